@@ -0,0 +1,394 @@
+"""
+changelogutil module:
+Contains a reader and a generator for debian/changelog files.
+Entries are parsed lazily, newest first, so reading the current version
+only parses the first entry.
+If a failure occurs functions will terminate with ChangelogError.
+"""
+from email.utils import formatdate
+from enum import Enum
+from json import dump, load
+from os import stat, path, environ, replace, makedirs
+from re import compile as re_compile, IGNORECASE
+from textwrap import wrap
+
+from gbpxargs import Flag
+from gitutil import get_session, GitError, resolve_rev
+from ioutil import Error, log, TextType, exec_cmd, exec_cmd_lines, \
+    CommandError
+
+DEFAULT_CHANGELOG_PATH = "debian/changelog"
+
+# Header and trailer lines of an entry, as parsed by dpkg.
+_HEADER_PATTERN = re_compile(
+    r"^(\w[-+0-9a-z.]*) \(([^() \t]+)\)((?:\s+[-+0-9a-z.]+)+);(.*)$",
+    IGNORECASE)
+_TRAILER_PATTERN = re_compile(r"^ -- (.*) <(.*)>  ?(.*\S)\s*$")
+# Lines ending the entries of a changelog.
+_END_PATTERN = re_compile(r"^(?:Local variables:|Old Changelog:|"
+                          r"/\* -\*- mode: .* -\*- \*/|vim:)", IGNORECASE)
+
+# First entries of read changelog files, by path with the file stamp.
+_entry_cache = {}
+
+# State of the native generator, kept in '<git common dir>/gbpx/'.
+_STATE_DIR = "gbpx"
+_STATE_FILE = "changelog.json"
+_LOG_FORMAT = "--format=%H%x09%an%x09%s"
+_UNRELEASED = "UNRELEASED"
+_LINE_WIDTH = 80
+
+
+class ChangelogError(Error):
+    """Error raised for changelog parsing.
+
+    Attributes:
+        file_   -- the changelog file
+        msg     -- explanation of the error
+        line    -- the affected line number (None if N/A)
+    """
+
+    def __init__(self, msg, file_=None, line=None):
+        Error.__init__(self)
+        self.msg = msg
+        self.file = file_
+        self.line = line
+
+    def log(self, flags):
+        """ Log the error """
+        log(flags, ("An error with changelog: " + self.file +
+                    "\n" if self.file is not None else "") + (
+                "On line: " + str(self.line) +
+                "\n" if self.line is not None else "") + self.msg, TextType.ERR)
+
+
+class ChangelogGenerator(Enum):
+    """ Changelog generator identifiers. """
+    GBP = 'gbp'
+    NATIVE = 'native'
+
+
+class ChangelogEntry(object):
+    """ An entry (stanza) of a debian changelog. """
+
+    __slots__ = ('source', 'version', 'distribution', 'urgency', 'changes',
+                 'maintainer', 'date')
+
+    def __init__(self, source, version, distribution, urgency):
+        self.source = source
+        self.version = version
+        self.distribution = distribution
+        self.urgency = urgency
+        self.changes = []
+        self.maintainer = None
+        self.date = None
+
+
+def _get_urgency(options):
+    """ Returns the urgency from the options of a header line. """
+    for option in options.split(','):
+        key, _, value = option.strip().partition('=')
+        if key.lower() == "urgency":
+            return value.strip()
+    return None
+
+
+def iter_changelog_entries(lines, name=DEFAULT_CHANGELOG_PATH):
+    """
+    Parses changelog entries from lines of text, one entry at a time,
+    so only the lines of the entries read are consumed.
+    Errors will be raised as ChangelogError.
+        :param lines: iterable of the changelog lines
+        :param name: the changelog name used in errors
+        :returns: generator of ChangelogEntry, newest first
+    """
+    entry = None
+    for line_num, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
+        if entry is None:
+            # Blank and comment lines between entries are skipped.
+            if not line.strip() or line.startswith('#'):
+                continue
+            elif _END_PATTERN.match(line):
+                return
+            header = _HEADER_PATTERN.match(line)
+            if header is None:
+                raise ChangelogError("Expected an entry header line", name,
+                                     line_num)
+            entry = ChangelogEntry(header.group(1), header.group(2),
+                                   header.group(3).strip(),
+                                   _get_urgency(header.group(4)))
+        elif line.startswith(" --"):
+            trailer = _TRAILER_PATTERN.match(line)
+            if trailer is None:
+                raise ChangelogError("Badly formatted entry trailer line",
+                                     name, line_num)
+            entry.maintainer = "{0} <{1}>".format(trailer.group(1),
+                                                  trailer.group(2))
+            entry.date = trailer.group(3)
+            # Strip the blank lines around the changes.
+            while entry.changes and not entry.changes[-1].strip():
+                entry.changes.pop()
+            while entry.changes and not entry.changes[0].strip():
+                entry.changes.pop(0)
+            yield entry
+            entry = None
+        else:
+            entry.changes.append(line)
+    if entry is not None:
+        raise ChangelogError("Unexpected end of file in entry \'" +
+                             entry.version + "\'", name)
+
+
+def read_changelog_entries(file_path=DEFAULT_CHANGELOG_PATH):
+    """
+    Streams the entries of a changelog file, the file is only read as
+    far as entries are taken.
+    Errors will be raised as ChangelogError.
+        :returns: generator of ChangelogEntry, newest first
+    """
+    try:
+        with open(file_path, encoding="utf-8") as file_:
+            yield from iter_changelog_entries(file_, file_path)
+    except (IOError, OSError, UnicodeDecodeError) as err:
+        raise ChangelogError("The changelog could not be read: " + str(err),
+                             file_path)
+
+
+def get_changelog_entry(file_path=DEFAULT_CHANGELOG_PATH):
+    """
+    Retrieves the latest entry of a changelog file. The result is cached
+    until the file is modified.
+    Errors will be raised as ChangelogError.
+        :returns: the latest entry
+        :rtype: ChangelogEntry
+    """
+    try:
+        file_stat = stat(file_path)
+    except OSError:
+        raise ChangelogError("The changelog does not exist", file_path)
+    stamp = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+    cache_key = path.abspath(file_path)
+    cached = _entry_cache.get(cache_key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    entry = next(read_changelog_entries(file_path), None)
+    if entry is None:
+        raise ChangelogError("The changelog has no entries", file_path)
+    _entry_cache[cache_key] = (stamp, entry)
+    return entry
+
+
+def get_branch_changelog_entry(branch, file_path=DEFAULT_CHANGELOG_PATH):
+    """
+    Retrieves the latest entry of the changelog of a branch without
+    checking it out, read from the blob through the repository session.
+    The result is cached by blob.
+    Errors will be raised as ChangelogError.
+        :returns: the latest entry
+        :rtype: ChangelogEntry
+    """
+    name = branch + ":" + file_path
+    try:
+        obj = get_session().read_object(name)
+    except GitError as err:
+        raise ChangelogError(err.msg, name)
+    if obj is None:
+        raise ChangelogError("The changelog does not exist", name)
+    cached = _entry_cache.get(obj[0])
+    if cached is not None:
+        return cached[1]
+
+    try:
+        lines = obj[2].decode("utf-8").splitlines()
+    except UnicodeDecodeError:
+        raise ChangelogError("The changelog is not valid text", name)
+    entry = next(iter_changelog_entries(lines, name), None)
+    if entry is None:
+        raise ChangelogError("The changelog has no entries", name)
+    _entry_cache[obj[0]] = (None, entry)
+    return entry
+
+
+def _read_state(state_path):
+    """ Reads the generator state, None if missing or unreadable. """
+    try:
+        with open(state_path) as state_file:
+            return load(state_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _is_ancestor(commit, rev):
+    """ Checks if a commit is an ancestor of (or equal to) a revision. """
+    try:
+        exec_cmd(["git", "merge-base", "--is-ancestor", commit, rev])
+        return True
+    except CommandError:
+        # Not an ancestor, or the commit no longer exists.
+        return False
+
+
+def get_changes(since_rev=None):
+    """
+    Retrieves the commits on HEAD since the given revision (all commits
+    if None), merges left out. The commits read by the latest call on
+    the branch are remembered in the repository, and if that call used
+    the same revision and its HEAD is still an ancestor of HEAD only the
+    range between them is read, commits of merged branches included.
+    Otherwise (e.g. a new release or rewritten history) all commits are
+    read.
+    Errors will be raised as ChangelogError.
+        :returns: list of (<author>, <subject>), oldest first
+        :rtype: list
+    """
+    try:
+        session = get_session()
+        head = session.get_head()
+        since = (resolve_rev(since_rev + "^{commit}")
+                 if since_rev is not None else None)
+        branch = session.get_branch()
+    except GitError as err:
+        raise ChangelogError(err.msg)
+    state_path = path.join(session.common_dir, _STATE_DIR, _STATE_FILE)
+    state = _read_state(state_path)
+    if not isinstance(state, dict):
+        state = {}
+    cached = state.get(branch)
+    if not isinstance(cached, dict) or cached.get('since') != since or \
+            not _is_ancestor(cached.get('last', ""), head):
+        cached = {'last': None, 'changes': []}
+
+    # Read the commits not reachable from the last read HEAD or since.
+    new_changes = []
+    if cached['last'] != head:
+        rev_range = ["HEAD"] + ["^" + rev for rev in (cached['last'], since)
+                                if rev is not None]
+        lines = exec_cmd_lines(["git", "log", "--no-merges", "--reverse",
+                                _LOG_FORMAT] + rev_range + ["--"])
+        try:
+            for line in lines:
+                author, subject = line.split('\t', 2)[1:]
+                new_changes.append([author, subject])
+        except CommandError as err:
+            raise ChangelogError("The commit history could not be read:\n" +
+                                 err.std_err.strip())
+        finally:
+            lines.close()
+
+    changes = cached['changes'] + new_changes
+    if cached['last'] != head:
+        # Remember the commits read up to HEAD, only the latest for each
+        # branch.
+        state[branch] = {'since': since, 'last': head, 'changes': changes}
+        try:
+            makedirs(path.dirname(state_path), exist_ok=True)
+            tmp_path = state_path + ".tmp"
+            with open(tmp_path, 'w') as state_file:
+                dump(state, state_file)
+            replace(tmp_path, state_path)
+        except (IOError, OSError):
+            # The state is only an optimization.
+            pass
+    return [tuple(change) for change in changes]
+
+
+def _get_maintainer():
+    """
+    Returns the maintainer of new entries (<name> <<email>>), from
+    DEBFULLNAME and DEBEMAIL if set, otherwise from the git committer.
+    Errors will be raised as ChangelogError.
+    """
+    try:
+        ident = exec_cmd(["git", "var", "GIT_COMMITTER_IDENT"])
+    except CommandError:
+        raise ChangelogError("The maintainer could not be determined")
+    name, _, email = ident.rpartition('>')[0].partition(' <')
+    email = environ.get("DEBEMAIL", email)
+    if '<' in email:
+        # DEBEMAIL can hold both the name and the email.
+        name, _, email = email.rstrip('>').partition('<')
+        name = name.strip()
+    name = environ.get("DEBFULLNAME", name)
+    return "{0} <{1}>".format(name, email.strip())
+
+
+def _format_changes(changes):
+    """
+    Formats the change lines of an entry, grouping the changes by author
+    if there are several authors (like gbp dch).
+    """
+    authors = []
+    for author, _ in changes:
+        if author not in authors:
+            authors.append(author)
+    lines = []
+    for author in authors:
+        if len(authors) > 1:
+            if lines:
+                lines.append("")
+            lines.append("  [ " + author + " ]")
+        for change_author, subject in changes:
+            if change_author == author:
+                lines += wrap(subject, _LINE_WIDTH, initial_indent="  * ",
+                              subsequent_indent="    ")
+    return lines
+
+
+def add_changelog_entry(flags, version, changes, distribution=None,
+                        urgency="low", release=False,
+                        file_path=DEFAULT_CHANGELOG_PATH):
+    """
+    Writes a new entry at the top of a changelog file, replacing the
+    latest entry if it has the same version.
+    The distribution is UNRELEASED unless set or releasing, then the
+    distribution of the latest released entry is kept.
+    Errors will be raised as ChangelogError.
+        :param version: the version of the new entry
+        :param changes: list of (<author>, <subject>), oldest first
+    """
+    try:
+        with open(file_path, encoding="utf-8") as file_:
+            lines = file_.readlines()
+    except (IOError, OSError, UnicodeDecodeError) as err:
+        raise ChangelogError("The changelog could not be read: " + str(err),
+                             file_path)
+    entries = iter_changelog_entries(lines, file_path)
+    latest = next(entries, None)
+    if latest is None:
+        raise ChangelogError("The changelog has no entries", file_path)
+    if distribution is None and release:
+        # Use the distribution of the latest released entry.
+        released = latest
+        while released is not None and released.distribution == _UNRELEASED:
+            released = next(entries, None)
+        distribution = (released.distribution if released is not None
+                        else _UNRELEASED)
+
+    if latest.version == version:
+        # Drop the latest entry up to and including its trailer.
+        end = next(index for index, line in enumerate(lines)
+                   if line.startswith(" --"))
+        lines = lines[end + 1:]
+        while lines and not lines[0].strip():
+            lines.pop(0)
+
+    if distribution is None:
+        distribution = _UNRELEASED
+    entry = ["{0} ({1}) {2}; urgency={3}".format(latest.source, version,
+                                                 distribution, urgency), ""]
+    entry += _format_changes(changes) or ["  * New release."]
+    entry += ["", " -- {0}  {1}".format(_get_maintainer(),
+                                        formatdate(localtime=True)), ""]
+
+    if not flags[Flag.SAFEMODE]:
+        tmp_path = file_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding="utf-8") as file_:
+                file_.write("\n".join(entry) + "\n")
+                file_.writelines(lines)
+            replace(tmp_path, file_path)
+        except (IOError, OSError) as err:
+            raise ChangelogError("The changelog could not be written: " +
+                                 str(err), file_path)
@@ -6,21 +6,29 @@ Used as a helper script for gbp-buildpackage.
 from argparse import ArgumentParser, SUPPRESS
 from glob import glob
 from os import path, chdir, getcwd
-from re import findall
 
+from changelogutil import get_changelog_entry, get_changes, \
+    add_changelog_entry, ChangelogGenerator
 from gbpxargs import Flag, Option, Action
 from gbpxutil import verify_create_head_tag, OpError, ConfigError, \
     restore_backup, create_ex_config, add_backup, restore_temp_commit, \
     get_next_upstream_version, is_version_lt, create_temp_commit, get_config, \
     get_config_default, DEFAULT_CONFIG_PATH, Setting, \
-    get_next_package_build_version
+    get_next_package_build_version, BranchFiles, ExcludeMatcher, \
+    get_orig_tarball, get_latest_by_version, get_file_version_str, \
+    get_build_record, add_build_record, LintianStage
 from gitutil import get_head_tag_version_str, commit_changes, switch_branch, \
     GitError, get_latest_tag_version, get_rep_name_from_url, clean_repository, \
-    get_branch, reset_branch
-from ioutil import Error, log, TextType, prompt_user_input, mkdirs, \
+    get_branch, reset_branch, invalidate_tag_index, RefTransaction, \
+    get_tag_index, get_file_content, get_latest_tag, commit_tree, \
+    create_annotated_tag, merge_replace, resolve_rev, check_git_rep
+from ioutil import Error, log, TextType, prompt_user_input, \
     exec_cmd, get_files_with_extension, clean_dir, \
     log_success, log_err, remove_dir, CommandError, exec_editor, \
-    prompt_user_yn, exec_piped_cmds, remove_file, line_break
+    prompt_user_yn, exec_piped_cmds, remove_file, line_break, \
+    get_spawn_count, get_spawn_counts, exec_cmd_streamed, log_cmd_profile, \
+    dump_cmd_records, Span, dump_trace, exec_concurrently, get_compression_ext
+from versionutil import split_version
 
 ############################## Constants ################################
 #########################################################################
@@ -28,17 +36,22 @@ from ioutil import Error, log, TextType, prompt_user_input, mkdirs, \
 __version__ = "0.8"
 
 _GIT_IGNORE_PATH = ".gitignore"
+_DEBIAN_DIR = "debian"
 _CHANGELOG_PATH = "debian/changelog"
 _BUILD_DIR = "../build-area"
 _TMP_DIR = "/tmp/gbpx"
 _TMP_TAR_SUBDIR = "tarball"
 _TMP_BAK_SUBDIR = "backup"
+_TMP_WORKTREE_SUBDIR = "worktree"
+_TMP_ORIG_CACHE_SUBDIR = "orig-cache"
+_TMP_LINTIAN_CACHE_SUBDIR = "lintian-cache"
 _SOURCE_CHANGES_FILE_EXT = "source.changes"
 _CHANGES_FILE_EXT = ".changes"
-_ORIG_TAR_FILE_EXT = ".orig.tar.gz"
+_ORIG_TAR_FILE_EXT = ".orig.tar"
 _MASTER_BRANCH = "master"
 _BUILD_NAME = "final"
 _TEST_BUILD_NAME = "test"
+_PROFILE_COUNT = 10
 
 
 class _ActionConf(object):
@@ -88,12 +101,20 @@ def execute_with(**opts):
         :type quiet: bool
         :param color:
         :type color: bool
+        :param force: rebuild even if the sources are unchanged
+        :type force: bool
         :param no_restore:
         :type no_restore: bool
         :param config: the path to the configuration file
         :type config: str
         :param dir: the working directory
         :type dir: str
+        :param profile: the number of slowest commands to report
+        :type profile: int
+        :param profile_json: the path to dump command records to
+        :type profile_json: str
+        :param trace: the path to write a Chrome trace file to
+        :type trace: str
         :param action:
         :type action: Action
     """
@@ -101,12 +122,16 @@ def execute_with(**opts):
         Flag.SAFEMODE: opts.get('safemode', False),
         Flag.VERBOSE: opts.get('verbose', False),
         Flag.QUIET: opts.get('quiet', False),
-        Flag.COLOR: opts.get('color', False)}
+        Flag.COLOR: opts.get('color', False),
+        Flag.FORCE: opts.get('force', False)}
 
     options = {Option.CONFIG: opts.get('config', DEFAULT_CONFIG_PATH),
                Option.DIR: opts.get('dir', "."),
                Option.VERSION: opts.get('version', False),
-               Option.NO_RESTORE: opts.get('norestore', False)}
+               Option.NO_RESTORE: opts.get('norestore', False),
+               Option.PROFILE: opts.get('profile'),
+               Option.PROFILE_JSON: opts.get('profile_json'),
+               Option.TRACE: opts.get('trace')}
 
     action = opts.get('action')
 
@@ -116,9 +141,8 @@ def execute_with(**opts):
 ########################## Argument Parsing #############################
 #########################################################################
 
-def _parse_args_and_execute():
-    """ Parses arguments and executes requested operations. """
-
+def _create_parser():
+    """ Creates the command line argument parser. """
     parser = ArgumentParser(
         description='Maintain debian packages with git and gbp.')
 
@@ -135,12 +159,29 @@ def _parse_args_and_execute():
                         action='store_true', help='enable colored output')
     parser.add_argument('-s', '--{}'.format(Flag.SAFEMODE.value),
                         action='store_true', help='prevent any file changes')
+    parser.add_argument('-f', '--{}'.format(Flag.FORCE.value),
+                        action='store_true',
+                        help='rebuild even if the sources are unchanged')
     parser.add_argument('-n', '--{}'.format(Option.NO_RESTORE.value),
                         action='store_true',
                         help='prevent auto restore on command failure')
     parser.add_argument('--{}'.format(Option.CONFIG.value),
                         default=DEFAULT_CONFIG_PATH,
                         help='path to the configuration file')
+    parser.add_argument('--{}'.format(Option.PROFILE.value),
+                        action='store_true',
+                        help='report the slowest commands and the ' +
+                        'totals per executable')
+    parser.add_argument('--{}'.format(Option.PROFILE_COUNT.value), type=int,
+                        metavar='N',
+                        help='the number of slowest commands to report '
+                        '(default {}), implies --{}'.format(
+                            _PROFILE_COUNT, Option.PROFILE.value))
+    parser.add_argument('--{}'.format(Option.PROFILE_JSON.value),
+                        metavar='FILE',
+                        help='write the executed command records as JSON')
+    parser.add_argument('--{}'.format(Option.TRACE.value), metavar='FILE',
+                        help='write a Chrome trace of the execution phases')
     # Hidden options.
     parser.add_argument('--{}'.format(Option.SHOW_FLAGS.value),
                         action='store_true', help=SUPPRESS)
@@ -165,17 +206,35 @@ def _parse_args_and_execute():
     # General args.
     parser.add_argument(Option.DIR.value, nargs='?', default=getcwd(),
                         help="path to git repository")
+    return parser
+
+
+def _get_profile_count(args):
+    """
+    Returns the number of slowest commands to report, None if profiling
+    was not requested.
+    """
+    if args.profile_count is not None:
+        return args.profile_count
+    return _PROFILE_COUNT if args.profile else None
+
 
-    args = parser.parse_args()
+def _parse_args_and_execute():
+    """ Parses arguments and executes requested operations. """
+    args = _create_parser().parse_args()
 
     flags = {Flag.SAFEMODE: args.safemode, Flag.VERBOSE: args.verbose,
-             Flag.QUIET: args.quiet, Flag.COLOR: args.color}
+             Flag.QUIET: args.quiet, Flag.COLOR: args.color,
+             Flag.FORCE: args.force}
 
     options = {Option.CONFIG: args.config, Option.DIR: args.dir,
                Option.NO_RESTORE: args.no_restore, Option.VERSION: args.version,
                Option.SHOW_FLAGS: args.show_flags,
                Option.SHOW_OPTIONS: args.show_options,
-               Option.SHOW_ACTIONS: args.show_actions}
+               Option.SHOW_ACTIONS: args.show_actions,
+               Option.PROFILE: _get_profile_count(args),
+               Option.PROFILE_JSON: args.profile_json,
+               Option.TRACE: args.trace}
 
     action = Action(args.action) if args.action is not None else None
 
@@ -186,6 +245,10 @@ def _parse_args_and_execute():
 ######################### Command Execution #############################
 #########################################################################
 
+# Stages started by the action that run in the background (e.g. lintian).
+_background_stages = []
+
+
 def _execute(flags, options, action):
     """
     Executes the main program phases.
@@ -221,37 +284,56 @@ def _execute(flags, options, action):
     if _ACTION_CONF[action].is_repository_based:
         try:
             log(flags, "\nSaving backup of repository", TextType.INFO)
-            bak_name = add_backup(flags, bak_dir, name=action.value)
+            with Span("backup"):
+                # Load the tag index while the backup is written,
+                # both only read the repository.
+                compression = _get_backup_compression(
+                    options[Option.CONFIG])
+                # Open the repository session the jobs share first.
+                try:
+                    check_git_rep()
+                except GitError:
+                    pass
+                bak_name = exec_concurrently(
+                    [lambda: add_backup(flags, bak_dir, name=action.value,
+                                        compression=compression[0],
+                                        threads=compression[1]),
+                     _preload_repository])[0]
         except OpError as err:
             log_err(flags, err)
             quit()
 
     try:
         # Execute initiation phase.
-        init_data = _exec_init(flags, action, options[Option.CONFIG])
+        with Span("init"):
+            init_data = _exec_init(flags, action, options[Option.CONFIG])
 
         # Execute action if allowed.
         if init_data[0]:
-            _exec_action(flags, action, init_data[1], options[Option.CONFIG],
-                         bak_dir)
-
-        # Restore if required by action.
-        if _ACTION_CONF[action].restore_backup:
-            try:
-                restore_backup(flags, bak_dir, name=bak_name)
-            except OpError:
-                log(flags, "Restore failed, see \'gbpx {}\'".format(
-                    Action.RESTORE) + " to restore repository to " +
-                    "previous state", TextType.INFO)
-
-        # Reset if action is repository based (temp commit was made).
-        elif _ACTION_CONF[action].is_repository_based:
-            try:
-                log(flags, "Restoring initial branch state", TextType.INFO)
-                restore_temp_commit(flags, init_data[2])
-            except Error:
-                log(flags, "Could not switch back to initial branch state",
-                    TextType.ERR)
+            with Span("action", action=action.value):
+                _exec_action(flags, action, init_data[1],
+                             options[Option.CONFIG], bak_dir)
+
+        with Span("restore"):
+            # Restore if required by action.
+            if _ACTION_CONF[action].restore_backup:
+                try:
+                    restore_backup(flags, bak_dir, name=bak_name)
+                except OpError:
+                    log(flags, "Restore failed, see \'gbpx {}\'".format(
+                        Action.RESTORE) + " to restore repository to " +
+                        "previous state", TextType.INFO)
+
+            # Reset if action is repository based (temp commit was made).
+            elif _ACTION_CONF[action].is_repository_based:
+                try:
+                    log(flags, "Restoring initial branch state",
+                        TextType.INFO)
+                    restore_temp_commit(flags, init_data[2])
+                except Error:
+                    log(flags,
+                        "Could not switch back to initial branch state",
+                        TextType.ERR)
     except OpError:
         # Force a backup restore if command has failed.
         log(flags, "\nError recovery for action \'" + action.value +
@@ -263,7 +345,8 @@ def _execute(flags, options, action):
                     "repository to previous state", TextType.INFO)
             else:
                 try:
-                    restore_backup(flags, bak_dir, name=bak_name)
+                    with Span("restore", recovery=True):
+                        restore_backup(flags, bak_dir, name=bak_name)
                 except OpError:
                     log(flags, "Restore failed, see \'gbpx {}\'".format(
                         Action.RESTORE) + " to restore repository to " +
@@ -271,6 +354,69 @@ def _execute(flags, options, action):
         else:
             log(flags, "No restore action needed", TextType.INFO)
 
+    # Wait for the stages still running in the background.
+    if _background_stages:
+        with Span("wait-background"):
+            while _background_stages:
+                _background_stages.pop(0).wait(flags)
+
+    # Report the number of processes spawned by the action.
+    log(flags, "\nSpawned {} processes ({})".format(
+        get_spawn_count(), ", ".join(
+            ["{}: {}".format(exe, count) for exe, count in
+             sorted(get_spawn_counts().items())])))
+    _report_profile(flags, options)
+
+
+def _report_profile(flags, options):
+    """
+    Reports the resource usage of the executed commands if requested.
+        :param flags:
+        :type flags: dict
+        :param options: options
+        :type options: dict
+    """
+    if options.get(Option.PROFILE) is not None:
+        log_cmd_profile(flags, options[Option.PROFILE])
+
+    if options.get(Option.PROFILE_JSON) is not None:
+        try:
+            dump_cmd_records(options[Option.PROFILE_JSON])
+        except OSError as err:
+            log(flags, "Could not write command records: {}".format(err),
+                TextType.WARNING)
+
+    if options.get(Option.TRACE) is not None:
+        try:
+            dump_trace(options[Option.TRACE])
+        except OSError as err:
+            log(flags, "Could not write trace: {}".format(err),
+                TextType.WARNING)
+
+
+def _get_backup_compression(config_path):
+    """
+    Returns a tuple of the compression method and threads for backups.
+    The config is read from the current branch if possible, since backups
+    are made before the config has been loaded.
+    """
+    try:
+        conf = get_config(config_path)
+        return conf[Setting.COMPRESSION], conf[Setting.COMPRESSION_THREADS]
+    except Error:
+        return get_config_default(Setting.COMPRESSION), None
+
+
+def _preload_repository():
+    """
+    Loads the repository data used by most actions ahead of time,
+    errors are left to be reported by the action.
+    """
+    try:
+        get_tag_index()
+    except Error:
+        pass
+
 
 def _execute_options(flags, options):
     """
@@ -417,6 +563,16 @@ def _exec_action(flags, action, conf, config_path, bak_dir):
 ####################### Sub Command functions ###########################
 #########################################################################
 
+def _get_branch_files(conf, branch):
+    """
+    Returns the access to the files of a branch,
+    using linked worktrees if enabled in the config.
+    """
+    wt_dir = (path.join(_TMP_DIR, _TMP_WORKTREE_SUBDIR, path.basename(getcwd()))
+              if conf[Setting.USE_WORKTREES] else None)
+    return BranchFiles(branch, wt_dir)
+
+
 def _test_pkg(conf, flags):
     """
     Prepares a release and builds the package
@@ -436,15 +592,18 @@ def _test_pkg(conf, flags):
         release_ver = create_ver[0]
 
         # Prepare release, no tags.
-        _commit_release(conf, flags, False)
+        with Span("commit-release"):
+            _commit_release(conf, flags, False, tarball=False)
 
         # Update the changelog to match upstream version.
         debian_ver = release_ver + conf[Setting.DEBIAN_VERSION_SUFFIX]
-        _update_changelog(conf, flags, version=debian_ver, commit=True)
+        with Span("update-changelog"):
+            _update_changelog(conf, flags, version=debian_ver, commit=True)
 
         # Test package build.
-        _build(conf, flags, conf[Setting.TEST_BUILD_FLAGS],
-               build_name=_TEST_BUILD_NAME)
+        with Span("build"):
+            _build(conf, flags, conf[Setting.TEST_BUILD_FLAGS],
+                   build_name=_TEST_BUILD_NAME)
 
         # Revert changes.
         log(flags, "Reverting changes")
@@ -453,24 +612,29 @@ def _test_pkg(conf, flags):
         raise OpError()
 
 
-def _commit_release(conf, flags, sign):
+def _commit_release(conf, flags, sign, tarball=True):
     """
     Prepares release, committing the latest to
     upstream and merging with debian. Also tags the upstrem commit.
+    If tarball is False the release tree is committed directly to the
+    upstream branch instead of making and importing a tarball, the
+    tarball is then made from the upstream tag by the build if needed.
     Returns the tag name on success.
     """
     log(flags, "Committing release", TextType.INFO)
 
     # Constants
     tmp_dir = path.join(_TMP_DIR, _TMP_TAR_SUBDIR, conf[Setting.PACKAGE_NAME])
-    archive_path = path.join(tmp_dir,
-                             conf[Setting.RELEASE_BRANCH] + "_archive.tar")
+
+    # Ref changes are written together once the release is imported.
+    ref_transaction = RefTransaction(flags)
 
     try:
         # Get the tagged version from the release branch.
         create_ver = verify_create_head_tag(flags,
                                             conf[Setting.RELEASE_BRANCH],
-                                            conf[Setting.RELEASE_TAG_TYPE])
+                                            conf[Setting.RELEASE_TAG_TYPE],
+                                            transaction=ref_transaction)
         release_ver = create_ver[0]
 
         log(flags, "Selected release version \'" +
@@ -483,10 +647,10 @@ def _commit_release(conf, flags, sign):
         except GitError:
             # No tag was detected, release version is used.
             upstream_ver = None
-        source_dir = conf[Setting.PACKAGE_NAME] + "-" + release_ver
-        source_dir_path = path.join(tmp_dir, source_dir)
         tar_path = path.join(tmp_dir, conf[Setting.PACKAGE_NAME] + "_" +
-                             release_ver + _ORIG_TAR_FILE_EXT)
+                             release_ver + _ORIG_TAR_FILE_EXT +
+                             get_compression_ext(conf[Setting.COMPRESSION]))
+        upstream_tag = conf[Setting.UPSTREAM_TAG_TYPE] + "/" + release_ver
 
         # Check that the release version is greater than the upstream version.
         if upstream_ver is not None and \
@@ -494,85 +658,144 @@ def _commit_release(conf, flags, sign):
             raise GitError("Release version is less than " +
                            "upstream version, aborting")
 
-        # Clean build directory.
-        log(flags, "Cleaning tarball directory")
-        clean_dir(flags, tmp_dir)
-        mkdirs(flags, source_dir_path)
-
-        # Extract the latest commit to release branch.
-        log(flags, "Extracting release version \'" + release_ver +
-            "\' from release branch \'" +
-            conf[Setting.RELEASE_BRANCH] + "\'")
-
-        # Prepare exclude list.
+        # Prepare exclusions, version control files are always excluded.
+        matcher = ExcludeMatcher(exclude_vcs=True)
         if conf[Setting.EXCLUDE_FILES] is not None:
-            exclude_opts = ["--exclude=" + e for e in
-                            conf[Setting.EXCLUDE_FILES]]
-        else:
-            exclude_opts = []
+            matcher.add_patterns(conf[Setting.EXCLUDE_FILES])
 
-        # Add .gitignore to excluded if it is present.
-        if path.exists(_GIT_IGNORE_PATH):
-            exclude_opts.append("--exclude-from={}".format(_GIT_IGNORE_PATH))
-
-        if not flags[Flag.SAFEMODE]:
-            exec_cmd(["git", "archive", conf[Setting.RELEASE_BRANCH], "-o",
-                      archive_path])
-            exec_cmd(["tar", "-xf", archive_path, "--directory=" +
-                      source_dir_path] + exclude_opts)
-
-        # Create the upstream tarball.
-        log(flags, "Making upstream tarball from extracted source files")
-        if not flags[Flag.SAFEMODE]:
-            exec_cmd(["tar", "--directory=" + tmp_dir, "-czf", tar_path,
-                      source_dir, "--exclude-vcs"])
-
-        # Commit tarball to upstream branch and tag.
-        log(flags, "Importing tarball to upstream branch \'" +
-            conf[Setting.UPSTREAM_BRANCH] + "\'")
+        # Add the .gitignore of the release to excluded if it is present.
+        git_ignore = get_file_content(conf[Setting.RELEASE_BRANCH],
+                                      _GIT_IGNORE_PATH)
+        if git_ignore is not None:
+            matcher.add_patterns(git_ignore.split('\n'))
 
         # Check if should sign and gpg key is set.
-        tag_opt = []
+        key_id = None
         if sign:
             if conf[Setting.GPG_KEY_ID] is not None:
-                tag_opt = ["--sign-tags",
-                           "--keyid=" + conf[Setting.GPG_KEY_ID]]
+                key_id = conf[Setting.GPG_KEY_ID]
             else:
                 log(flags, "The gpg key id is not set in the " +
                     "configuration file, disabling tag signing.",
                     TextType.WARNING)
 
-        log(flags,
-            "Merging upstream branch \'" + conf[Setting.UPSTREAM_BRANCH] +
-            "\' into debian branch \'" + conf[Setting.DEBIAN_BRANCH] + "\'")
-        if not flags[Flag.SAFEMODE]:
-            exec_cmd(["gbp", "import-orig", "--no-interactive", "--merge"] +
-                     tag_opt + [
-                         "--merge-mode=replace",
-                         "--debian-branch=" + conf[Setting.DEBIAN_BRANCH],
-                         "--upstream-branch=" + conf[Setting.UPSTREAM_BRANCH],
-                         tar_path])
+        if tarball:
+            _import_release_tarball(conf, flags, matcher, release_ver,
+                                    tmp_dir, tar_path, key_id)
+
+            # Reset upstream to import commit.
+            log(flags,
+                "Resetting upstream branch \'" +
+                conf[Setting.UPSTREAM_BRANCH] +
+                "\' to import commit \'" + upstream_tag + "\'")
+            reset_branch(flags, conf[Setting.UPSTREAM_BRANCH], upstream_tag,
+                         ref_transaction)
+        else:
+            _import_release_tree(conf, flags, matcher, release_ver,
+                                 upstream_tag, key_id, ref_transaction)
 
-        # Reset upstream to import commit.
-        upstream_tag = conf[Setting.UPSTREAM_TAG_TYPE] + "/" + release_ver
-        log(flags,
-            "Resetting upstream branch \'" + conf[Setting.UPSTREAM_BRANCH] +
-            "\' to import commit \'" + upstream_tag + "\'")
-        reset_branch(flags, conf[Setting.UPSTREAM_BRANCH], upstream_tag)
+        # Write the release tag and the upstream changes.
+        ref_transaction.commit(flags)
+
+        # Update the files if the debian branch was moved while checked out.
+        if not tarball and get_branch() == conf[Setting.DEBIAN_BRANCH]:
+            reset_branch(flags, conf[Setting.DEBIAN_BRANCH], "HEAD")
 
     except Error as err:
         log_err(flags, err)
         raise OpError()
 
-    # Cleanup tarball directory
-    log(flags, "Cleaning up temporary files")
-    remove_dir(flags, tmp_dir)
+    if tarball:
+        # Cleanup tarball directory
+        log(flags, "Cleaning up temporary files")
+        remove_dir(flags, tmp_dir)
 
     # Print success message.
     log_success(flags)
 
     # Return the name of the upstream tag.
-    return conf[Setting.UPSTREAM_TAG_TYPE] + "/" + release_ver
+    return upstream_tag
+
+
+def _import_release_tarball(conf, flags, matcher, release_ver, tmp_dir,
+                            tar_path, key_id):
+    """
+    Makes the upstream tarball from the release branch and imports it
+    to the upstream branch and tag, merging it into the debian branch.
+    Errors will be raised as Error.
+    """
+    # Clean build directory.
+    log(flags, "Cleaning tarball directory")
+    clean_dir(flags, tmp_dir)
+
+    # Stream the latest commit of the release branch into the upstream
+    # tarball, filtering out the excluded files on the way.
+    log(flags, "Making upstream tarball of release version \'" +
+        release_ver + "\' from release branch \'" +
+        conf[Setting.RELEASE_BRANCH] + "\'")
+    with Span("tarball"):
+        if not flags[Flag.SAFEMODE]:
+            tar_size, tar_checksums, cached = get_orig_tarball(
+                path.join(_TMP_DIR, _TMP_ORIG_CACHE_SUBDIR),
+                conf[Setting.RELEASE_BRANCH], tar_path,
+                conf[Setting.PACKAGE_NAME], release_ver,
+                matcher, conf[Setting.COMPRESSION],
+                conf[Setting.COMPRESSION_THREADS])
+            log(flags, "{0} tarball \'{1}\' ({2} bytes, sha256 {3})".
+                format("Reused cached" if cached else "Created",
+                       tar_path, tar_size, tar_checksums['sha256']))
+
+    # Commit tarball to upstream branch and tag.
+    log(flags, "Importing tarball to upstream branch \'" +
+        conf[Setting.UPSTREAM_BRANCH] + "\'")
+    tag_opt = (["--sign-tags", "--keyid=" + key_id]
+               if key_id is not None else [])
+
+    log(flags,
+        "Merging upstream branch \'" + conf[Setting.UPSTREAM_BRANCH] +
+        "\' into debian branch \'" + conf[Setting.DEBIAN_BRANCH] + "\'")
+    with Span("import-orig"):
+        if not flags[Flag.SAFEMODE]:
+            exec_cmd(["gbp", "import-orig", "--no-interactive",
+                      "--merge"] + tag_opt + [
+                         "--merge-mode=replace",
+                         "--debian-branch=" + conf[Setting.DEBIAN_BRANCH],
+                         "--upstream-branch=" +
+                         conf[Setting.UPSTREAM_BRANCH],
+                         tar_path])
+            # The upstream tag was created by gbp.
+            invalidate_tag_index()
+
+
+def _import_release_tree(conf, flags, matcher, release_ver, upstream_tag,
+                         key_id, transaction):
+    """
+    Commits the filtered tree of the release branch to the upstream
+    branch, tags it and merges it into the debian branch keeping only
+    the debian directory, like gbp import-orig with merge mode replace.
+    All ref changes are queued in the transaction.
+    Errors will be raised as Error.
+    """
+    log(flags, "Committing release version \'" + release_ver +
+        "\' from release branch \'" + conf[Setting.RELEASE_BRANCH] +
+        "\' to upstream branch \'" + conf[Setting.UPSTREAM_BRANCH] + "\'")
+    with Span("import-tree"):
+        upstream_commit = commit_tree(
+            flags, conf[Setting.RELEASE_BRANCH],
+            conf[Setting.UPSTREAM_BRANCH],
+            "New upstream version " + release_ver,
+            matcher.is_excluded, transaction)
+        create_annotated_tag(flags, upstream_tag, upstream_commit,
+                             "Upstream version " + release_ver, key_id,
+                             transaction)
+
+        log(flags,
+            "Merging upstream branch \'" + conf[Setting.UPSTREAM_BRANCH] +
+            "\' into debian branch \'" + conf[Setting.DEBIAN_BRANCH] + "\'")
+        merge_replace(flags, conf[Setting.DEBIAN_BRANCH], upstream_commit,
+                      _DEBIAN_DIR,
+                      "Update upstream source from tag \'" +
+                      upstream_tag + "\'", transaction)
 
 
 def _update_changelog(conf, flags, **opts):
@@ -621,16 +844,26 @@ def _update_changelog(conf, flags, **opts):
                         if conf[Setting.DISTRIBUTION] is not None else [])
     release_opt = (["--release"] if release else [])
 
+    # The debian branch files are needed for its changelog file.
+    branch_files = _get_branch_files(conf, conf[Setting.DEBIAN_BRANCH])
     try:
-        switch_branch(conf[Setting.DEBIAN_BRANCH])
+        branch_files.enter(flags)
+        # A worktree has a detached HEAD.
+        branch_opt = (["--ignore-branch"] if branch_files.is_worktree()
+                      else [])
         if not flags[Flag.SAFEMODE]:
             # Update changelog.
-            exec_cmd(["gbp", "dch", "--debian-branch=" +
-                      conf[Setting.DEBIAN_BRANCH],
-                      "--new-version=" + debian_ver,
-                      "--urgency=" + conf[Setting.URGENCY],
-                      "--spawn-editor=snapshot"] + distribution_opt +
-                     release_opt)
+            if conf[Setting.CHANGELOG_GENERATOR] == ChangelogGenerator.NATIVE:
+                with Span("changelog"):
+                    _generate_changelog(conf, flags, debian_ver, release)
+            else:
+                with Span("dch"):
+                    exec_cmd(["gbp", "dch", "--debian-branch=" +
+                              conf[Setting.DEBIAN_BRANCH],
+                              "--new-version=" + debian_ver,
+                              "--urgency=" + conf[Setting.URGENCY],
+                              "--spawn-editor=snapshot"] + distribution_opt +
+                             release_opt + branch_opt)
 
             # Check if editor should be opened.
             if editor:
@@ -638,8 +871,7 @@ def _update_changelog(conf, flags, **opts):
 
         # Check if the version vas manually changed.
         try:
-            ch_ver = exec_cmd(
-                ["dpkg-parsechangelog", "--show-field", "Version"])
+            ch_ver = get_changelog_entry(_CHANGELOG_PATH).version
             if debian_ver != ch_ver:
                 debian_ver = ch_ver
                 log(flags,
@@ -655,14 +887,41 @@ def _update_changelog(conf, flags, **opts):
                 conf[Setting.DEBIAN_BRANCH] + "\'")
             commit_changes(flags, "Update changelog for " +
                            debian_ver + " release.")
+            branch_files.publish(flags)
     except Error as err:
         log_err(flags, err)
         raise OpError()
+    finally:
+        branch_files.leave()
 
     # Print success message.
     log_success(flags)
 
 
+def _generate_changelog(conf, flags, debian_ver, release):
+    """
+    Writes a changelog entry for the new version with the commits since
+    the debian tag of the current changelog version, or since the latest
+    debian tag if that tag does not exist.
+    Errors will be raised as Error.
+    """
+    current_tag = (conf[Setting.DEBIAN_TAG_TYPE] + "/" +
+                   get_changelog_entry(_CHANGELOG_PATH).version)
+    if current_tag in get_tag_index().get_tags(conf[Setting.DEBIAN_TAG_TYPE]):
+        since_tag = current_tag
+    else:
+        try:
+            since_tag = get_latest_tag("HEAD", conf[Setting.DEBIAN_TAG_TYPE])
+        except GitError:
+            # No release yet, all commits are included.
+            since_tag = None
+    log(flags, "Adding the changes since \'{}\' to the changelog".
+        format(since_tag if since_tag is not None else "the first commit"))
+    add_changelog_entry(flags, debian_ver, get_changes(since_tag),
+                        conf[Setting.DISTRIBUTION], conf[Setting.URGENCY],
+                        release, _CHANGELOG_PATH)
+
+
 def _build(conf, flags, build_flags, **opts):
     """
     Builds package from the latest debian commit.
@@ -675,16 +934,12 @@ def _build(conf, flags, build_flags, **opts):
     - sign_changes      -- Set to True to sign the .changes file.
     - sign_source       -- Set to True to sign the .source file.
     """
-    build_name = opts.get('build_name', None)
-    tag = opts.get('tag', False)
-    sign_tag = opts.get('sign-tag', False)
     upstream_treeish = opts.get('upstream_treeish', None)
-    sign_changes = opts.get('sign_changes', False)
-    sign_source = opts.get('sign_source', False)
 
     log(flags, "Building package", TextType.INFO)
 
     # Check if treeish is used for upstream.
+    upstream_ver = None
     if upstream_treeish is None:
         try:
             upstream_ver = get_head_tag_version_str(
@@ -698,34 +953,63 @@ def _build(conf, flags, build_flags, **opts):
         log(flags, "Building debian package for \'{}\'".
             format(upstream_treeish))
 
-    # Prepare build.
-    log(flags, "Switching to debian branch \'{}\'".
+    # Prepare build, only the build itself needs the debian branch files.
+    log(flags, "Preparing files of debian branch \'{}\'".
         format(conf[Setting.DEBIAN_BRANCH]))
-    switch_branch(conf[Setting.DEBIAN_BRANCH])
+    build_dir = path.abspath(_BUILD_DIR)
+    branch_files = _get_branch_files(conf, conf[Setting.DEBIAN_BRANCH])
+    try:
+        try:
+            branch_files.enter(flags)
+        except OpError as err:
+            log_err(flags, err)
+            raise OpError()
+        _build_branch_files(conf, flags, build_flags, build_dir, upstream_ver,
+                            branch_files.is_worktree(), **opts)
+    finally:
+        branch_files.leave()
+
+
+def _build_branch_files(conf, flags, build_flags, build_dir, upstream_ver,
+                        in_worktree, **opts):
+    """
+    Builds package from the debian branch files in the current directory.
+    - build_dir     -- the absolute path of the build area.
+    - upstream_ver  -- the expected upstream version, None if not checked.
+    - in_worktree   -- True if in a linked worktree (detached HEAD).
+    See _build for the other options.
+    """
+    build_name = opts.get('build_name', None)
+    tag = opts.get('tag', False)
+    sign_tag = opts.get('sign-tag', False)
+    upstream_treeish = opts.get('upstream_treeish', None)
+    sign_changes = opts.get('sign_changes', False)
+    sign_source = opts.get('sign_source', False)
 
     try:
-        version = exec_cmd(["dpkg-parsechangelog", "--show-field", "Version"])
+        version = get_changelog_entry(_CHANGELOG_PATH).version
     except Error as err:
         log_err(flags, err)
         raise OpError()
 
     # Check if changelog has the correct version.
-    if not version.startswith(upstream_ver):
+    if upstream_ver is not None and not version.startswith(upstream_ver):
         log(flags, "The upstream version \'{}\'".format(upstream_ver) +
             " does not match the changelog version \'{}\'\n".format(version) +
             ", see gbpx {} to update before building".
             format(Action.UPDATE_CHANGELOG), TextType.ERR)
         raise OpError()
 
-    pkg_build_dir = path.join(_BUILD_DIR, conf[Setting.PACKAGE_NAME], version)
+    pkg_build_dir = path.join(build_dir, conf[Setting.PACKAGE_NAME], version)
     if build_name is not None:
         pkg_build_dir = path.join(pkg_build_dir, build_name)
-    log(flags, "Cleaning old build files in \'" + pkg_build_dir + "\'")
-    clean_dir(flags, pkg_build_dir)
 
     # Check if tag should be created.
     tag_opt = ["--git-tag"] if tag else []
 
+    # A worktree has a detached HEAD.
+    branch_opt = ["--git-ignore-branch"] if in_worktree else []
+
     # Prepare tag signing options.
     if sign_tag:
         if conf[Setting.GPG_KEY_ID] is not None:
@@ -757,36 +1041,47 @@ def _build(conf, flags, build_flags, **opts):
         [conf[Setting.BUILD_CMD], "--no-lintian"] + sign_build_opt +
         ([build_flags] if build_flags is not None else []))
 
+    # Reuse the last build if neither the sources nor the options changed.
+    fingerprint = _get_build_fingerprint(conf, version, upstream_treeish,
+                                         build_cmd, tag_opt)
+    if fingerprint is not None and not flags[Flag.SAFEMODE] and \
+            not flags[Flag.FORCE]:
+        record = get_build_record(pkg_build_dir, fingerprint)
+        if record is not None and (not tag or _is_head_tagged(conf)):
+            log(flags, "The sources are unchanged since the last build in \'" +
+                pkg_build_dir + "\', reusing it (see --force)",
+                TextType.INFO)
+            # The findings are cached for the unchanged files.
+            _start_lintian(flags, pkg_build_dir)
+            log_success(flags)
+            return
+
+    log(flags, "Cleaning old build files in \'" + pkg_build_dir + "\'")
+    clean_dir(flags, pkg_build_dir)
+
+    # Stream command output to the log as it arrives.
+    def log_line(line):
+        log(flags, line)
+
     try:
         if not flags[Flag.SAFEMODE]:
-            exec_cmd(["gbp", "buildpackage"] + tag_opt + upstream_opt +
-                     ["--git-debian-branch=" + conf[Setting.DEBIAN_BRANCH],
-                      "--git-upstream-branch=" + conf[Setting.UPSTREAM_BRANCH],
-                      "--git-export-dir=" + pkg_build_dir, "--git-builder=" +
-                      build_cmd])
-
-            changes_paths = get_files_with_extension(pkg_build_dir,
-                                                     _CHANGES_FILE_EXT)
-            if changes_paths:
-                # Let lintian fail without quitting.
-                try:
-                    log(flags, "Running Lintian...", TextType.INFO)
-                    log(flags, exec_cmd(["lintian", "-Iv", "--color", "auto",
-                                         changes_paths[0]]))
-                    log(flags, "Lintian Done", TextType.INFO)
-                except CommandError as err:
-                    if err.std_err:
-                        # Some other error.
-                        log_err(flags, err)
-                    else:
-                        # Lintian check failed because of bad package.
-                        log(flags, err.std_out.rstrip())
-                        log(flags, "Lintian finished with errors",
-                            TextType.WARNING)
-            else:
-                log(flags, "Changes file (" + _CHANGES_FILE_EXT +
-                    ") not found in \'" + pkg_build_dir +
-                    "\', skipping lintian", TextType.WARNING)
+            with Span("buildpackage"):
+                exec_cmd_streamed(
+                    ["gbp", "buildpackage"] + tag_opt + upstream_opt +
+                    branch_opt +
+                    ["--git-debian-branch=" + conf[Setting.DEBIAN_BRANCH],
+                     "--git-upstream-branch=" +
+                     conf[Setting.UPSTREAM_BRANCH],
+                     "--git-export-dir=" + pkg_build_dir, "--git-builder=" +
+                     build_cmd], log_line)
+            if tag:
+                # The debian tag was created by gbp.
+                invalidate_tag_index()
+
+            if fingerprint is not None:
+                add_build_record(flags, pkg_build_dir, fingerprint)
+
+            _start_lintian(flags, pkg_build_dir)
     except Error as err:
         log_err(flags, err)
         raise OpError()
@@ -795,6 +1090,58 @@ def _build(conf, flags, build_flags, **opts):
     log_success(flags)
 
 
+def _get_build_fingerprint(conf, version, upstream_treeish, build_cmd,
+                           tag_opt):
+    """
+    Identifies a build of the current debian branch files by the
+    debian and upstream trees and the build options.
+    Returns the fingerprint (dict) or None if the sources can not be
+    resolved.
+    """
+    if upstream_treeish is None:
+        # The upstream tree gbp uses by default.
+        upstream_tag = (conf[Setting.UPSTREAM_TAG_TYPE] + "/" +
+                        split_version(version)[1])
+        upstream_treeish = (upstream_tag if upstream_tag in get_tag_index().
+                            get_tags(conf[Setting.UPSTREAM_TAG_TYPE])
+                            else conf[Setting.UPSTREAM_BRANCH])
+    try:
+        return {'version': version,
+                'debian_tree': resolve_rev("HEAD^{tree}"),
+                'upstream_tree': resolve_rev(upstream_treeish + "^{tree}"),
+                'build_cmd': build_cmd, 'tag_opt': tag_opt}
+    except GitError:
+        return None
+
+
+def _is_head_tagged(conf):
+    """
+    Checks if the current debian branch commit has a debian tag.
+    """
+    try:
+        return bool(get_tag_index().get_commit_tags(
+            resolve_rev("HEAD^{commit}"), conf[Setting.DEBIAN_TAG_TYPE]))
+    except GitError:
+        return False
+
+
+def _start_lintian(flags, pkg_build_dir):
+    """
+    Starts lintian on the built package in the background,
+    it is waited for at the end of the execution.
+    """
+    changes_paths = get_files_with_extension(pkg_build_dir, _CHANGES_FILE_EXT)
+    if changes_paths:
+        stage = LintianStage(changes_paths[0],
+                             path.join(_TMP_DIR, _TMP_LINTIAN_CACHE_SUBDIR))
+        stage.start(flags)
+        _background_stages.append(stage)
+    else:
+        log(flags, "Changes file (" + _CHANGES_FILE_EXT +
+            ") not found in \'" + pkg_build_dir +
+            "\', skipping lintian", TextType.WARNING)
+
+
 def _upload_pkg(conf, flags):
     """
     Uploads the latest build to the ppa set in the config file.
@@ -813,17 +1160,16 @@ def _upload_pkg(conf, flags):
     changes_paths = get_files_with_extension(pkg_build_dir,
                                              _SOURCE_CHANGES_FILE_EXT)
 
-    # Filter out test builds and sort the files on version.
-    changes_paths = [s for s in changes_paths if
-                     path.basename(path.dirname(s)) == _BUILD_NAME]
-    changes_paths.sort(
-        key=lambda s: findall(r'''\d+''', path.basename(s).split('_')[1]),
-        reverse=True)
+    # Filter out test builds and find the latest version.
+    changes_paths = get_latest_by_version(
+        [s for s in changes_paths if
+         path.basename(path.dirname(s)) == _BUILD_NAME],
+        get_file_version_str)
     if changes_paths:
         # Ask user for confirmation
         if not prompt_user_yn(
                 "Upload the latest build (version \'{0}\')?".format(
-                    path.basename(changes_paths[0]).split('_')[1])):
+                    get_file_version_str(changes_paths[0]))):
             raise OpError()
         try:
             if not flags[Flag.SAFEMODE]:
@@ -11,6 +11,7 @@ class Flag(Enum):
     QUIET = 'quiet'
     COLOR = 'color'
     SAFEMODE = 'safemode'
+    FORCE = 'force'
 
 
 class Option(Enum):
@@ -23,6 +24,10 @@ class Option(Enum):
     SHOW_FLAGS = 'show-flags'
     SHOW_OPTIONS = 'show-options'
     SHOW_ACTIONS = 'show-actions'
+    PROFILE = 'profile'
+    PROFILE_COUNT = 'profile-count'
+    PROFILE_JSON = 'profile-json'
+    TRACE = 'trace'
 
 
 class Action(Enum):
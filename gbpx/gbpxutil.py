@@ -5,18 +5,33 @@ Contains various io functions for git and packaging.
 from configparser import ConfigParser
 from datetime import datetime
 from enum import Enum
-from os import path, getcwd
+from fcntl import flock, LOCK_EX, LOCK_NB
+from hashlib import md5, sha1, sha256
+from json import dump, dumps, load
+from os import path, getcwd, chdir, listdir, utime, remove, replace, \
+    getpid, makedirs, stat
+from shutil import copyfile
+from tarfile import open as open_tar, PAX_FORMAT, TarInfo, DIRTYPE
+from threading import Thread
 from time import strftime
-from re import findall, match
+from re import match, escape, compile as re_compile, DOTALL
 
+from changelogutil import ChangelogGenerator
 from gbpxargs import Flag
 from gitutil import get_head_tags, get_head_tag_version_str, tag_head, \
     get_branch, get_head_commit, is_working_dir_clean, stash_changes, \
     apply_stash, commit_changes, switch_branch, reset_branch, check_git_rep, \
-    GitError
+    GitError, commit_snapshot, delete_ref, get_session, find_git_dirs, \
+    add_worktree, update_worktree, remove_worktree, prune_worktrees, \
+    RefTransaction
 
 from ioutil import Error, log, TextType, prompt_user_input, mkdirs, \
-    exec_cmd, get_files_with_extension, prompt_user_options, clean_dir
+    exec_cmd, get_files_with_extension, prompt_user_options, clean_dir, \
+    remove_dir, exec_pipeline, Compression, get_compressor, \
+    get_compression_ext, get_compression_exts, get_cpu_count, \
+    exec_cmd_streamed, CommandError, log_err, Span
+from versionutil import compare_versions, sort_by_version, \
+    get_latest_by_version, get_file_version_str
 
 
 ############################### Errors ##################################
@@ -100,10 +115,14 @@ class Setting(Enum):
     URGENCY = 'urgency'
     DEBIAN_VERSION_SUFFIX = 'debianVersionSuffix'
     EXCLUDE_FILES = 'excludeFiles'
+    CHANGELOG_GENERATOR = 'changelogGenerator'
 
     PPA_NAME = 'ppa'
 
     EDITOR_CMD = 'editorCommand'
+    USE_WORKTREES = 'useWorktrees'
+    COMPRESSION = 'compression'
+    COMPRESSION_THREADS = 'compressionThreads'
 
 
 class _Section(Enum):
@@ -115,6 +134,51 @@ class _Section(Enum):
     SYSTEM = 'SYSTEM'
 
 
+def _to_bool(value):
+    """ Converts a config string to a boolean. """
+    return str(value).strip().lower() in ("1", "yes", "true", "on")
+
+
+def _to_int(value):
+    """
+    Converts a config string to an integer, None if empty.
+    Errors will be raised as ConfigError.
+    """
+    try:
+        return int(value) if str(value).strip() else None
+    except ValueError:
+        raise ConfigError("The value \'{}\' is not a number".format(value))
+
+
+def _to_compression(value):
+    """
+    Converts a config string to a compression method, None if empty.
+    Errors will be raised as ConfigError.
+    """
+    try:
+        return Compression(str(value).strip()) if str(value).strip() \
+            else None
+    except ValueError:
+        raise ConfigError("Unknown compression \'{0}\', use one of: {1}".
+                          format(value, ", ".join(c.value for c in
+                                                  Compression)))
+
+
+def _to_changelog_generator(value):
+    """
+    Converts a config string to a changelog generator, None if empty.
+    Errors will be raised as ConfigError.
+    """
+    try:
+        return ChangelogGenerator(str(value).strip()) if str(value).strip() \
+            else None
+    except ValueError:
+        raise ConfigError("Unknown changelog generator \'{0}\', use one "
+                          "of: {1}".format(value,
+                                           ", ".join(g.value for g in
+                                                     ChangelogGenerator)))
+
+
 class _BaseSetting(object):
     def __init__(self, default, section, required, convert):
         """
@@ -158,10 +222,19 @@ _CONFIG = {
     Setting.EXCLUDE_FILES: _BaseSetting(
         DEFAULT_CONFIG_PATH + ",README.md,LICENSE", _Section.PACKAGE, False,
         lambda s: [se.strip() for se in str(s).split(_DEL_EXCLUDE)]),
+    Setting.CHANGELOG_GENERATOR: _BaseSetting(ChangelogGenerator.GBP,
+                                              _Section.PACKAGE, False,
+                                              _to_changelog_generator),
 
     Setting.PPA_NAME: _BaseSetting(None, _Section.UPLOAD, False, str),
 
-    Setting.EDITOR_CMD: _BaseSetting("editor", _Section.SYSTEM, True, str)
+    Setting.EDITOR_CMD: _BaseSetting("editor", _Section.SYSTEM, True, str),
+    Setting.USE_WORKTREES: _BaseSetting(False, _Section.SYSTEM, False,
+                                        _to_bool),
+    Setting.COMPRESSION: _BaseSetting(Compression.GZIP, _Section.SYSTEM,
+                                      False, _to_compression),
+    Setting.COMPRESSION_THREADS: _BaseSetting(None, _Section.SYSTEM, False,
+                                              _to_int)
 }
 
 
@@ -187,6 +260,8 @@ def create_ex_config(flags, config_path, preset_keys=None):
                     val = preset_keys[key]
                 else:
                     val = setting.default
+                if isinstance(val, Enum):
+                    val = val.value
                 config[setting.section.value][key.value] = str(
                     val) if val is not None else ""
 
@@ -269,18 +344,6 @@ def is_version_gt(ver1, ver2):
     return compare_versions(ver1, ver2) > 0
 
 
-def compare_versions(ver1, ver2):
-    """ Compares two versions. """
-    ver_s = [ver1, ver2]
-    ver_s.sort(key=lambda s: findall(r'''\d+''', s))
-    if ver1 == ver2:
-        return 0
-    elif ver_s[0] == ver1:
-        return -1
-    else:
-        return 1
-
-
 def get_next_upstream_version(version_str):
     """
     Produces the next logical upstream version
@@ -312,6 +375,697 @@ def get_next_package_build_version(version_str):
     return version_str
 
 
+###################### Source Tarball Utilities #########################
+#########################################################################
+### This section defines functions for creating source tarballs.
+#########################################################################
+
+# Version control files left out of source tarballs, as 'tar --exclude-vcs'.
+_VCS_EXCLUDES = ["CVS", ".cvsignore", "RCS", "SCCS", ".git", ".gitignore",
+                 ".gitattributes", ".gitmodules", ".arch-ids", "{arch}",
+                 "=RELEASE-ID", "=meta-update", "=update", ".bzr",
+                 ".bzrignore", ".bzrtags", ".hg", ".hgignore", ".hgtags",
+                 "_darcs"]
+
+# Size of the chunks copied between streams.
+_COPY_BUFFER_SIZE = 65536
+
+# Version of the cached tarball format, changed to invalidate the cache.
+_ORIG_CACHE_FORMAT = 2
+_ORIG_CACHE_SUMS_EXT = ".json"
+_ORIG_CACHE_MAX_SIZE = 2 * 1024 ** 3
+
+
+def _translate_glob(pattern):
+    """
+    Translates a gitignore glob to a regular expression,
+    '**' matches any number of directories and '*' does not match '/'.
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == '/'):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        elif pattern.startswith("**", i) and i + 2 == len(pattern) and \
+                (i == 0 or pattern[i - 1] == '/'):
+            regex += ".*"
+            i += 2
+            continue
+        elif char == '*':
+            regex += "[^/]*"
+        elif char == '?':
+            regex += "[^/]"
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                regex += escape(char)
+            else:
+                char_class = pattern[i + 1:end].replace('\\', '\\\\')
+                if char_class[0] in '!^':
+                    char_class = '^' + char_class[1:]
+                regex += '[' + char_class + ']'
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += escape(pattern[i])
+        else:
+            regex += escape(char)
+        i += 1
+    return regex
+
+
+class _PatternSet(object):
+    """
+    Compiled patterns of one kind, finding the last (highest index)
+    pattern matching a path. Literal names are kept in a dict, literal
+    paths in a prefix trie and all glob patterns in one regex.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._trie = {}
+        self._globs = []
+        self._regex = None
+        self._group_indexes = []
+
+    def add(self, index, pattern, anchored):
+        """ Adds a pattern (without any leading '/' or trailing '/'). """
+        if not any(c in pattern for c in '*?[\\'):
+            if not anchored:
+                self._names[pattern] = index
+            else:
+                node = self._trie
+                for part in pattern.split('/'):
+                    node = node.setdefault(part, {})
+                node[None] = index
+        else:
+            regex = _translate_glob(pattern)
+            self._globs.append((index, regex if anchored
+                                else "(?:.*/)?" + regex))
+
+    def compile(self):
+        """ Compiles the glob patterns, later patterns first. """
+        if self._globs:
+            self._globs.sort(reverse=True)
+            self._group_indexes = [index for index, _ in self._globs]
+            self._regex = re_compile("|".join(
+                ["(" + regex + ")" for _, regex in self._globs]), DOTALL)
+
+    def get_last_match(self, file_path):
+        """
+        Returns the index of the last pattern matching the path,
+        -1 if no pattern matches.
+        """
+        last = self._names.get(file_path.rsplit('/', 1)[-1], -1)
+        node = self._trie
+        for part in file_path.split('/'):
+            node = node.get(part)
+            if node is None:
+                break
+        else:
+            last = max(last, node.get(None, -1))
+        if self._regex is not None:
+            match_ = self._regex.fullmatch(file_path)
+            if match_ is not None:
+                # The first matching alternative is the last pattern.
+                last = max(last, self._group_indexes[match_.lastindex - 1])
+        return last
+
+
+class ExcludeMatcher(object):
+    """
+    Matches paths against exclude patterns with the semantics of
+    .gitignore files: a pattern containing a '/' (other than a trailing
+    one) is relative to the top directory, otherwise it matches names at
+    any depth. A trailing '/' only matches directories, '!' includes
+    matching paths again and the last matching pattern decides.
+    Excluding a directory excludes all of its contents.
+    """
+
+    def __init__(self, patterns=None, exclude_vcs=False):
+        """
+            :param patterns: the exclude patterns
+            :type patterns: list
+            :param exclude_vcs: set to True to exclude version control files
+            :type exclude_vcs: bool
+        """
+        self._patterns = []
+        self._sets = None
+        self._dir_cache = {}
+        if exclude_vcs:
+            self.add_patterns(_VCS_EXCLUDES)
+        if patterns is not None:
+            self.add_patterns(patterns)
+
+    def add_patterns(self, patterns):
+        """
+        Adds exclude patterns, e.g. the lines of a .gitignore file.
+        Empty lines and comments are skipped.
+        """
+        for pattern in patterns:
+            if pattern.endswith('\n'):
+                pattern = pattern[:-1]
+            # Trailing spaces are ignored unless escaped.
+            stripped = pattern.rstrip(' ')
+            if stripped.endswith('\\') and len(stripped) < len(pattern):
+                stripped += ' '
+            if stripped and not stripped.startswith('#'):
+                self._patterns.append(stripped)
+        self._sets = None
+        self._dir_cache = {}
+
+    def get_patterns(self):
+        """ Returns the list of patterns in the order they were added. """
+        return list(self._patterns)
+
+    def _compile(self):
+        """ Compiles the patterns into pattern sets by kind. """
+        # Sets by (negated, directories only).
+        self._sets = dict([((negated, dir_only), _PatternSet())
+                           for negated in (False, True)
+                           for dir_only in (False, True)])
+        for index, pattern in enumerate(self._patterns):
+            negated = pattern.startswith('!')
+            if negated or pattern.startswith('\\!') or \
+                    pattern.startswith('\\#'):
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+            if pattern:
+                self._sets[(negated, dir_only)].add(index, pattern, anchored)
+            if pattern.endswith("/**") and len(pattern) > 3:
+                # Like git, 'dir/**' matches the directory itself too.
+                self._sets[(negated, True)].add(index, pattern[:-3], True)
+        for pattern_set in self._sets.values():
+            pattern_set.compile()
+
+    def _is_matched(self, file_path, is_dir):
+        """ Checks if the path itself is excluded by the last pattern. """
+        excluded = self._sets[(False, False)].get_last_match(file_path)
+        included = self._sets[(True, False)].get_last_match(file_path)
+        if is_dir:
+            excluded = max(excluded,
+                           self._sets[(False, True)].get_last_match(file_path))
+            included = max(included,
+                           self._sets[(True, True)].get_last_match(file_path))
+        return excluded > included
+
+    def _is_dir_excluded(self, dir_path):
+        """ Checks if a directory is excluded, caching the results. """
+        excluded = self._dir_cache.get(dir_path)
+        if excluded is None:
+            parent = dir_path.rpartition('/')[0]
+            excluded = (bool(parent) and self._is_dir_excluded(parent)) or \
+                self._is_matched(dir_path, True)
+            self._dir_cache[dir_path] = excluded
+        return excluded
+
+    def is_excluded(self, file_path, is_dir=False):
+        """
+        Checks if a path is excluded.
+            :param file_path: the path relative to the top directory
+            :type file_path: str
+            :param is_dir: if the path is a directory
+            :type is_dir: bool
+            :rtype: bool
+        """
+        if self._sets is None:
+            self._compile()
+        file_path = file_path.strip('/')
+        if is_dir:
+            return self._is_dir_excluded(file_path)
+        parent = file_path.rpartition('/')[0]
+        return (bool(parent) and self._is_dir_excluded(parent)) or \
+            self._is_matched(file_path, False)
+
+    def to_pathspecs(self):
+        """
+        Converts the patterns to git pathspec excludes, so that excluded
+        files are never read by e.g. 'git archive'.
+        Patterns including paths again cannot be expressed as pathspecs.
+        Returns the list of pathspecs or None if not possible.
+        """
+        pathspecs = []
+        for pattern in self._patterns:
+            if pattern.startswith('!'):
+                return None
+            if pattern.startswith('\\!') or pattern.startswith('\\#'):
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if '/' not in pattern:
+                pattern = "**/" + pattern
+            pattern = pattern.lstrip('/')
+            if not dir_only:
+                pathspecs.append(":(exclude,glob)" + pattern)
+            pathspecs.append(":(exclude,glob)" + pattern + "/**")
+        return pathspecs
+
+
+def get_tar_filter(matcher, prefix="", mtime=None):
+    """
+    Creates a pipeline filter stage (see ioutil.exec_pipeline) copying a
+    tar stream without the excluded members.
+    The members are owned by root and the output only depends on the input
+    members (and mtime), so that equal input gives an identical tarball.
+    - matcher       -- The ExcludeMatcher of the excluded files.
+    - prefix        -- The directory prefix to add to all member names.
+    - mtime         -- The modification time to set on all members,
+                       None to keep the times of the input.
+    Returns the filter function.
+    """
+
+    def filter_tar(in_file, out_file):
+        """ Copies the tar stream without the excluded members. """
+        with open_tar(fileobj=in_file, mode='r|') as src_tar, \
+                open_tar(fileobj=out_file, mode='w|',
+                         format=PAX_FORMAT) as dst_tar:
+            prefix_added = False
+            for member in src_tar:
+                if prefix and not prefix_added:
+                    # Archive members all have the commit time.
+                    dst_tar.addfile(_get_prefix_dir_member(
+                        prefix, mtime if mtime is not None else member.mtime))
+                    prefix_added = True
+                if matcher.is_excluded(member.name, member.isdir()):
+                    continue
+                # Drop the input extended headers (e.g. the path),
+                # the needed ones are recreated from the member.
+                member.pax_headers = {}
+                member.name = prefix + member.name
+                if member.islnk():
+                    member.linkname = prefix + member.linkname
+                _set_member_owner(member)
+                if mtime is not None:
+                    member.mtime = mtime
+                dst_tar.addfile(member, src_tar.extractfile(member)
+                                if member.isfile() else None)
+
+    return filter_tar
+
+
+def _set_member_owner(member):
+    """ Sets root as the owner of a tar member. """
+    member.uid = member.gid = 0
+    member.uname = member.gname = "root"
+
+
+def _get_prefix_dir_member(prefix, mtime):
+    """ Creates the tar member of the top directory of a prefix. """
+    member = TarInfo(prefix.rstrip('/'))
+    member.type = DIRTYPE
+    member.mode = 0o775
+    member.mtime = mtime
+    _set_member_owner(member)
+    return member
+
+
+class ChecksumWriter(object):
+    """
+    Wraps a binary file, computing the size and checksums (md5, sha1 and
+    sha256, as used in Debian source control files) of all written data.
+    """
+
+    def __init__(self, file_):
+        self.file = file_
+        self.size = 0
+        self._hashes = [('md5', md5()), ('sha1', sha1()),
+                        ('sha256', sha256())]
+
+    def write(self, data):
+        """ Writes the data to the file and adds it to the checksums. """
+        self.file.write(data)
+        self.size += len(data)
+        for _, hash_ in self._hashes:
+            hash_.update(data)
+
+    def get_checksums(self):
+        """ Returns the dict of the hex checksums by algorithm name. """
+        return dict([(name, hash_.hexdigest())
+                     for name, hash_ in self._hashes])
+
+
+def create_orig_tarball(treeish, tar_path, prefix, matcher,
+                        compression=Compression.GZIP, threads=None,
+                        mtime=None):
+    """
+    Creates an upstream tarball from a git treeish in a single streaming
+    pass: the archive is filtered from excluded files, gets the prefix
+    and is compressed and checksummed on its way into the tarball file.
+    Errors will be raised as CommandError.
+    - treeish   -- The treeish (e.g. the release branch) to archive.
+    - tar_path  -- The path of the tarball to write.
+    - prefix    -- The directory to put the files in (e.g. <pkg>-<ver>/).
+    - matcher   -- The ExcludeMatcher of the excluded files.
+    - compression   -- The compression method.
+    - threads       -- The number of compression threads (None for all CPUs).
+    - mtime         -- The modification time of all files (see get_tar_filter).
+    Returns a tuple of the tarball size and checksums (see ChecksumWriter).
+    """
+    writers = []
+
+    def write_checksummed(in_file, out_file):
+        """ Writes the compressed stream while computing the checksums. """
+        writer = ChecksumWriter(out_file)
+        writers.append(writer)
+        for data in iter(lambda: in_file.read(_COPY_BUFFER_SIZE), b""):
+            writer.write(data)
+
+    # Excluded directories are not even read if the exclusions can be
+    # passed to git, the filter is still needed for the exact semantics.
+    pathspecs = matcher.to_pathspecs()
+    exec_pipeline([["git", "archive", "--format=tar", treeish] +
+                   (["--"] + pathspecs if pathspecs else []),
+                   get_tar_filter(matcher, prefix, mtime=mtime),
+                   get_compressor(compression, threads),
+                   write_checksummed], out_path=tar_path)
+    return writers[0].size, writers[0].get_checksums()
+
+
+def _get_orig_cache_key(tree, mtime, matcher, package, version, compression,
+                        threads):
+    """
+    Computes the cache key of an upstream tarball from everything that
+    affects its content.
+    """
+    key = [_ORIG_CACHE_FORMAT, tree, mtime, matcher.get_patterns(), package,
+           version, compression.value]
+    # Only multi-threaded xz output depends on the thread count.
+    if compression == Compression.XZ:
+        key.append(threads if threads is not None else get_cpu_count())
+    return sha256(dumps(key).encode("utf-8")).hexdigest()
+
+
+def _remove_orig_cache_entry(cache_dir, key):
+    """
+    Removes the files of a cached tarball, files already removed (e.g. by
+    another process) are skipped. Temporary files being written by other
+    processes are left alone.
+    """
+    for name in [key + ".tar" + ext for ext in get_compression_exts()] + \
+            [key + _ORIG_CACHE_SUMS_EXT]:
+        try:
+            remove(path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+
+def _evict_orig_cache(cache_dir, keep_key):
+    """
+    Removes the least recently used cached tarballs until the cache is
+    within its maximum size, the given entry is always kept.
+    """
+    entries = []
+    for name in listdir(cache_dir):
+        if name.endswith(_ORIG_CACHE_SUMS_EXT):
+            key = name[:-len(_ORIG_CACHE_SUMS_EXT)]
+            file_path = path.join(cache_dir, name)
+            try:
+                with open(file_path) as sums_file:
+                    entries.append((path.getmtime(file_path), key,
+                                    load(sums_file)['size']))
+            except (IOError, OSError, ValueError, KeyError):
+                # Removed or being written by another process.
+                pass
+    total_size = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total_size <= _ORIG_CACHE_MAX_SIZE:
+            break
+        if key != keep_key:
+            _remove_orig_cache_entry(cache_dir, key)
+            total_size -= size
+
+
+def get_orig_tarball(cache_dir, rev, tar_path, package, version, matcher,
+                     compression=Compression.GZIP, threads=None):
+    """
+    Creates an upstream tarball with the files of a revision in the
+    <package>-<version> directory, reusing a previously created one from
+    the cache directory if nothing affecting its content has changed.
+    All files get the commit time so that the tarballs are reproducible.
+    The tarball is a copy, so it can be changed without affecting the cache.
+    Errors will be raised as CommandError or as OpError (file errors).
+    - cache_dir     -- The directory of the cached tarballs.
+    - rev           -- The revision (e.g. the release branch) to archive.
+    - tar_path      -- The path of the tarball to write.
+    - package       -- The package name.
+    - version       -- The upstream version.
+    - matcher       -- The ExcludeMatcher of the excluded files.
+    - compression   -- The compression method.
+    - threads       -- The number of compression threads (None for all CPUs).
+    Returns a tuple of the tarball size, checksums (see ChecksumWriter)
+    and if it was found in the cache.
+    """
+    commit, tree, mtime = exec_cmd(["git", "show", "-s", "--format=%H %T %ct",
+                                    rev]).split()
+    key = _get_orig_cache_key(tree, int(mtime), matcher, package, version,
+                              compression, threads)
+    cache_path = path.join(cache_dir, key + ".tar" +
+                           get_compression_ext(compression))
+    sums_path = path.join(cache_dir, key + _ORIG_CACHE_SUMS_EXT)
+
+    try:
+        with open(sums_path) as sums_file:
+            sums = load(sums_file)
+        cached = path.getsize(cache_path) == sums['size']
+    except (IOError, OSError, ValueError, KeyError):
+        cached = False
+
+    tmp_path = "{0}.{1}.tmp".format(cache_path, getpid())
+    try:
+        if not cached:
+            makedirs(cache_dir, exist_ok=True)
+            try:
+                size, checksums = create_orig_tarball(
+                    commit, tmp_path, package + "-" + version + "/", matcher,
+                    compression, threads, int(mtime))
+                replace(tmp_path, cache_path)
+                sums = dict(checksums, size=size)
+                with open(tmp_path, 'w') as sums_file:
+                    dump(sums, sums_file)
+                replace(tmp_path, sums_path)
+            finally:
+                if path.exists(tmp_path):
+                    remove(tmp_path)
+
+        # Mark as recently used and keep the cache within its size.
+        utime(sums_path)
+        _evict_orig_cache(cache_dir, key)
+
+        # Copied, a link would let changes to the tarball reach the cache.
+        # An old tarball is removed first, it may be linked to the cache.
+        if path.lexists(tar_path):
+            remove(tar_path)
+        copyfile(cache_path, tar_path)
+    except (IOError, OSError) as err:
+        raise OpError(msg="The upstream tarball \'" + tar_path +
+                      "\' could not be created: " + str(err))
+
+    size = sums.pop('size')
+    return size, sums, cached
+
+
+######################## Build Record Utilities #########################
+#########################################################################
+### This section defines functions for recording builds, so that builds
+### of unchanged sources can be reused.
+#########################################################################
+
+_BUILD_RECORD_FILE = ".gbpx-build.json"
+
+
+def _get_build_artifacts(build_dir):
+    """
+    Returns the files in a build directory,
+    by name with their size and modification time.
+    """
+    artifacts = {}
+    for name in listdir(build_dir):
+        file_path = path.join(build_dir, name)
+        if name != _BUILD_RECORD_FILE and path.isfile(file_path):
+            file_stat = stat(file_path)
+            artifacts[name] = [file_stat.st_size, file_stat.st_mtime_ns]
+    return artifacts
+
+
+def get_build_record(build_dir, fingerprint):
+    """
+    Retrieves the record of the last build in a build directory, if it
+    was made with the given fingerprint and its files are unchanged.
+    - build_dir     -- The build directory.
+    - fingerprint   -- Dict identifying the build (sources and options).
+    Returns the record or None if the build must be made.
+    """
+    try:
+        with open(path.join(build_dir, _BUILD_RECORD_FILE)) as record_file:
+            record = load(record_file)
+        if record.get('fingerprint') == fingerprint and \
+                record.get('artifacts') == _get_build_artifacts(build_dir):
+            return record
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def add_build_record(flags, build_dir, fingerprint, **results):
+    """
+    Records a successful build in its build directory with the
+    fingerprint, the built files and the given results.
+    Errors will be raised as OpError.
+    - build_dir     -- The build directory.
+    - fingerprint   -- Dict identifying the build (sources and options).
+    - results       -- Other JSON serializable results, e.g. of lintian.
+    """
+    if flags[Flag.SAFEMODE]:
+        return
+    record = dict(results, fingerprint=fingerprint,
+                  artifacts=_get_build_artifacts(build_dir))
+    record_path = path.join(build_dir, _BUILD_RECORD_FILE)
+    try:
+        with open(record_path + ".tmp", 'w') as record_file:
+            dump(record, record_file)
+        replace(record_path + ".tmp", record_path)
+    except (IOError, OSError) as err:
+        raise OpError(msg="The build record could not be written: " +
+                      str(err))
+
+
+########################## Lintian Utilities ############################
+#########################################################################
+### This section defines functions for running lintian in the background
+### with its findings cached per checked .changes file.
+#########################################################################
+
+_LINTIAN_CACHE_EXT = ".json"
+_HASH_BLOCK_SIZE = 1 << 16
+
+
+def _get_lintian_cache_key(changes_path, lintian_ver):
+    """
+    Returns the cache key of the lintian findings for a .changes file,
+    the sha256 of the file (which lists the checksums of all the built
+    files) and the lintian version.
+    """
+    hasher = sha256()
+    with open(changes_path, 'rb') as changes_file:
+        for block in iter(lambda: changes_file.read(_HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    hasher.update(b"\0" + lintian_ver.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class LintianStage(object):
+    """
+    Runs lintian on a .changes file in a background thread, so that it
+    overlaps with the rest of the action. The findings are buffered and
+    logged when waiting for the check, so they are not mixed with the
+    output of the action, and cached: a check of identical files with the
+    same lintian version reports the cached findings instead.
+    The commands of the check are attached to its own "lintian" span.
+    """
+
+    def __init__(self, changes_path, cache_dir):
+        """
+            :param changes_path: the path of the .changes file to check
+            :type changes_path: str
+            :param cache_dir: the directory of the cached findings
+            :type cache_dir: str
+        """
+        self.changes_path = path.abspath(changes_path)
+        self.cache_dir = path.abspath(cache_dir)
+        self.result = None
+        self._error = None
+        self._thread = None
+
+    def start(self, flags):
+        """ Starts the check in the background. """
+        log(flags, "Running Lintian in the background, the findings are "
+                   "shown when the action is done", TextType.INFO)
+        self._thread = Thread(target=self._run, args=(flags,))
+        self._thread.start()
+
+    def _run(self, flags):
+        """
+        Checks the package, or reads the cached findings.
+        Any error is kept to be reported by wait().
+        """
+        try:
+            with Span("lintian"):
+                self._check(flags)
+        except Exception as err:
+            self._error = err
+
+    def _check(self, flags):
+        """ Checks the package, the findings are kept in the result. """
+        lintian_ver = exec_cmd(["lintian", "--version"])
+        cache_path = path.join(self.cache_dir, _get_lintian_cache_key(
+            self.changes_path, lintian_ver) + _LINTIAN_CACHE_EXT)
+        try:
+            with open(cache_path) as cache_file:
+                result = load(cache_file)
+            self.result = {'lines': list(result['lines']),
+                           'failed': bool(result['failed'])}
+            return
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.result = None
+
+        lines = []
+        try:
+            exec_cmd_streamed(["lintian", "-Iv", "--color", "auto",
+                               self.changes_path], lines.append)
+            failed = False
+        except CommandError as err:
+            if err.std_err:
+                # Some other error, the findings are not cached.
+                raise
+            # Lintian check failed because of bad package.
+            failed = True
+        self.result = {'lines': lines, 'failed': failed}
+        if not flags[Flag.SAFEMODE]:
+            makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = "{0}.{1}.tmp".format(cache_path, getpid())
+            with open(tmp_path, 'w') as cache_file:
+                dump(self.result, cache_file)
+            replace(tmp_path, cache_path)
+
+    def wait(self, flags):
+        """
+        Waits for the check to finish and logs the findings and outcome.
+        Errors which are not an Error, IOError or OSError are raised
+        again after the findings are logged.
+        Returns the findings (dict with the 'lines' and if lintian
+        'failed'), or None if lintian could not be run.
+        """
+        if self._thread is None:
+            return None
+        self._thread.join()
+        self._thread = None
+        if self.result is not None:
+            for line in self.result['lines']:
+                log(flags, line)
+        error, self._error = self._error, None
+        if isinstance(error, Error):
+            log_err(flags, error)
+        elif isinstance(error, (IOError, OSError)):
+            log(flags, "The lintian findings could not be cached: " +
+                str(error), TextType.WARNING)
+        elif error is not None:
+            raise error
+        if self.result is not None:
+            if self.result['failed']:
+                log(flags, "Lintian finished with errors", TextType.WARNING)
+            else:
+                log(flags, "Lintian Done", TextType.INFO)
+        return self.result
+
+
 ####################### Combined Operations ############################
 #########################################################################
 ### This section defines functions combining IO/UI with Git operations.
@@ -321,14 +1075,17 @@ def get_next_package_build_version(version_str):
 ### After the reset is attempted, functions terminates with an OpError.
 #########################################################################
 
-_BAK_FILE_EXT = ".bak.tar.gz"
+_BAK_FILE_EXT = ".bak.tar"
 _BAK_FILE_DATE_FORMAT = "%Y-%m-%d-%H-%M-%S"
 _BAK_DISPLAY_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 _TAB_WIDTH = 8
 
+_SNAPSHOT_REF = "refs/gbpx/temp-commit"
 
-def verify_create_head_tag(flags, branch, tag_type, version_str=None):
+
+def verify_create_head_tag(flags, branch, tag_type, version_str=None,
+                           transaction=None):
     """
     Verifies or creates a version tag for a branch HEAD.
     If tag needs to be created and no version is given,
@@ -336,6 +1093,8 @@ def verify_create_head_tag(flags, branch, tag_type, version_str=None):
     - branch        -- The branch to tag.
     - tag_type      -- The tag type (<tag_type>/<version>).
     - version_str   -- The version string to use.
+    - transaction   -- The ref transaction to queue the tag in,
+                       the tag is created at once if not set.
     Returns the a tuple with version created or found
     and True if created otherwise False. (<version>, <created>)
     """
@@ -364,19 +1123,21 @@ def verify_create_head_tag(flags, branch, tag_type, version_str=None):
             if not flags[Flag.SAFEMODE]:
                 log(flags, "Tagging HEAD commit on branch \'" + branch +
                     "\' as \'" + tag + "\'")
-                tag_head(flags, branch, tag)
+                tag_head(flags, branch, tag, transaction)
             return version_str, tag, True
     except Error as err:
         raise OpError(err)
 
 
-def create_temp_commit(flags):
+def create_temp_commit(flags, snapshot=True):
     """
     Commits any uncommitted changes on the current
     branch to a temporary commit.
-    - branch    -- The branch to tag.
+    - snapshot  -- Set to True to commit the changes without touching
+                   the working directory (temporary index and private ref),
+                   set to False to stash, apply and commit them.
     Returns the a tuple with the branch name, commit id and
-    stash name, used to restore the initial state with the
+    stash name (or snapshot ref), used to restore the initial state with the
     'restore_temp_commit' function.
     If no changes can be committed the stash name is set to 'None'.
     """
@@ -390,17 +1151,28 @@ def create_temp_commit(flags):
 
         # Check for uncommitted changes.
         if not is_working_dir_clean():
-            log(flags, "Stashing uncommitted changes on branch \'{0}\'".
-                format(current_branch))
-            # Save changes to tmp stash.
-            stash_name = "gbpx<{0}>".format(head_commit)
-            stash_changes(flags, stash_name)
-
-            # Apply stash and create a temporary commit.
-            log(flags, "Creating temporary commit on branch \'{0}\'".
-                format(current_branch))
-            apply_stash(flags, current_branch, drop=False)
-            commit_changes(flags, "Temp \'{0}\' commit.".format(current_branch))
+            if snapshot:
+                # Commit the files as they are, nothing is rewritten.
+                log(flags, "Creating temporary snapshot commit on branch " +
+                    "\'{0}\'".format(current_branch))
+                commit_snapshot(flags, _SNAPSHOT_REF,
+                                "Temp \'{0}\' commit.".format(current_branch))
+                # No snapshot is committed in safe mode.
+                stash_name = (_SNAPSHOT_REF if not flags[Flag.SAFEMODE]
+                              else None)
+            else:
+                log(flags, "Stashing uncommitted changes on branch \'{0}\'".
+                    format(current_branch))
+                # Save changes to tmp stash.
+                stash_name = "gbpx<{0}>".format(head_commit)
+                stash_changes(flags, stash_name)
+
+                # Apply stash and create a temporary commit.
+                log(flags, "Creating temporary commit on branch \'{0}\'".
+                    format(current_branch))
+                apply_stash(flags, current_branch, drop=False)
+                commit_changes(flags,
+                               "Temp \'{0}\' commit.".format(current_branch))
         else:
             stash_name = None
             log(flags, "Working directory clean, no commit needed")
@@ -417,14 +1189,23 @@ def restore_temp_commit(flags, restore_data):
                         'create_temp_commit' function.
     """
     try:
-        # Restore branch.
+        # Restore branch, only the files that differ are checked out.
         if restore_data[0] != get_branch():
             log(flags, "Switching active branch to \'" + restore_data[0] +
                 "\'")
             switch_branch(restore_data[0])
 
+        # Check if a snapshot commit was created.
+        if restore_data[2] == _SNAPSHOT_REF:
+            log(flags, "Resetting branch \'" +
+                restore_data[0] + "\' to commit \'" +
+                restore_data[1] + "\', keeping uncommitted changes")
+            reset_branch(flags, restore_data[0], restore_data[1],
+                         keep_files=True)
+            delete_ref(flags, _SNAPSHOT_REF)
+
         # Check if changes have been stashed (and temporary commit created).
-        if restore_data[2] is not None:
+        elif restore_data[2] is not None:
             log(flags, "Resetting branch \'" +
                 restore_data[0] + "\'to commit \'" +
                 restore_data[1] + "\'")
@@ -437,11 +1218,193 @@ def restore_temp_commit(flags, restore_data):
         raise OpError(err)
 
 
-def add_backup(flags, bak_dir, name="unknown"):
+_MAX_WORKTREES = 6
+_WORKTREE_LOCK_EXT = ".lock"
+
+# Lock files of the worktrees used by this process.
+_worktree_locks = {}
+
+
+def _lock_worktree(wt_path):
+    """
+    Tries to lock a worktree slot for this process, the lock is held
+    until the process exits.
+    Returns True if locked, False if used by another process.
+    """
+    if wt_path in _worktree_locks:
+        return True
+    lock_file = open(wt_path + _WORKTREE_LOCK_EXT, "a")
+    try:
+        flock(lock_file, LOCK_EX | LOCK_NB)
+    except (IOError, OSError):
+        lock_file.close()
+        return False
+    _worktree_locks[wt_path] = lock_file
+    return True
+
+
+def _get_worktree_common_dir(wt_path):
+    """
+    Returns the common git dir of the repository a worktree slot belongs
+    to, or None if the slot holds no valid worktree.
+    """
+    if not path.exists(path.join(wt_path, ".git")):
+        return None
+    git_dirs = find_git_dirs(wt_path)
+    return git_dirs[1] if git_dirs is not None else None
+
+
+def _evict_worktrees(flags, wt_dir, common_dir):
+    """
+    Removes the least recently used worktrees of the repository (given
+    common git dir) above the maximum count, worktrees locked by any
+    process and slots of other repositories are kept.
+    """
+    wt_paths = [path.join(wt_dir, name) for name in listdir(wt_dir)
+                if path.isdir(path.join(wt_dir, name)) and
+                _get_worktree_common_dir(path.join(wt_dir, name)) ==
+                common_dir]
+    wt_paths.sort(key=path.getmtime, reverse=True)
+    for wt_path in wt_paths[_MAX_WORKTREES:]:
+        if wt_path not in _worktree_locks and _lock_worktree(wt_path):
+            log(flags, "Removing unused worktree \'" + wt_path + "\'")
+            try:
+                remove_worktree(flags, wt_path)
+            except GitError:
+                remove_dir(flags, wt_path)
+            if not flags[Flag.SAFEMODE]:
+                remove(wt_path + _WORKTREE_LOCK_EXT)
+            _worktree_locks.pop(wt_path).close()
+    prune_worktrees(flags)
+
+
+def get_branch_worktree(flags, wt_dir, branch):
+    """
+    Prepares a linked worktree with the files of a branch (detached HEAD).
+    Worktrees are reused across runs, one is only used by a single process
+    at a time and the least recently used ones are removed.
+    Not available in safe mode, where no worktree can be written.
+    - wt_dir    -- The directory holding the worktrees of the repository.
+    - branch    -- The branch to check out.
+    Returns the path of the worktree.
+    """
+    try:
+        mkdirs(flags, wt_dir)
+        common_dir = get_session().common_dir
+        slot = 0
+        while True:
+            wt_path = path.join(wt_dir, "{0}.{1}".format(
+                branch.replace('/', '_'), slot))
+            slot += 1
+            if not _lock_worktree(wt_path):
+                continue
+            wt_common_dir = _get_worktree_common_dir(wt_path)
+            if wt_common_dir == common_dir:
+                log(flags, "Updating worktree \'" + wt_path + "\'")
+                update_worktree(flags, wt_path, "refs/heads/" + branch)
+                break
+            elif wt_common_dir is None:
+                log(flags, "Adding worktree \'" + wt_path + "\'")
+                remove_dir(flags, wt_path)
+                prune_worktrees(flags)
+                add_worktree(flags, wt_path, "refs/heads/" + branch)
+                break
+            # Otherwise the slot belongs to another repository.
+
+        # Mark as recently used.
+        if path.isdir(wt_path):
+            utime(wt_path)
+        _evict_worktrees(flags, wt_dir, common_dir)
+        return wt_path
+    except (Error, IOError, OSError) as err:
+        log(flags, "Could not prepare a worktree for branch \'" + branch +
+            "\'")
+        raise OpError(err if isinstance(err, Error) else None)
+
+
+class BranchFiles(object):
+    """
+    Gives access to the files of a branch. The branch is checked out in the
+    repository, or if a worktree directory is given and the branch is not
+    the current one, in a linked worktree so that the repository files are
+    left untouched. Commits made in the worktree are published to the
+    branch with 'publish'.
+    """
+
+    def __init__(self, branch, wt_dir=None):
+        """
+            :param branch: the branch
+            :type branch: str
+            :param wt_dir: the directory holding the worktrees of the
+                           repository, None to always check out
+            :type wt_dir: str
+        """
+        self.branch = branch
+        self.wt_dir = wt_dir
+        self.wt_path = None
+        self._repo_path = None
+        self._start_commit = None
+
+    def is_worktree(self):
+        """ Checks if the branch files are in a linked worktree. """
+        return self.wt_path is not None
+
+    def enter(self, flags):
+        """
+        Makes the branch files available in the current directory.
+        Errors will be raised as OpError.
+        """
+        try:
+            # No worktree can be prepared in safe mode, check out instead.
+            if self.wt_dir is None or flags[Flag.SAFEMODE] or \
+                    get_branch() == self.branch:
+                switch_branch(self.branch)
+                return
+            self._start_commit = get_head_commit(self.branch)
+        except Error as err:
+            raise OpError(err)
+        self.wt_path = get_branch_worktree(flags, self.wt_dir, self.branch)
+        self._repo_path = getcwd()
+        log(flags, "Using worktree \'" + self.wt_path + "\' for branch \'" +
+            self.branch + "\'")
+        chdir(self.wt_path)
+
+    def publish(self, flags):
+        """
+        Moves the branch to the commits made in the worktree, if any.
+        Errors will be raised as OpError.
+        """
+        if not self.is_worktree() or flags[Flag.SAFEMODE]:
+            return
+        try:
+            head_commit = get_head_commit("HEAD")
+            if head_commit != self._start_commit:
+                log(flags, "Moving branch \'" + self.branch +
+                    "\' to worktree commit \'" + head_commit + "\'")
+                chdir(self._repo_path)
+                ref_transaction = RefTransaction(flags)
+                ref_transaction.update("refs/heads/" + self.branch,
+                                       head_commit, self._start_commit)
+                ref_transaction.commit(flags)
+                chdir(self.wt_path)
+        except Error as err:
+            raise OpError(err)
+
+    def leave(self):
+        """ Returns to the repository directory if a worktree was used. """
+        if self._repo_path is not None:
+            chdir(self._repo_path)
+            self._repo_path = None
+
+
+def add_backup(flags, bak_dir, name="unknown", compression=Compression.GZIP,
+               threads=None):
     """
     Adds a backup of the git repository.
-    - bak_dir   -- The destination directory.
-    - name      -- The name of the backup, replaces '_' with '-'.
+    - bak_dir       -- The destination directory.
+    - name          -- The name of the backup, replaces '_' with '-'.
+    - compression   -- The compression method.
+    - threads       -- The number of compression threads (None for all CPUs).
     Returns the name of the created backup file.
     """
     try:
@@ -451,16 +1414,19 @@ def add_backup(flags, bak_dir, name="unknown"):
         name.replace('_', '-')
 
         # Set the path to the new backup file.
-        tar_name = "{0}_{1}{2}".format(name,
-                                       strftime(_BAK_FILE_DATE_FORMAT),
-                                       _BAK_FILE_EXT)
+        tar_name = "{0}_{1}{2}{3}".format(name,
+                                          strftime(_BAK_FILE_DATE_FORMAT),
+                                          _BAK_FILE_EXT,
+                                          get_compression_ext(compression))
         tar_path = path.join(bak_dir, tar_name)
 
         # Make a safety backup of the current git repository.
         log(flags, "Creating backup file \'" + tar_path + "\'")
         if not flags[Flag.SAFEMODE]:
             mkdirs(flags, bak_dir)
-            exec_cmd(["tar", "-czf", tar_path, "."])
+            exec_pipeline([["tar", "-cf", "-", "."],
+                           get_compressor(compression, threads)],
+                          out_path=tar_path)
 
         return tar_name
     except Error as err:
@@ -485,16 +1451,19 @@ def restore_backup(flags, bak_dir, num=None, name=None):
 
         else:
             # Find all previously backed up states.
-            bak_files = get_files_with_extension(bak_dir, _BAK_FILE_EXT)
+            # Backups may use any compression method.
+            bak_files = [f for ext in get_compression_exts() for f in
+                         get_files_with_extension(bak_dir,
+                                                  _BAK_FILE_EXT + ext)]
             if not bak_files:
                 raise OpError("No backups exists in directory \'" +
                               bak_dir + "\'")
 
-            # Sort the bak_files according to date.
-            bak_files.sort(key=lambda bak_f: [int(v) for v in
-                                              bak_f.split('_')[1].split('.')[
-                                                  0].split('-')],
-                           reverse=True)
+            # Sort the bak_files according to date, latest first.
+            bak_files = sort_by_version(
+                bak_files,
+                lambda bak_f: get_file_version_str(bak_f, _BAK_FILE_EXT),
+                reverse=True)
 
             # Set the max tab depth.
             max_tab_depth = max([1 + (len(s.split('_')[0]) // _TAB_WIDTH)
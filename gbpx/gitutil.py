@@ -4,11 +4,17 @@ Contains various io functions for git.
 No functions will print any progress messages.
 If a failure occurs functions will terminate with GitError.
 """
-from os import getcwd
-from re import findall, match
+from bisect import insort
+from enum import Enum
+from os import getcwd, path, stat, environ, replace, remove
+from shutil import copyfile
+from re import match
+from threading import Lock, RLock
 
 from gbpxargs import Flag
-from ioutil import Error, log, TextType, exec_cmd, CommandError
+from ioutil import Error, log, TextType, exec_cmd, CommandError, CmdProcess, \
+    exec_cmd_lines, get_spawn_count
+from versionutil import get_version_key
 
 
 class GitError(Error):
@@ -34,24 +40,615 @@ class GitError(Error):
             log(flags, self.msg, TextType.ERR)
 
 
+## Ref reader.
+
+_GIT_FILE_PREFIX = "gitdir: "
+_SYMREF_PREFIX = "ref: "
+_MAX_SYMREF_DEPTH = 5
+_PER_WORKTREE_REFS = ("HEAD", "refs/bisect/", "refs/worktree/",
+                      "refs/rewritten/")
+
+
+def _is_oid(value):
+    """ Checks if a string is a full (sha1 or sha256) object id. """
+    return match(r"^([0-9a-f]{40}|[0-9a-f]{64})$", value) is not None
+
+
+def _read_file(file_path):
+    """ Reads a small text file, returns None if it can't be read. """
+    try:
+        with open(file_path) as file_:
+            return file_.read().strip()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+
+
+def find_git_dirs(dir_path):
+    """
+    Finds the git dir and the common git dir of the repository containing
+    the given directory without spawning git. Linked worktrees ('.git'
+    files) and 'commondir' files are followed.
+    Returns a tuple (<git dir>, <common dir>) or None if no repository
+    was found or the layout must be left to git (e.g. GIT_DIR is set).
+    """
+    if "GIT_DIR" in environ or "GIT_COMMON_DIR" in environ:
+        return None
+
+    # Search upwards for a '.git' directory or file.
+    current_dir = dir_path
+    while True:
+        dot_git = path.join(current_dir, ".git")
+        if path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        elif path.isfile(dot_git):
+            content = _read_file(dot_git)
+            if content is None or not content.startswith(_GIT_FILE_PREFIX):
+                return None
+            git_dir = path.normpath(path.join(
+                current_dir, content[len(_GIT_FILE_PREFIX):]))
+            break
+        parent_dir = path.dirname(current_dir)
+        if parent_dir == current_dir:
+            return None
+        current_dir = parent_dir
+
+    if not path.isfile(path.join(git_dir, "HEAD")):
+        return None
+
+    # Linked worktrees share the refs of the main repository.
+    common_dir = _read_file(path.join(git_dir, "commondir"))
+    if common_dir is not None:
+        common_dir = path.normpath(path.join(git_dir, common_dir))
+    else:
+        common_dir = git_dir
+    return git_dir, common_dir
+
+
+class RefReader(object):
+    """
+    Resolves refs by reading HEAD, loose refs and packed-refs directly.
+    Lookups that can't be answered from the files (e.g. reftable
+    repositories or unexpected content) return None, leaving the
+    lookup to git.
+    """
+
+    # Parsed packed-refs per file path, with the stat they were read at.
+    _packed_cache = {}
+
+    def __init__(self, git_dir, common_dir):
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.supported = not path.exists(path.join(common_dir, "reftable"))
+
+    def _get_ref_path(self, ref):
+        """ Returns the path of a loose ref file. """
+        if ref.startswith(_PER_WORKTREE_REFS):
+            return path.join(self.git_dir, ref)
+        return path.join(self.common_dir, ref)
+
+    def _get_packed_refs(self):
+        """ Returns the parsed packed-refs, reading the file if changed. """
+        packed_path = path.join(self.common_dir, "packed-refs")
+        try:
+            packed_stat = stat(packed_path)
+        except OSError:
+            return {}
+        stamp = (packed_stat.st_ino, packed_stat.st_mtime_ns,
+                 packed_stat.st_size)
+        cached = RefReader._packed_cache.get(packed_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        refs = {}
+        with open(packed_path) as packed_file:
+            for line in packed_file:
+                # Skip the header and peeled tag lines.
+                if line.startswith(("#", "^")):
+                    continue
+                parts = line.split()
+                if len(parts) == 2:
+                    refs[parts[1]] = parts[0]
+        RefReader._packed_cache[packed_path] = (stamp, refs)
+        return refs
+
+    def read_loose(self, ref):
+        """
+        Reads the content of a loose ref, e.g. 'HEAD'.
+        Returns the content or None if there is no such loose ref.
+        """
+        if not self.supported:
+            return None
+        return _read_file(self._get_ref_path(ref))
+
+    def resolve(self, ref):
+        """
+        Resolves a full ref name, e.g. 'HEAD' or 'refs/heads/<branch>',
+        following symbolic refs.
+        Returns the object id or None if it could not be resolved.
+        """
+        if not self.supported:
+            return None
+        for _ in range(_MAX_SYMREF_DEPTH):
+            content = self.read_loose(ref)
+            if content is None:
+                return self._get_packed_refs().get(ref)
+            elif content.startswith(_SYMREF_PREFIX):
+                ref = content[len(_SYMREF_PREFIX):]
+            elif _is_oid(content):
+                return content
+            else:
+                return None
+        return None
+
+
+## Repository session.
+
+class RepoSession(object):
+    """
+    Cached state of the repository in a directory, validated once.
+    Holds the object query process, the tag index, the current branch and
+    the HEAD commit. The branch and HEAD are read again when
+    '<git dir>/HEAD' or the branch ref have been modified outside
+    of the session.
+    The query processes and the tag index can be used from several
+    threads.
+    """
+
+    def __init__(self, dir_path):
+        """
+        Validates the repository in the given directory.
+        Errors will be raised as GitError (if not a rep).
+            :param dir_path: the directory of the repository
+            :type dir_path: str
+        """
+        git_dirs = find_git_dirs(dir_path)
+        if git_dirs is None:
+            # Let git find the repository.
+            try:
+                git_dirs = [path.join(dir_path, git_dir) for git_dir in
+                            exec_cmd(["git", "rev-parse", "--git-dir",
+                                      "--git-common-dir"]).splitlines()]
+            except CommandError:
+                raise GitError(dir_path + " is not a git repository",
+                               "rev-parse")
+        self.dir_path = dir_path
+        self.git_dir = path.normpath(git_dirs[0])
+        self.common_dir = path.normpath(git_dirs[1])
+        self.refs = RefReader(self.git_dir, self.common_dir)
+        self._git_dir_ino = stat(self.git_dir).st_ino
+        # Guards the query processes and the tag index.
+        self._lock = RLock()
+        self._batch = None
+        self._blob_batch = None
+        self._tag_index = None
+        self._branch = None
+        self._branch_stamp = None
+        self._head = None
+        self._head_stamp = None
+        # The last clean check as (<stamp>, <clean>).
+        self.clean_state = None
+
+    def is_valid(self):
+        """ Checks that the repository has not been removed or replaced. """
+        try:
+            return stat(self.git_dir).st_ino == self._git_dir_ino
+        except OSError:
+            return False
+
+    def close(self):
+        """ Stops the object query processes of the session. """
+        with self._lock:
+            if self._batch is not None:
+                self._batch.close()
+                self._batch = None
+            if self._blob_batch is not None:
+                self._blob_batch.close()
+                self._blob_batch = None
+
+    def get_clean_stamp(self):
+        """
+        Returns the git state the result of a clean check depends on,
+        valid as long as no command has been run in between.
+        Changes to the working directory files are not part of the stamp.
+        """
+        return ((get_spawn_count(),) +
+                self._stamp(path.join(self.git_dir, "index")) +
+                self._get_head_stamp(self.get_branch()))
+
+    @staticmethod
+    def _stamp(*file_paths):
+        """
+        Returns the inode, modification time and size of the given files.
+        Git replaces ref files by renaming a lock file over them, so the
+        inode changes even if the modification time does not.
+        """
+        stamp = []
+        for file_path in file_paths:
+            try:
+                file_stat = stat(file_path)
+                stamp.append((file_stat.st_ino, file_stat.st_mtime_ns,
+                              file_stat.st_size))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _get_head_stamp(self, branch):
+        """ Returns the stamps of HEAD and the branch ref. """
+        return self._stamp(path.join(self.git_dir, "HEAD"),
+                           path.join(self.common_dir, "refs", "heads", branch),
+                           path.join(self.common_dir, "packed-refs"))
+
+    def query_object(self, rev):
+        """
+        Looks up an object through the persistent query process.
+        Errors will be raised as GitError.
+        Returns a tuple (<object id>, <object type>) or None if missing.
+        """
+        with self._lock:
+            if self._batch is None or not self._batch.is_alive():
+                try:
+                    self._batch = CmdProcess(["git", "cat-file",
+                                              "--batch-check"])
+                except CommandError:
+                    raise GitError("The object query process could not be " +
+                                   "started", "cat-file")
+            try:
+                response = self._batch.request(rev)
+            except CommandError:
+                self.close()
+                raise GitError("The object query process exited",
+                               "cat-file")
+        parts = response.split()
+        if len(parts) == 3:
+            return parts[0], parts[1]
+        else:
+            return None
+
+    def read_object(self, rev):
+        """
+        Reads the content of an object (e.g. '<branch>:<path>') through
+        the persistent content process.
+        Errors will be raised as GitError.
+        Returns a tuple (<object id>, <object type>, <content bytes>)
+        or None if missing.
+        """
+        with self._lock:
+            if self._blob_batch is None or not self._blob_batch.is_alive():
+                try:
+                    self._blob_batch = CmdProcess(["git", "cat-file",
+                                                   "--batch"])
+                except CommandError:
+                    raise GitError("The object read process could not be " +
+                                   "started", "cat-file")
+            try:
+                parts = self._blob_batch.request(rev).split()
+                if len(parts) != 3:
+                    return None
+                # The content is followed by a line break.
+                content = self._blob_batch.read(int(parts[2]) + 1)[:-1]
+            except CommandError:
+                self._blob_batch.close()
+                self._blob_batch = None
+                raise GitError("The object read process exited", "cat-file")
+        return parts[0], parts[1], content
+
+    def get_tag_index(self):
+        """
+        Retrieves the tag index of the repository, loading it on first use.
+        Errors will be raised as GitError.
+        """
+        with self._lock:
+            if self._tag_index is None:
+                tag_index = TagIndex()
+                tag_index.load()
+                self._tag_index = tag_index
+            return self._tag_index
+
+    def has_tag_index(self):
+        """ Checks if the tag index has been loaded. """
+        return self._tag_index is not None
+
+    def invalidate_tag_index(self):
+        """ Drops the loaded tag index. """
+        self._tag_index = None
+
+    def get_branch(self):
+        """
+        Retrieves the name of the current branch ('HEAD' if detached).
+        Errors will be raised as GitError.
+        """
+        stamp = self._stamp(path.join(self.git_dir, "HEAD"))
+        if self._branch is None or stamp != self._branch_stamp:
+            self._branch = self._read_branch()
+            self._branch_stamp = stamp
+        return self._branch
+
+    def _read_branch(self):
+        """ Reads the current branch from HEAD, using git if needed. """
+        head = self.refs.read_loose("HEAD")
+        if head is not None:
+            if head.startswith(_SYMREF_PREFIX + "refs/heads/"):
+                return head[len(_SYMREF_PREFIX + "refs/heads/"):]
+            elif _is_oid(head):
+                return "HEAD"
+        try:
+            return exec_cmd(["git", "rev-parse", "--abbrev-ref", "HEAD"])
+        except CommandError:
+            raise GitError("Could not find the name of the current " +
+                           "branch", "rev-parse")
+
+    def set_branch(self, branch):
+        """ Updates the current branch after it has been checked out. """
+        self._branch = branch
+        self._branch_stamp = self._stamp(path.join(self.git_dir, "HEAD"))
+        self._head = None
+
+    def get_head(self):
+        """
+        Retrieves the HEAD commit id.
+        Errors will be raised as GitError.
+        """
+        stamp = self._get_head_stamp(self.get_branch())
+        if self._head is None or stamp != self._head_stamp:
+            self._head = self.resolve_ref("HEAD")
+            self._head_stamp = stamp
+        return self._head
+
+    def resolve_ref(self, ref):
+        """
+        Resolves a full ref name to an object id, reading the ref files
+        directly and only asking git if that fails.
+        Errors will be raised as GitError (if the ref does not exist).
+        """
+        oid = self.refs.resolve(ref)
+        if oid is None:
+            obj = self.query_object(ref)
+            if obj is None:
+                raise GitError("The ref \'" + ref + "\' could not be " +
+                               "resolved", "cat-file")
+            oid = obj[0]
+        return oid
+
+    def invalidate_head(self):
+        """ Drops the cached HEAD commit after the branch has been moved. """
+        self._head = None
+
+
+# Repository sessions per directory.
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def get_session():
+    """
+    Retrieves the repository session for the current directory,
+    validating the repository on first use.
+    Errors will be raised as GitError (if not a rep).
+    """
+    dir_path = path.realpath(getcwd())
+    with _sessions_lock:
+        session = _sessions.get(dir_path)
+        if session is None or not session.is_valid():
+            if session is not None:
+                session.close()
+            session = RepoSession(dir_path)
+            _sessions[dir_path] = session
+        return session
+
+
+def resolve_rev(rev):
+    """
+    Resolves a revision to an object id without spawning a process.
+    Errors will be raised as GitError (if the revision does not exist).
+        :param rev: the revision, e.g. 'HEAD', '<branch>^{commit}'
+        :type rev: str
+        :returns: the full object id
+        :rtype: str
+        :raises: GitError
+    """
+    obj = get_session().query_object(rev)
+    if obj is None:
+        raise GitError("The revision \'" + rev + "\' could not be resolved",
+                       "cat-file")
+    return obj[0]
+
+
 def check_git_rep():
     """
     Checks if the current directory is a git repository.
+    The repository is only validated once per session.
     Errors will be raised as GitError (if not a rep).
     """
-    try:
-        exec_cmd(["git", "status"])
-    except CommandError:
-        raise GitError(getcwd() + " is not a git repository", "status")
+    get_session()
+
+
+## Tag index.
+
+_TAG_REF_PREFIX = "refs/tags/"
+
+
+def _tag_version_key(tag):
+    """
+    Returns a sort key for the version part of a tag (<tag_type>/<version>),
+    versions are ordered as by dpkg.
+    """
+    return get_version_key(tag.partition('/')[2])
+
+
+class TagIndex(object):
+    """
+    In-memory index of all tags in a repository, loaded with a single
+    'git for-each-ref' pass. Tags are grouped by tag type
+    (<tag_type>/<version>) and kept sorted on version.
+    The commit history needed to find reachable tags is read on demand
+    and kept, commits are never changed so it stays valid when tags are.
+    """
+
+    def __init__(self):
+        # Tag name to commit id.
+        self._commits = {}
+        # Tag type to commit id to version sorted list of (key, tag).
+        self._by_commit = {}
+        # Tag type to version sorted list of (key, tag).
+        self._sorted = {}
+        # (commit id, tag type) to the closest reachable tag.
+        self._reachable = {}
+        # Commit id to parent commit ids, complete for the ancestry of
+        # the commits in _history_tips.
+        self._parents = {}
+        self._history_tips = []
+
+    def load(self):
+        """
+        Loads all tags of the repository in the current directory.
+        Errors will be raised as GitError.
+        """
+        try:
+            output = exec_cmd(["git", "for-each-ref",
+                               "--format=%(refname) %(objectname) "
+                               "%(*objectname)", _TAG_REF_PREFIX])
+        except CommandError:
+            raise GitError("The repository tags could not be listed",
+                           "for-each-ref")
+        # Annotated tags are peeled to the tagged commit.
+        for line in output.splitlines():
+            parts = line.split()
+            self._commits[parts[0][len(_TAG_REF_PREFIX):]] = parts[-1]
+
+        # Sort all tags once, appending keeps the lists sorted.
+        for entry in sorted([(_tag_version_key(tag), tag)
+                             for tag in self._commits]):
+            tag = entry[1]
+            tag_type = tag.partition('/')[0]
+            self._by_commit.setdefault(tag_type, {}).setdefault(
+                self._commits[tag], []).append(entry)
+            self._sorted.setdefault(tag_type, []).append(entry)
+
+    def add(self, tag, commit):
+        """ Adds a tag pointing at the given commit to the index. """
+        self.remove(tag)
+        self._reachable.clear()
+        tag_type = tag.partition('/')[0]
+        entry = (_tag_version_key(tag), tag)
+        self._commits[tag] = commit
+        insort(self._by_commit.setdefault(tag_type, {}).setdefault(commit, []),
+               entry)
+        insort(self._sorted.setdefault(tag_type, []), entry)
+
+    def remove(self, tag):
+        """ Removes a tag from the index if present. """
+        commit = self._commits.pop(tag, None)
+        if commit is not None:
+            self._reachable.clear()
+            tag_type = tag.partition('/')[0]
+            entry = (_tag_version_key(tag), tag)
+            commit_tags = self._by_commit[tag_type][commit]
+            commit_tags.remove(entry)
+            if not commit_tags:
+                del self._by_commit[tag_type][commit]
+            self._sorted[tag_type].remove(entry)
+
+    def get_commit_tags(self, commit, tag_type):
+        """
+        Retrieves the tags of a type pointing at the given commit.
+        Returns the list of tags sorted on version (can be empty).
+        """
+        return [tag for _, tag in
+                self._by_commit.get(tag_type, {}).get(commit, [])]
+
+    def get_tags(self, tag_type):
+        """
+        Retrieves all tags of a type.
+        Returns the list of tags sorted on version (can be empty).
+        """
+        return [tag for _, tag in self._sorted.get(tag_type, [])]
+
+    def _load_history(self, commit):
+        """
+        Reads the parents of the ancestors of a commit which have not been
+        read yet, with one 'git rev-list' pass.
+        Errors will be raised as GitError.
+        """
+        if commit in self._parents:
+            return
+        lines = exec_cmd_lines(["git", "rev-list", "--parents", commit] +
+                               ["^" + tip for tip in self._history_tips])
+        try:
+            for line in lines:
+                parts = line.split()
+                self._parents[parts[0]] = parts[1:]
+        except CommandError:
+            raise GitError("The history of \'" + commit +
+                           "\' could not be read", "rev-list")
+        finally:
+            lines.close()
+        self._history_tips.append(commit)
+
+    def get_reachable_tag(self, rev, tag_type):
+        """
+        Finds the tag of a type closest to the given revision in history,
+        i.e. on the tagged commit with the fewest commits in between (like
+        'git describe'), the greatest version if several are as close.
+        The history is walked in memory, only history not read by earlier
+        lookups is read from git. The lookup is memoised per commit and
+        tag type until the tags are changed.
+        Errors will be raised as GitError.
+        Returns the tag name or None if no tag is reachable.
+        """
+        tagged = self._by_commit.get(tag_type)
+        if not tagged:
+            return None
+        commit = resolve_rev(rev + "^{commit}")
+        key = (commit, tag_type)
+        if key not in self._reachable:
+            self._load_history(commit)
+            tag = None
+            # Breadth-first walk, one generation at a time.
+            generation = [commit]
+            seen = set(generation)
+            while generation and tag is None:
+                entries = [entry for gen_commit in generation
+                           for entry in tagged.get(gen_commit, [])]
+                if entries:
+                    tag = max(entries)[1]
+                parents = []
+                for gen_commit in generation:
+                    for parent in self._parents.get(gen_commit, []):
+                        if parent not in seen:
+                            seen.add(parent)
+                            parents.append(parent)
+                generation = parents
+            self._reachable[key] = tag
+        return self._reachable[key]
+
+
+def get_tag_index():
+    """
+    Retrieves the tag index of the repository in the current directory.
+    Errors will be raised as GitError.
+    """
+    return get_session().get_tag_index()
+
+
+def invalidate_tag_index():
+    """
+    Drops all loaded tag indexes, must be called after tags have been
+    changed by other programs than this module (e.g. gbp).
+    """
+    for session in _sessions.values():
+        session.invalidate_tag_index()
 
 
 def switch_branch(branch):
     """
-    Switches to git branch.
+    Switches to git branch, skipped if the branch is already checked out.
     Errors will be raised as GitError (if checkout isn't possible).
     """
     # Verify that the current dir is a git repository.
-    check_git_rep()
+    session = get_session()
+    if session.get_branch() == branch:
+        return
     try:
         # Try to switch branch.
         exec_cmd(["git", "checkout", branch])
@@ -59,22 +656,29 @@ def switch_branch(branch):
         raise GitError("Please make sure that the branch \'" +
                        branch + "\' exists and all changes " +
                        "are commited", "checkout")
+    session.set_branch(branch)
+
+
+def _branch_ref(branch):
+    """
+    Returns the full ref name of a branch, used to address the branch
+    without checking it out ('HEAD' is kept for detached states).
+    """
+    return branch if branch == "HEAD" else "refs/heads/" + branch
 
 
 def get_head_tags(branch, tag_type):
     """
     Retrieves the tags for the HEAD commit on form (<tag_type>/<version>).
+    The branch is addressed by ref and is not checked out.
     Errors will be raised as GitError (underlying errors).
-    Returns the list of HEAD tags for the given branch (can be empty).
+    Returns the list of HEAD tags for the given branch sorted on version
+    (can be empty).
     """
-    switch_branch(branch)
     try:
-        # Get all tags at HEAD.
-        head_tags = exec_cmd(["git", "tag", "--points-at", "HEAD"])
-        # Find the matching tags.
-        matching_tags = findall(r"(?m)^" + tag_type + r"/.*$", head_tags)
-        return matching_tags
-    except CommandError:
+        return get_tag_index().get_commit_tags(get_head_commit(branch),
+                                               tag_type)
+    except GitError:
         raise GitError("The tags pointing at \'" + branch +
                        "\' HEAD, could not be retrieved", "tag")
 
@@ -85,16 +689,12 @@ def get_head_tag(branch, tag_type):
     Errors will be raised as GitError (underlying errors).
     Returns the name of the latest tag (largest version number).
     """
-    # Get the latest HEAD tags.
+    # Get the HEAD tags, already sorted on version.
     head_tags = get_head_tags(branch, tag_type)
 
     # Make sure at least some tag follows the right format.
     if head_tags:
-        # Find the "latest tag"
-        # Assuming std format: <tag_type>/<version>(-<deb_version>)
-        head_tags.sort(key=lambda s: [int(v) for v in
-                                      s.split('/')[1].split('-')[0].split('.')])
-        return head_tags[0]
+        return head_tags[-1]
     else:
         raise GitError("The HEAD on branch \'" + branch +
                        "\' has no tags of type: " + tag_type + "/<version>")
@@ -103,17 +703,16 @@ def get_head_tag(branch, tag_type):
 def get_latest_tag(branch, tag_type):
     """
     Retrieves the latest tag (<tag_type>/<version>) for a branch.
+    The branch is addressed by ref and is not checked out.
     Errors will be raised as GitError (underlying errors or if no tags exists).
     """
-    # Get the latest tag.
-    switch_branch(branch)
-    try:
-        return exec_cmd(["git", "describe", "--abbrev=0", "--tags",
-                         "--match", tag_type + "/*"])
-    except CommandError:
+    latest_tag = get_tag_index().get_reachable_tag(_branch_ref(branch),
+                                                   tag_type)
+    if latest_tag is None:
         raise GitError("The branch \'" + branch +
                        "\' has no tags of type: " +
                        tag_type + "/<version>")
+    return latest_tag
 
 
 def get_version_from_tag(tag, tag_type):
@@ -152,17 +751,93 @@ def get_latest_tag_version(branch, tag_type):
     return get_version_from_tag(latest_tag, tag_type)
 
 
-def is_working_dir_clean():
+class CleanCheck(Enum):
+    """ Strategies for checking if the working directory is clean. """
+    # Full 'git status --porcelain'.
+    STATUS = 'status'
+    # Files and index compared to HEAD, stops at the first change.
+    DIFF_INDEX = 'diff-index'
+    # Status using the untracked cache (and fsmonitor if configured),
+    # stops at the first reported path.
+    UNTRACKED_CACHE = 'untracked-cache'
+
+
+def _has_output(cmd):
+    """ Checks if a command outputs any line, stops at the first line. """
+    lines = exec_cmd_lines(cmd)
+    try:
+        for _ in lines:
+            return True
+        return False
+    finally:
+        lines.close()
+
+
+def _has_diff(cmd):
+    """ Checks if a quiet diff command reports differences. """
+    try:
+        exec_cmd(cmd)
+        return False
+    except CommandError as err:
+        if err.std_err:
+            # Some other error.
+            raise
+        return True
+
+
+def is_working_dir_clean(strategy=CleanCheck.DIFF_INDEX, untracked=True,
+                         use_cache=False):
     """
     Check if working directory is clean.
+    Errors will be raised as GitError.
     Returns True if clean, False otherwise.
+        :param strategy: how to detect changes
+        :type strategy: CleanCheck
+        :param untracked: set to check for untracked files as well
+                          (always checked by CleanCheck.STATUS)
+        :type untracked: bool
+        :param use_cache: set to reuse the last result if no command has
+                          been run and the index and HEAD are unchanged,
+                          only safe if no files can have been changed
+                          in between (file writes are not detected)
+        :type use_cache: bool
     """
-    check_git_rep()
+    session = get_session()
+    check = (strategy, untracked)
+    if use_cache and session.clean_state is not None and \
+            session.clean_state[0] == (session.get_clean_stamp(),) + check:
+        return session.clean_state[1]
+
     try:
-        return exec_cmd(["git", "status", "--porcelain"]) == ''
+        if strategy == CleanCheck.DIFF_INDEX:
+            try:
+                session.get_head()
+            except GitError:
+                # Nothing to compare with before the first commit.
+                strategy = CleanCheck.STATUS
+
+        if strategy == CleanCheck.STATUS:
+            clean = exec_cmd(["git", "status", "--porcelain"]) == ''
+        elif strategy == CleanCheck.UNTRACKED_CACHE:
+            clean = not _has_output(
+                ["git", "-c", "core.untrackedCache=true", "status",
+                 "--porcelain", "--untracked-files=" +
+                 ("normal" if untracked else "no")])
+        else:
+            # Files are compared first since stat-only changes are
+            # refreshed by 'git diff' but reported by 'git diff-index'.
+            clean = not _has_diff(["git", "diff", "--quiet", "HEAD", "--"]) \
+                and not _has_diff(["git", "diff-index", "--cached",
+                                   "--quiet", "HEAD", "--"]) \
+                and not (untracked and _has_output(
+                    ["git", "ls-files", "--others", "--exclude-standard",
+                     "--directory", "--no-empty-directory"]))
     except CommandError:
         raise GitError("Could not determine if working directory is clean.",
-                       "status")
+                       strategy.value)
+
+    session.clean_state = ((session.get_clean_stamp(),) + check, clean)
+    return clean
 
 
 def get_branch():
@@ -170,29 +845,132 @@ def get_branch():
     Retrives the name of the current branch.
     Errors will be raised as GitError.
     """
-    check_git_rep()
+    return get_session().get_branch()
+
+
+def get_file_content(rev, file_path):
+    """
+    Retrieves the content of a file in a revision without checking it out.
+    Errors will be raised as GitError.
+        :param rev: the revision, e.g. a branch name
+        :type rev: str
+        :param file_path: the path of the file relative to the repository
+        :type file_path: str
+        :returns: the file content or None if the file does not exist
+        :rtype: str
+    """
+    obj = get_session().read_object(rev + ":" + file_path)
+    if obj is None or obj[1] != "blob":
+        return None
     try:
-        return exec_cmd(["git", "rev-parse", "--abbrev-ref", "HEAD"])
-    except CommandError:
-        raise GitError("Could not find the name of the current branch",
-                       "rev-parse")
+        return obj[2].decode("utf-8")
+    except UnicodeDecodeError:
+        raise GitError("The file \'" + file_path + "\' in \'" + rev +
+                       "\' is not valid text", "cat-file")
 
 
 def get_head_commit(branch):
     """
     Retrives the name HEAD commit on the given branch.
+    The branch is addressed by ref and is not checked out.
     Errors will be raised as GitError.
     """
-    switch_branch(branch)
     try:
-        return exec_cmd(["git", "rev-parse", "HEAD"])
-    except CommandError:
+        session = get_session()
+        if branch == "HEAD" or branch == session.get_branch():
+            return session.get_head()
+        return session.resolve_ref(_branch_ref(branch))
+    except GitError:
         raise GitError("Could not find HEAD commit of branch \'" +
                        branch + "\'", "rev-parse")
 
 
 ## Affecting repository / files.
 
+_TAG_REF_PREFIX_LEN = len(_TAG_REF_PREFIX)
+
+
+class RefTransaction(object):
+    """
+    Queues ref creations, updates and deletions and commits them
+    atomically with a single 'git update-ref --stdin', either all refs
+    are written or none.
+    Revisions are resolved to object ids when queued, except in safe mode
+    where nothing is resolved or written.
+    """
+
+    def __init__(self, flags=None):
+        """
+            :param flags: the flags, nothing is written in safe mode
+            :type flags: dict
+        """
+        self._safemode = flags is not None and flags[Flag.SAFEMODE]
+        self._commands = []
+
+    def _resolve(self, rev):
+        """ Resolves a revision unless in safe mode (not needed). """
+        if rev is None or self._safemode:
+            return rev
+        return resolve_rev(rev)
+
+    def is_empty(self):
+        """ Checks if no ref changes are queued. """
+        return not self._commands
+
+    def create(self, ref, rev):
+        """
+        Queues the creation of a ref, fails on commit if it exists.
+        Errors will be raised as GitError (if the revision does not exist).
+        """
+        self._commands.append(("create", ref, self._resolve(rev), None))
+
+    def update(self, ref, rev, old_rev=None):
+        """
+        Queues an update of a ref, verifying the old value if given.
+        Errors will be raised as GitError (if a revision does not exist).
+        """
+        self._commands.append(("update", ref, self._resolve(rev),
+                               self._resolve(old_rev)))
+
+    def delete(self, ref, old_rev=None):
+        """
+        Queues the deletion of a ref, verifying the old value if given.
+        Errors will be raised as GitError (if a revision does not exist).
+        """
+        self._commands.append(("delete", ref, None,
+                               self._resolve(old_rev)))
+
+    def commit(self, flags):
+        """
+        Writes all queued ref changes in one atomic operation.
+        Errors will be raised as GitError (no refs are changed on error).
+        """
+        if self.is_empty() or self._safemode or flags[Flag.SAFEMODE]:
+            self._commands = []
+            return
+        session = get_session()
+        lines = [" ".join([part for part in command if part is not None])
+                 for command in self._commands]
+        try:
+            exec_cmd(["git", "update-ref", "--stdin"],
+                     std_input="\n".join(lines) + "\n")
+        except CommandError as err:
+            raise GitError("The ref changes could not be written:\n" +
+                           err.std_err.strip(), "update-ref")
+
+        # Update the cached repository state.
+        for opr, ref, oid, _ in self._commands:
+            if ref.startswith(_TAG_REF_PREFIX) and session.has_tag_index():
+                tag_index = session.get_tag_index()
+                tag = ref[_TAG_REF_PREFIX_LEN:]
+                if opr == "delete":
+                    tag_index.remove(tag)
+                else:
+                    tag_index.add(tag, resolve_rev(oid + "^{commit}"))
+        session.invalidate_head()
+        self._commands = []
+
+
 def init_repository(flags, dir_path):
     """
     Initiate a git repository.
@@ -225,16 +1003,33 @@ def create_branch(flags, branch):
         raise GitError("Could not create branch \'{}\' ".format(branch))
 
 
-def reset_branch(flags, branch, commit):
+def reset_branch(flags, branch, commit, transaction=None, keep_files=False):
     """
     Resets the given branch to the given commit, (accepts HEAD as commit).
+    Only the current branch is reset with its files, other branches are
+    not checked out and just have their ref moved.
+    If a transaction is given the ref update is queued in it.
+    If keep_files is set the files of the current branch are left as is
+    and only the branch and the index are reset.
     Errors will be raised as GitError.
     """
-    switch_branch(branch)
+    session = get_session()
     try:
-        if not flags[Flag.SAFEMODE]:
-            exec_cmd(["git", "reset", "--hard", commit])
-    except CommandError:
+        if branch == session.get_branch():
+            if not flags[Flag.SAFEMODE]:
+                exec_cmd(["git", "reset", "-q",
+                          "--mixed" if keep_files else "--hard", commit])
+                session.invalidate_head()
+        else:
+            # HEAD refers to the branch itself once reset.
+            if commit == "HEAD":
+                commit = _branch_ref(branch)
+            ref_transaction = (transaction if transaction is not None
+                               else RefTransaction(flags))
+            ref_transaction.update(_branch_ref(branch), commit + "^{commit}")
+            if transaction is None:
+                ref_transaction.commit(flags)
+    except (CommandError, GitError):
         raise GitError("Could not reset branch \'" + branch + "\' " +
                        "to commit \'" + commit + "\'")
 
@@ -244,15 +1039,215 @@ def commit_changes(flags, msg):
     Commits all changes for the current branch.
     Errors will be raised as GitError.
     """
-    check_git_rep()
+    session = get_session()
     try:
         if not flags[Flag.SAFEMODE]:
             exec_cmd(["git", "add", "-A"])
             exec_cmd(["git", "commit", "-m", msg])
+            session.invalidate_head()
     except CommandError:
         raise GitError("Could not commit changes to current branch")
 
 
+def commit_snapshot(flags, ref, msg):
+    """
+    Commits all changes in the working directory to the current branch
+    without touching any files. The commit is built on a temporary index
+    (write-tree, commit-tree) and is also stored under the given ref.
+    Errors will be raised as GitError.
+        :param flags:
+        :type flags: dict
+        :param ref: the private ref to keep the snapshot commit under
+        :type ref: str
+        :param msg: the commit message
+        :type msg: str
+        :raises: GitError
+    """
+    session = get_session()
+    if flags[Flag.SAFEMODE]:
+        return
+    index_path = path.join(session.git_dir, "index")
+    tmp_index_path = path.join(session.git_dir, "gbpx-snapshot-index")
+    try:
+        # Start from the current index to reuse its file stat data.
+        if path.exists(index_path):
+            copyfile(index_path, tmp_index_path)
+        index_env = {"GIT_INDEX_FILE": tmp_index_path}
+        exec_cmd(["git", "add", "-A"], env=index_env)
+        tree = exec_cmd(["git", "write-tree"], env=index_env)
+        head = session.get_head()
+        commit = exec_cmd(["git", "commit-tree", tree, "-p", head, "-m", msg])
+
+        # Move the branch and keep the snapshot reachable.
+        ref_transaction = RefTransaction(flags)
+        ref_transaction.update(_branch_ref(session.get_branch()), commit, head)
+        ref_transaction.update(ref, commit)
+        ref_transaction.commit(flags)
+
+        # The temporary index matches the new commit and the files.
+        replace(tmp_index_path, index_path)
+    except (CommandError, GitError, IOError, OSError):
+        raise GitError("Could not commit a snapshot of the working " +
+                       "directory", "commit-tree")
+    finally:
+        if path.exists(tmp_index_path):
+            remove(tmp_index_path)
+
+
+def _get_tree_entries(rev, *paths):
+    """
+    Lists the top level entries of the tree of a revision, optionally
+    limited to the given paths, in 'git mktree' input format.
+    """
+    return [entry for entry in
+            exec_cmd(["git", "ls-tree", "-z", rev + "^{tree}", "--"] +
+                     list(paths), raw=True).split('\0') if entry]
+
+
+def commit_tree(flags, rev, branch, msg, is_excluded=None, transaction=None):
+    """
+    Commits the tree of a revision on top of the given branch without
+    checking out any files, leaving out the files for which is_excluded
+    returns True. The tree is built on a temporary index (read-tree,
+    update-index, write-tree) and the branch is created if missing.
+    If a transaction is given the branch update is queued in it.
+    Errors will be raised as GitError.
+        :param flags:
+        :type flags: dict
+        :param rev: the revision to take the files from
+        :type rev: str
+        :param branch: the branch to commit to
+        :type branch: str
+        :param msg: the commit message
+        :type msg: str
+        :param is_excluded: function checking if a file path is excluded
+        :type is_excluded: function
+        :returns: the new commit id (None in safe mode)
+        :rtype: str
+        :raises: GitError
+    """
+    if flags[Flag.SAFEMODE]:
+        return None
+    session = get_session()
+    tmp_index_path = path.join(session.git_dir, "gbpx-import-index")
+    try:
+        index_env = {"GIT_INDEX_FILE": tmp_index_path}
+        exec_cmd(["git", "read-tree", rev + "^{tree}"], env=index_env)
+        if is_excluded is not None:
+            excluded = [file_path for file_path in
+                        exec_cmd(["git", "ls-files", "-z"], env=index_env,
+                                 raw=True).split('\0')
+                        if file_path and is_excluded(file_path)]
+            if excluded:
+                exec_cmd(["git", "update-index", "-z", "--force-remove",
+                          "--stdin"], std_input="\0".join(excluded) + "\0",
+                         env=index_env)
+        tree = exec_cmd(["git", "write-tree"], env=index_env)
+
+        try:
+            parent = get_head_commit(branch)
+        except GitError:
+            # The branch is created by the commit.
+            parent = None
+        commit = exec_cmd(["git", "commit-tree", tree, "-m", msg] +
+                          (["-p", parent] if parent is not None else []))
+
+        ref_transaction = (transaction if transaction is not None
+                           else RefTransaction(flags))
+        if parent is not None:
+            ref_transaction.update(_branch_ref(branch), commit, parent)
+        else:
+            ref_transaction.create(_branch_ref(branch), commit)
+        if transaction is None:
+            ref_transaction.commit(flags)
+        return commit
+    except (CommandError, GitError):
+        raise GitError("Could not commit the tree of \'" + rev + "\' " +
+                       "to branch \'" + branch + "\'", "commit-tree")
+    finally:
+        if path.exists(tmp_index_path):
+            remove(tmp_index_path)
+
+
+def create_annotated_tag(flags, tag, rev, msg, key_id=None, transaction=None):
+    """
+    Creates an annotated tag of the given revision, signed with the
+    given gpg key if set. The tag object is made with 'git mktag' so the
+    tag ref can be written together with other refs.
+    If a transaction is given the tag creation is queued in it.
+    Errors will be raised as GitError.
+    """
+    if flags[Flag.SAFEMODE]:
+        return
+    try:
+        tag_data = "object {0}\ntype commit\ntag {1}\ntagger {2}\n\n{3}\n". \
+            format(resolve_rev(rev + "^{commit}"), tag,
+                   exec_cmd(["git", "var", "GIT_COMMITTER_IDENT"]), msg)
+        if key_id is not None:
+            # The signature is appended to the tag data, as git does.
+            tag_data += exec_cmd(["gpg", "-bsau", key_id],
+                                 std_input=tag_data) + "\n"
+        tag_obj = exec_cmd(["git", "mktag"], std_input=tag_data)
+
+        ref_transaction = (transaction if transaction is not None
+                           else RefTransaction(flags))
+        ref_transaction.create(_TAG_REF_PREFIX + tag, tag_obj)
+        if transaction is None:
+            ref_transaction.commit(flags)
+    except (CommandError, GitError):
+        raise GitError("The tag \'" + tag + "\' could not be created " +
+                       "and may already exist", "mktag")
+
+
+def merge_replace(flags, branch, rev, keep_dir, msg, transaction=None):
+    """
+    Merges a revision into the given branch, replacing all files
+    except the given directory which is kept from the branch
+    (like the 'replace' merge mode of gbp import-orig).
+    No files are checked out.
+    If a transaction is given the branch update is queued in it.
+    Errors will be raised as GitError.
+        :returns: the merge commit id (None in safe mode)
+        :rtype: str
+        :raises: GitError
+    """
+    if flags[Flag.SAFEMODE]:
+        return None
+    try:
+        head = get_head_commit(branch)
+        entries = [entry for entry in _get_tree_entries(rev)
+                   if entry.split('\t', 1)[1] != keep_dir]
+        entries += _get_tree_entries(head, keep_dir)
+        tree = exec_cmd(["git", "mktree", "-z"],
+                        std_input="".join([entry + "\0" for entry in entries]))
+        commit = exec_cmd(["git", "commit-tree", tree, "-p", head,
+                           "-p", rev + "^{commit}", "-m", msg])
+
+        ref_transaction = (transaction if transaction is not None
+                           else RefTransaction(flags))
+        ref_transaction.update(_branch_ref(branch), commit, head)
+        if transaction is None:
+            ref_transaction.commit(flags)
+        return commit
+    except (CommandError, GitError):
+        raise GitError("Could not merge \'" + rev + "\' into branch \'" +
+                       branch + "\'", "commit-tree")
+
+
+def delete_ref(flags, ref):
+    """
+    Deletes the given ref (e.g. a private snapshot ref).
+    Errors will be raised as GitError.
+    """
+    try:
+        ref_transaction = RefTransaction(flags)
+        ref_transaction.delete(ref, ref)
+        ref_transaction.commit(flags)
+    except GitError:
+        raise GitError("The ref \'" + ref + "\' could not be deleted",
+                       "update-ref")
+
+
 def stash_changes(flags, name=None):
     """
     Stashes the changes in the working directory with a optional stash name.
@@ -290,31 +1285,110 @@ def apply_stash(flags, branch, name=None, drop=True):
                        (" (" + name + ")" if name is not None else ""), "stash")
 
 
-def delete_tag(flags, tag):
+def delete_tag(flags, tag, transaction=None):
     """
     Deletes the given tag.
+    If a transaction is given the deletion is queued in it.
+    Errors will be raised as GitError.
+    """
+    try:
+        ref_transaction = (transaction if transaction is not None
+                           else RefTransaction(flags))
+        ref_transaction.delete(_TAG_REF_PREFIX + tag, _TAG_REF_PREFIX + tag)
+        if transaction is None:
+            ref_transaction.commit(flags)
+    except GitError:
+        raise GitError("The tag \'" + tag + "\' could not be deleted", "tag")
+
+
+def tag_head(flags, branch, tag, transaction=None):
+    """
+    Tags the HEAD of the given branch.
+    The branch is addressed by ref and is not checked out.
+    If a transaction is given the tag creation is queued in it.
+    Errors will be raised as GitError.
+    """
+    try:
+        ref_transaction = (transaction if transaction is not None
+                           else RefTransaction(flags))
+        ref_transaction.create(_TAG_REF_PREFIX + tag,
+                               get_head_commit(branch))
+        if transaction is None:
+            ref_transaction.commit(flags)
+    except GitError:
+        raise GitError("The tag \'" + tag + "\' could not be created " +
+                       "and may already exist", "tag")
+
+
+def add_worktree(flags, dir_path, rev):
+    """
+    Adds a linked worktree with a detached HEAD at the given revision.
     Errors will be raised as GitError.
+        :param flags:
+        :type flags: dict
+        :param dir_path: path of the worktree to add
+        :type dir_path: str
+        :param rev: the revision to check out
+        :type rev: str
+        :raises: GitError
     """
     check_git_rep()
     try:
         if not flags[Flag.SAFEMODE]:
-            exec_cmd(["git", "tag", "-d", tag])
+            exec_cmd(["git", "worktree", "add", "--detach", dir_path, rev])
     except CommandError:
-        raise GitError("The tag \'" + tag + "\' could not be deleted", "tag")
+        raise GitError("Could not add worktree \'{}\'".format(dir_path),
+                       "worktree")
 
 
-def tag_head(flags, branch, tag):
+def update_worktree(flags, dir_path, rev):
     """
-    Tags the HEAD of the given branch.
+    Checks out a revision (detached) in a linked worktree, only files that
+    differ are written. Local changes and untracked files are removed.
     Errors will be raised as GitError.
+        :param flags:
+        :type flags: dict
+        :param dir_path: path of the worktree
+        :type dir_path: str
+        :param rev: the revision to check out
+        :type rev: str
+        :raises: GitError
     """
-    switch_branch(branch)
     try:
         if not flags[Flag.SAFEMODE]:
-            exec_cmd(["git", "tag", tag])
+            exec_cmd(["git", "-C", dir_path, "checkout", "-q", "--force",
+                      "--detach", rev])
+            exec_cmd(["git", "-C", dir_path, "clean", "-q", "-fdx"])
     except CommandError:
-        raise GitError("The tag \'" + tag + "\' could not be created " +
-                       "and may already exist", "tag")
+        raise GitError("Could not update worktree \'{}\'".format(dir_path),
+                       "checkout")
+
+
+def remove_worktree(flags, dir_path):
+    """
+    Removes a linked worktree and its files.
+    Errors will be raised as GitError.
+    """
+    check_git_rep()
+    try:
+        if not flags[Flag.SAFEMODE]:
+            exec_cmd(["git", "worktree", "remove", "--force", dir_path])
+    except CommandError:
+        raise GitError("Could not remove worktree \'{}\'".format(dir_path),
+                       "worktree")
+
+
+def prune_worktrees(flags):
+    """
+    Removes the administrative files of linked worktrees that are gone.
+    Errors will be raised as GitError.
+    """
+    check_git_rep()
+    try:
+        if not flags[Flag.SAFEMODE]:
+            exec_cmd(["git", "worktree", "prune"])
+    except CommandError:
+        raise GitError("Could not prune worktrees", "worktree")
 
 
 def clean_repository(flags):
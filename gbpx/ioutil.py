@@ -2,10 +2,27 @@
 ioutil module:
 Contains various io functions for git and packaging.
 """
-from os import path, rename, remove, listdir, makedirs, walk
+from asyncio import create_subprocess_exec, gather, get_running_loop, \
+    run as run_async, CancelledError, Semaphore
+from atexit import register
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from json import dump
+from os import path, rename, remove, listdir, makedirs, walk, environ, read, \
+    write, wait4, WIFSIGNALED, WTERMSIG, WEXITSTATUS, pipe, close, \
+    open as open_fd, O_WRONLY, O_CREAT, O_TRUNC, devnull, sched_getaffinity
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
 from shutil import rmtree
-from subprocess import check_call, Popen, PIPE
+from signal import SIGPIPE
+from struct import pack
+from subprocess import Popen, PIPE, DEVNULL
 from sys import stdout
+from tempfile import TemporaryFile
+from threading import Thread, Lock, local, get_ident, main_thread
+from time import perf_counter
+from zlib import compressobj, crc32, DEFLATED, MAX_WBITS, Z_FINISH, \
+    Z_SYNC_FLUSH
 from gbpxargs import Flag
 
 
@@ -22,20 +39,29 @@ class Error(Exception):
         raise NotImplementedError("Please implement this method")
 
 
+# Number of output lines kept for error reports.
+_TAIL_LINES = 200
+
+
+def _get_tail(text, lines=_TAIL_LINES):
+    """ Returns the last lines of a text. """
+    return "\n".join(text.split("\n")[-lines:])
+
+
 class CommandError(Error):
     """Error raised when executing a shell command.
 
     Attributes:
         expr    -- input command for which the error occurred
-        std_out -- command output
-        std_err -- command error output
+        std_out -- command output (only the last lines)
+        std_err -- command error output (only the last lines)
     """
 
     def __init__(self, expr, std_out, std_err):
         Error.__init__(self)
         self.expr = expr
-        self.std_out = std_out
-        self.std_err = std_err
+        self.std_out = _get_tail(std_out)
+        self.std_err = _get_tail(std_err)
 
     def log(self, flags):
         """ Log the error """
@@ -44,6 +70,26 @@ class CommandError(Error):
         log(flags, "\nStdErr:\n" + self.std_err, TextType.ERR_EXTRA)
 
 
+class PipelineError(CommandError):
+    """Error raised when stages of a pipeline fail.
+
+    Attributes:
+        expr    -- the pipeline for which the error occurred
+        std_out -- pipeline output (only the last lines)
+        std_err -- error output of the failed stages (only the last lines)
+        stages  -- list of (stage, exit status, error output) tuples of
+                   the failed stages, the status is None for functions
+    """
+
+    def __init__(self, expr, std_out, stages):
+        CommandError.__init__(
+            self, expr, std_out, "\n".join(
+                ["[{0}] exited with status {1}:\n{2}".format(
+                    stage, status, std_err) for stage, status, std_err in
+                 stages]))
+        self.stages = stages
+
+
 ########################### Logging Tools ###############################
 #########################################################################
 ### This section defines functions useful for logging.
@@ -145,82 +191,1003 @@ def log_success(flags):
 
 _CMD_DEL = " "
 
+# Size of the chunks read from command output pipes.
+_READ_SIZE = 65536
+
+# Size of the chunks written to command input pipes, a pipe reported as
+# writable always accepts this much without blocking.
+_PIPE_BUF = 512
+
+# Maximum number of concurrently executed jobs.
+_MAX_JOBS = 4
+
+# Records of all executed commands.
+_cmd_records = []
+
+# Guards the command records and spans, commands and spans are added
+# from several threads.
+_records_lock = Lock()
+
+# Long-lived processes to close on exit.
+_open_processes = []
+
+
+class CmdRecord(object):
+    """
+    Resource accounting of an executed command.
+    The resource usage is only available for commands which have exited.
+    """
+
+    def __init__(self, cmd):
+        """
+        Starts the accounting of a command.
+            :param cmd: list of the executable followed by the arguments
+            :type cmd: list
+        """
+        self.cmd = list(cmd)
+        # Set when the command has been spawned.
+        self.span = None
+        self.start = perf_counter()
+        self.wall_time = 0.0
+        self.user_time = 0.0
+        self.sys_time = 0.0
+        self.max_rss = 0
+        self.exit_code = None
+        self.out_bytes = 0
+
+    def get_executable(self):
+        """ Retrieves the executable name of the command. """
+        return path.basename(self.cmd[0])
+
+    def finish(self, exit_code, usage=None):
+        """
+        Completes the record when the command has exited.
+            :param exit_code: the command exit code (negative if killed)
+            :type exit_code: int
+            :param usage: the resource usage of the process (if available)
+            :type usage: resource.struct_rusage
+        """
+        self.wall_time = perf_counter() - self.start
+        self.exit_code = exit_code
+        if usage is not None:
+            self.user_time = usage.ru_utime
+            self.sys_time = usage.ru_stime
+            # Maximum resident set size in KiB.
+            self.max_rss = usage.ru_maxrss
+
+    def to_dict(self):
+        """ Returns the record as a JSON serializable dict. """
+        return {'cmd': self.cmd,
+                'span': self.span.name if self.span is not None else None,
+                'wall_time': self.wall_time,
+                'user_time': self.user_time, 'sys_time': self.sys_time,
+                'max_rss': self.max_rss, 'exit_code': self.exit_code,
+                'out_bytes': self.out_bytes}
+
+
+def _add_cmd_record(record):
+    """
+    Registers the record of a spawned command and attaches it to the
+    innermost open span, commands which could not be spawned are not
+    recorded.
+    """
+    record.span = get_current_span()
+    with _records_lock:
+        if record.span is not None:
+            record.span.records.append(record)
+        _cmd_records.append(record)
+
+
+def _start_cmd(cmd, **popen_args):
+    """
+    Starts a command process and records it.
+    Returns a tuple of the process and its record.
+    """
+    record = CmdRecord(cmd)
+    proc = Popen(cmd, **popen_args)
+    _add_cmd_record(record)
+    return proc, record
+
+
+def _wait_cmd(proc, record):
+    """
+    Waits for a command process to exit and completes its record
+    with the resource usage of the process.
+    """
+    try:
+        _, status, usage = wait4(proc.pid, 0)
+    except ChildProcessError:
+        # The process has already been reaped.
+        proc.wait()
+        usage = None
+    else:
+        proc.returncode = -WTERMSIG(status) if WIFSIGNALED(status) \
+            else WEXITSTATUS(status)
+    record.finish(proc.returncode, usage)
+
+
+def _kill_cmd(proc, record):
+    """ Kills a command process and completes its record. """
+    proc.kill()
+    _wait_cmd(proc, record)
+
+
+def _read_pipes(proc, record, std_input=None):
+    """
+    Reads the standard output and error pipes of a command process until
+    they are closed, while writing any input to its standard input.
+    Yields a tuple of the pipe and the data read as the output arrives,
+    the data is empty when the pipe has been closed.
+    """
+    selector = DefaultSelector()
+    try:
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe is not None:
+                selector.register(pipe, EVENT_READ)
+        if proc.stdin is not None:
+            if std_input:
+                selector.register(proc.stdin, EVENT_WRITE)
+            else:
+                proc.stdin.close()
+        offset = 0
+        while selector.get_map():
+            for key, _ in selector.select():
+                if key.fileobj is proc.stdin:
+                    try:
+                        offset += write(
+                            key.fd, std_input[offset:offset + _PIPE_BUF])
+                    except BrokenPipeError:
+                        # The command will not read any further input.
+                        offset = len(std_input)
+                    if offset >= len(std_input):
+                        selector.unregister(proc.stdin)
+                        proc.stdin.close()
+                else:
+                    data = read(key.fd, _READ_SIZE)
+                    record.out_bytes += len(data)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    yield key.fileobj, data
+    finally:
+        selector.close()
+
+
+def get_spawn_count():
+    """
+    Retrieves the total number of processes spawned by this module.
+        :returns: the number of spawned processes
+        :rtype: int
+    """
+    with _records_lock:
+        return len(_cmd_records)
+
+
+def get_spawn_counts():
+    """
+    Retrieves the number of processes spawned per executable.
+        :returns: the executable to count mapping
+        :rtype: dict
+    """
+    counts = {}
+    for record in get_cmd_records():
+        exe = record.get_executable()
+        counts[exe] = counts.get(exe, 0) + 1
+    return counts
+
+
+def get_cmd_records():
+    """
+    Retrieves the records of all executed commands.
+        :returns: a copy of the list of records in execution order
+        :rtype: list
+    """
+    with _records_lock:
+        return list(_cmd_records)
+
+
+def get_cmd_totals():
+    """
+    Retrieves the accumulated resource usage per executable.
+        :returns: the executable to totals (dict) mapping
+        :rtype: dict
+    """
+    totals = {}
+    for record in get_cmd_records():
+        total = totals.setdefault(record.get_executable(), {
+            'count': 0, 'wall_time': 0.0, 'user_time': 0.0,
+            'sys_time': 0.0, 'max_rss': 0, 'out_bytes': 0})
+        total['count'] += 1
+        total['wall_time'] += record.wall_time
+        total['user_time'] += record.user_time
+        total['sys_time'] += record.sys_time
+        total['max_rss'] = max(total['max_rss'], record.max_rss)
+        total['out_bytes'] += record.out_bytes
+    return totals
+
+
+def log_cmd_profile(flags, count):
+    """
+    Prints the slowest executed commands and the totals per executable.
+        :param flags:
+        :type flags: dict
+        :param count: the number of slowest commands to print
+        :type count: int
+    """
+    log(flags, "\nSlowest commands:", TextType.INFO)
+    for record in sorted(get_cmd_records(), key=lambda r: r.wall_time,
+                         reverse=True)[:count]:
+        log(flags, "{:9.3f}s (user {:.3f}s, sys {:.3f}s, {} KiB, "
+                   "exit {}) {}".format(record.wall_time, record.user_time,
+                                        record.sys_time, record.max_rss,
+                                        record.exit_code,
+                                        _CMD_DEL.join(record.cmd)),
+            TextType.INFO)
+
+    log(flags, "\nTotals per executable:", TextType.INFO)
+    for exe, total in sorted(get_cmd_totals().items(),
+                             key=lambda t: t[1]['wall_time'], reverse=True):
+        log(flags, "{:9.3f}s (user {:.3f}s, sys {:.3f}s, {} KiB, "
+                   "{} runs) {}".format(total['wall_time'],
+                                        total['user_time'],
+                                        total['sys_time'], total['max_rss'],
+                                        total['count'], exe), TextType.INFO)
+
+
+def dump_cmd_records(file_path):
+    """
+    Writes the command records and totals per executable as JSON.
+        :param file_path: the path of the JSON file
+        :type file_path: str
+    """
+    with open(file_path, 'w') as file_:
+        dump({'commands': [r.to_dict() for r in get_cmd_records()],
+              'totals': get_cmd_totals()}, file_, indent=2)
+
+
+############################ Tracing Tools ##############################
+#########################################################################
+### This section defines functions for tracing the execution phases.
+#########################################################################
+
+# Origin of the trace timestamps.
+_TRACE_ORIGIN = perf_counter()
+
+# Spans currently open per thread.
+_span_local = local()
+
+# All opened spans in order.
+_spans = []
+
+
+def _get_span_stack():
+    """ Returns the spans currently open in this thread, innermost last. """
+    try:
+        return _span_local.stack
+    except AttributeError:
+        _span_local.stack = []
+        return _span_local.stack
 
-def exec_cmd(cmd):
+
+def get_current_span():
+    """
+    Retrieves the innermost span open in the current thread.
+        :returns: the span or None if no span is open
+        :rtype: Span
+    """
+    stack = _get_span_stack()
+    return stack[-1] if stack else None
+
+
+def _run_in_span(span, func):
+    """
+    Calls a function, in another thread than the one which opened the
+    given span, as if within that span so that its commands and spans
+    are attached to it.
+    Returns the result of the function.
+    """
+    stack = _get_span_stack()
+    if span is not None:
+        stack.append(span)
+    try:
+        return func()
+    finally:
+        if span is not None:
+            stack.remove(span)
+
+
+class Span(object):
+    """
+    A named and timed phase of the execution, used as a context manager.
+    Spans opened within another span are nested in it and the commands
+    executed while a span is open are attached to the innermost span.
+    Spans are tracked per thread.
+    """
+
+    def __init__(self, name, **args):
+        """
+        Creates a span, timing starts when it is entered.
+            :param name: the span name
+            :type name: str
+            :param args: extra values to show in the trace
+        """
+        self.name = name
+        self.args = args
+        self.parent = None
+        self.start = None
+        self.end = None
+        self.records = []
+        self.thread = None
+
+    def __enter__(self):
+        stack = _get_span_stack()
+        self.parent = stack[-1] if stack else None
+        self.thread = get_ident()
+        stack.append(self)
+        with _records_lock:
+            _spans.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = perf_counter()
+        _get_span_stack().remove(self)
+        return False
+
+
+def _get_trace_time(time_):
+    """ Converts a perf counter time to trace microseconds. """
+    return round((time_ - _TRACE_ORIGIN) * 1000000)
+
+
+def dump_trace(file_path):
+    """
+    Writes the spans and executed commands as a Chrome trace_event file,
+    which can be loaded in a trace viewer (e.g. chrome://tracing).
+    Spans of the main thread are shown on the first thread, spans of
+    other threads and commands on the following threads, overlapping
+    commands are spread over several threads.
+        :param file_path: the path of the JSON file
+        :type file_path: str
+    """
+    now = perf_counter()
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+               'args': {'name': 'gbpx'}},
+              {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+               'args': {'name': 'phases'}}]
+
+    with _records_lock:
+        spans = [(span, list(span.records)) for span in _spans]
+        records = list(_cmd_records)
+
+    # Thread ids of the span threads, the main thread first.
+    span_tids = {main_thread().ident: 0}
+    for span, span_records in spans:
+        if span.thread not in span_tids:
+            span_tids[span.thread] = -len(span_tids)
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                           'tid': span_tids[span.thread],
+                           'args': {'name': 'background phases'}})
+        end = span.end if span.end is not None else now
+        args = dict(span.args)
+        args['commands'] = len(span_records)
+        args['command_wall_time'] = sum(r.wall_time for r in span_records)
+        args['command_cpu_time'] = sum(r.user_time + r.sys_time
+                                       for r in span_records)
+        events.append({'name': span.name, 'cat': 'phase', 'ph': 'X',
+                       'pid': 1, 'tid': span_tids[span.thread],
+                       'ts': _get_trace_time(span.start),
+                       'dur': _get_trace_time(end) -
+                              _get_trace_time(span.start),
+                       'args': args})
+
+    # Place each command on the first thread free at its start.
+    thread_ends = []
+    for record in sorted(records, key=lambda r: r.start):
+        end = record.start + record.wall_time \
+            if record.exit_code is not None else now
+        thread = next((i for i, t in enumerate(thread_ends)
+                       if t <= record.start), len(thread_ends))
+        if thread == len(thread_ends):
+            thread_ends.append(end)
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                           'tid': thread + 1,
+                           'args': {'name': 'commands'}})
+        else:
+            thread_ends[thread] = end
+        events.append({'name': record.get_executable(), 'cat': 'command',
+                       'ph': 'X', 'pid': 1, 'tid': thread + 1,
+                       'ts': _get_trace_time(record.start),
+                       'dur': _get_trace_time(end) -
+                              _get_trace_time(record.start),
+                       'args': record.to_dict()})
+
+    with open(file_path, 'w') as file_:
+        dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file_)
+
+
+class CmdProcess(object):
+    """
+    A long-lived command answering every request line written to its
+    standard input with one response line on its standard output.
+    The process is started on creation and kept until closed.
+    Errors will be raised as CommandError.
+    """
+
+    def __init__(self, cmd):
+        """
+        Starts the command process.
+            :param cmd: list of the executable followed by the arguments
+            :type cmd: list
+            :raises: CommandError
+        """
+        self._cmd = cmd
+        try:
+            self._proc, self._record = _start_cmd(cmd, stdin=PIPE,
+                                                  stdout=PIPE,
+                                                  stderr=DEVNULL)
+        except (OSError, ValueError) as err:
+            raise CommandError(_CMD_DEL.join(cmd), "",
+                               "\nError message:\n" + str(err))
+        _open_processes.append(self)
+
+    def is_alive(self):
+        """ Checks whether the process is still running. """
+        return self._proc.poll() is None
+
+    def request(self, line):
+        """
+        Writes a request line and reads the response line.
+        Errors will be raised as CommandError (if the process has exited).
+            :param line: the request without line break
+            :type line: str
+            :returns: the response without line break
+            :rtype: str
+        """
+        try:
+            self._proc.stdin.write((line + "\n").encode("utf-8"))
+            self._proc.stdin.flush()
+            response = self._proc.stdout.readline()
+            self._record.out_bytes += len(response)
+        except (OSError, ValueError) as err:
+            raise CommandError(_CMD_DEL.join(self._cmd), "",
+                               "\nError message:\n" + str(err))
+        if not response:
+            raise CommandError(_CMD_DEL.join(self._cmd), "",
+                               "The process exited unexpectedly")
+        return response.decode("utf-8").rstrip("\n")
+
+    def read(self, size):
+        """
+        Reads exactly size bytes of data following a response,
+        for commands answering with a header line and a data block.
+        Errors will be raised as CommandError (if the process has exited).
+            :returns: the data
+            :rtype: bytes
+        """
+        chunks = []
+        try:
+            while size > 0:
+                chunk = self._proc.stdout.read(size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size -= len(chunk)
+        except (OSError, ValueError) as err:
+            raise CommandError(_CMD_DEL.join(self._cmd), "",
+                               "\nError message:\n" + str(err))
+        if size > 0:
+            raise CommandError(_CMD_DEL.join(self._cmd), "",
+                               "The process exited unexpectedly")
+        data = b"".join(chunks)
+        self._record.out_bytes += len(data)
+        return data
+
+    def close(self):
+        """ Closes the standard input and waits for the process to exit. """
+        if self in _open_processes:
+            _open_processes.remove(self)
+        try:
+            self._proc.stdin.close()
+            self._proc.stdout.close()
+            _wait_cmd(self._proc, self._record)
+        except (OSError, ValueError):
+            _kill_cmd(self._proc, self._record)
+
+
+@register
+def close_cmd_processes():
+    """ Closes all long-lived command processes still running. """
+    for proc in list(_open_processes):
+        proc.close()
+
+
+def exec_cmd(cmd, std_input=None, env=None, raw=False):
     """
     Executes a shell command.
     Errors will be raised as CommandError.
     Returns the command output.
-    - cmd   -- list of the executable followed by the arguments.
+    - cmd       -- list of the executable followed by the arguments.
+    - std_input -- text to write to the standard input of the command.
+    - env       -- extra environment variables for the command.
+    - raw       -- return the output without stripping it (e.g. NUL
+                   separated paths).
     """
     std_output, std_err_output = '', ''
-    proc = None
+    proc = record = None
     try:
-        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        std_output, std_err_output = proc.communicate()
+        proc, record = _start_cmd(
+            cmd, stdin=PIPE if std_input is not None else None,
+            stdout=PIPE, stderr=PIPE,
+            env=dict(environ, **env) if env is not None else None)
+        std_out_data, std_err_data = [], []
+        for pipe, data in _read_pipes(
+                proc, record,
+                std_input.encode("utf-8") if std_input is not None else None):
+            (std_out_data if pipe is proc.stdout else std_err_data).append(
+                data)
+        _wait_cmd(proc, record)
         # Decode
-        std_output = std_output.decode("utf-8")
-        std_err_output = std_err_output.decode("utf-8")
+        std_output = b"".join(std_out_data).decode("utf-8")
+        std_err_output = b"".join(std_err_data).decode("utf-8")
     except (OSError, ValueError) as err:
         if proc is not None:
-            proc.kill()
+            _kill_cmd(proc, record)
         raise CommandError(_CMD_DEL.join(cmd), std_output,
                            std_err_output + "\nError message:\n" + str(err))
 
+    return _get_cmd_output(cmd, std_output, std_err_output, proc.returncode,
+                           raw)
+
+
+def _get_cmd_output(cmd, std_output, std_err_output, returncode, raw=False):
+    """
+    Checks the result of an executed command.
+    Errors will be raised as CommandError.
+    Returns the command output, stripped unless raw.
+    """
     if ('fatal' in std_output) or (
-                'fatal' in std_err_output) or proc.returncode >= 1:
+                'fatal' in std_err_output) or returncode >= 1:
         # Handle error case
         raise CommandError(_CMD_DEL.join(cmd), std_output, std_err_output)
+    elif raw:
+        return std_output
     else:
         # Success!
         return std_output.strip()
 
 
-def exec_piped_cmds(cmd1, cmd2):
+async def exec_cmd_async(cmd, std_input=None, env=None):
     """
-    Executes a two piped shell commands.
+    Coroutine executing a shell command without blocking the event loop.
+    The resource usage of the command is not recorded, only its time.
     Errors will be raised as CommandError.
     Returns the command output.
-    - cmd1, cmd2    -- list of the executable followed by the arguments.
+    - cmd       -- list of the executable followed by the arguments.
+    - std_input -- text to write to the standard input of the command.
+    - env       -- extra environment variables for the command.
     """
-    std_output, std_err_output = "", ""
-    proc1 = proc2 = None
+    std_output, std_err_output = '', ''
+    proc = None
+    record = CmdRecord(cmd)
     try:
-        proc1 = Popen(cmd1, stdout=PIPE)
-        proc2 = Popen(cmd2, stdin=proc1.stdout,
-                      stdout=PIPE, stderr=PIPE)
-        # Allow p1 to receive a SIGPIPE if p2 exits.
-        proc1.stdout.close()
-        std_output, std_err_output = proc2.communicate()
+        proc = await create_subprocess_exec(
+            *cmd, stdin=PIPE if std_input is not None else None,
+            stdout=PIPE, stderr=PIPE,
+            env=dict(environ, **env) if env is not None else None)
+        _add_cmd_record(record)
+        std_output, std_err_output = await proc.communicate(
+            std_input.encode("utf-8") if std_input is not None else None)
+        record.out_bytes = len(std_output) + len(std_err_output)
+        record.finish(proc.returncode)
         # Decode
         std_output = std_output.decode("utf-8")
         std_err_output = std_err_output.decode("utf-8")
+    except CancelledError:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            record.finish(await proc.wait())
+        raise
     except (OSError, ValueError) as err:
-        if proc1 is not None:
-            proc1.kill()
-        if proc2 is not None:
-            proc2.kill()
-        raise CommandError(_CMD_DEL.join(cmd1) + " | " + _CMD_DEL.join(cmd2),
-                           std_output,
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            record.finish(await proc.wait())
+        raise CommandError(_CMD_DEL.join(cmd), std_output,
                            std_err_output + "\nError message:\n" + str(err))
 
-    if ('fatal' in std_output) or (
-                'fatal' in std_err_output) or proc2.returncode >= 1:
+    return _get_cmd_output(cmd, std_output, std_err_output, proc.returncode)
+
+
+def exec_concurrently(jobs, max_jobs=_MAX_JOBS):
+    """
+    Executes independent jobs concurrently, at most max_jobs at a time.
+    A job is either a command (list of the executable followed by the
+    arguments) executed as with exec_cmd, or a function without arguments
+    called in a separate thread.
+    All jobs are run to completion before the first error (in job order)
+    is raised, so that no job is left running.
+    Returns the list of command outputs and function results in job order.
+    - jobs      -- the commands and functions to execute.
+    - max_jobs  -- the maximum number of jobs running at the same time.
+    """
+
+    # Functions run in other threads, within the span of the caller.
+    span = get_current_span()
+
+    async def run_job(semaphore, job):
+        """ Runs a single job when the concurrency limit allows. """
+        async with semaphore:
+            if callable(job):
+                return await get_running_loop().run_in_executor(
+                    None, _run_in_span, span, job)
+            return await exec_cmd_async(job)
+
+    async def run_jobs():
+        """ Runs all jobs and collects the results and errors. """
+        semaphore = Semaphore(max_jobs)
+        return await gather(*[run_job(semaphore, job) for job in jobs],
+                            return_exceptions=True)
+
+    results = run_async(run_jobs())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def exec_cmd_streamed(cmd, line_callback=None, tail_lines=_TAIL_LINES):
+    """
+    Executes a shell command, passing each output line (stdout and stderr)
+    to a callback as it arrives instead of buffering all output.
+    Only the last lines are kept, for the returned output and errors.
+    Errors will be raised as CommandError.
+    Returns the last lines of the command output.
+    - cmd           -- list of the executable followed by the arguments.
+    - line_callback -- called with every output line, e.g. a logger.
+    - tail_lines    -- the number of output lines to keep.
+    """
+    std_out_tail = deque(maxlen=tail_lines)
+    std_err_tail = deque(maxlen=tail_lines)
+    fatal = False
+    proc = record = None
+    try:
+        proc, record = _start_cmd(cmd, stdout=PIPE, stderr=PIPE)
+        tails = {proc.stdout: std_out_tail, proc.stderr: std_err_tail}
+        partials = {proc.stdout: b"", proc.stderr: b""}
+        for pipe, data in _read_pipes(proc, record):
+            if data:
+                raw_lines = (partials[pipe] + data).split(b"\n")
+                partials[pipe] = raw_lines.pop()
+            else:
+                # End of stream, flush the unterminated line.
+                raw_lines = [partials[pipe]] if partials[pipe] else []
+            for raw_line in raw_lines:
+                line = raw_line.decode("utf-8", "replace")
+                # Detect failures as they are reported.
+                fatal = fatal or 'fatal' in line
+                tails[pipe].append(line)
+                if line_callback is not None:
+                    line_callback(line)
+        _wait_cmd(proc, record)
+    except (OSError, ValueError) as err:
+        if proc is not None:
+            _kill_cmd(proc, record)
+        raise CommandError(_CMD_DEL.join(cmd), "\n".join(std_out_tail),
+                           "\n".join(std_err_tail) +
+                           "\nError message:\n" + str(err))
+
+    if fatal or proc.returncode >= 1:
         # Handle error case
-        raise CommandError(_CMD_DEL.join(cmd1) + " | " + _CMD_DEL.join(cmd2),
-                           std_output, std_err_output)
+        raise CommandError(_CMD_DEL.join(cmd), "\n".join(std_out_tail),
+                           "\n".join(std_err_tail))
+    else:
+        # Success!
+        return "\n".join(std_out_tail).strip()
+
+
+def exec_cmd_lines(cmd):
+    """
+    Executes a shell command and yields its output line by line.
+    The command is killed if the caller stops iterating early.
+    Errors will be raised as CommandError.
+    - cmd   -- list of the executable followed by the arguments.
+    """
+    std_err_file = TemporaryFile()
+    try:
+        proc, record = _start_cmd(cmd, stdout=PIPE, stderr=std_err_file)
+    except (OSError, ValueError) as err:
+        std_err_file.close()
+        raise CommandError(_CMD_DEL.join(cmd), "",
+                           "\nError message:\n" + str(err))
+
+    completed = False
+    try:
+        for line in proc.stdout:
+            record.out_bytes += len(line)
+            yield line.decode("utf-8").rstrip("\n")
+        completed = True
+    finally:
+        proc.stdout.close()
+        if completed:
+            _wait_cmd(proc, record)
+        else:
+            _kill_cmd(proc, record)
+        std_err_file.seek(0)
+        std_err_output = std_err_file.read().decode("utf-8")
+        std_err_file.close()
+
+    if proc.returncode >= 1 or 'fatal' in std_err_output:
+        raise CommandError(_CMD_DEL.join(cmd), "", std_err_output)
+
+
+def exec_piped_cmds(cmd1, cmd2):
+    """
+    Executes a two piped shell commands.
+    Errors will be raised as CommandError.
+    Returns the command output.
+    - cmd1, cmd2    -- list of the executable followed by the arguments.
+    """
+    return exec_pipeline([cmd1, cmd2])
+
+
+def _get_stage_expr(stage):
+    """ Returns the text representation of a pipeline stage. """
+    return _CMD_DEL.join(stage) if not callable(stage) else \
+        getattr(stage, '__name__', "<filter>")
+
+
+def _run_filter(func, in_fd, out_fd, errors):
+    """
+    Runs a function pipeline stage, the file descriptors are closed after.
+    Any error is added to the errors list.
+    """
+    try:
+        with open(in_fd, 'rb') if in_fd is not None else \
+                open(devnull, 'rb') as in_file, \
+                open(out_fd, 'wb') as out_file:
+            func(in_file, out_file)
+    except BrokenPipeError:
+        # The next stage has stopped reading.
+        pass
+    except Exception as err:
+        errors.append(err)
+
+
+def exec_pipeline(stages, out_path=None):
+    """
+    Executes a pipeline, connecting the output of each stage to the input
+    of the next. Command stages are connected file descriptor to file
+    descriptor so no data passes through this process.
+    A stage can also be a function called in a separate thread with a binary
+    input and output file object, e.g. to filter a tar stream.
+    A stage killed by SIGPIPE is not considered failed, since it is the
+    result of a later stage not reading all input.
+    Errors will be raised as PipelineError with the status and error output
+    of every failed stage.
+    Returns the pipeline output, empty if written to a file.
+    - stages    -- list of commands (list of the executable followed by the
+                   arguments) and functions taking (in_file, out_file).
+    - out_path  -- the file to write the pipeline output to.
+    """
+    expr = " | ".join([_get_stage_expr(stage) for stage in stages])
+    cmds = []
+    filters = []
+    in_fd = None
+    std_output = b""
+    try:
+        for i, stage in enumerate(stages):
+            if i < len(stages) - 1 or out_path is None:
+                read_fd, write_fd = pipe()
+            else:
+                read_fd, write_fd = None, open_fd(
+                    out_path, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+
+            if callable(stage):
+                # The thread takes over the file descriptors.
+                errors = []
+                thread = Thread(target=_run_filter,
+                                args=(stage, in_fd, write_fd, errors))
+                in_fd = None
+                thread.start()
+                filters.append((stage, thread, errors))
+            else:
+                err_file = TemporaryFile()
+                try:
+                    proc, record = _start_cmd(
+                        stage, stdin=in_fd if in_fd is not None else DEVNULL,
+                        stdout=write_fd, stderr=err_file)
+                except (OSError, ValueError):
+                    err_file.close()
+                    if read_fd is not None:
+                        close(read_fd)
+                    raise
+                finally:
+                    close(write_fd)
+                    if in_fd is not None:
+                        close(in_fd)
+                        in_fd = None
+                cmds.append((stage, proc, record, err_file))
+            in_fd = read_fd
+
+        # Read the pipeline output.
+        if in_fd is not None:
+            with open(in_fd, 'rb') as out_file:
+                in_fd = None
+                std_output = out_file.read()
+            if not callable(stages[-1]):
+                # The output of the last stage command.
+                cmds[-1][2].out_bytes += len(std_output)
+    except (OSError, ValueError) as err:
+        if in_fd is not None:
+            close(in_fd)
+        for _, proc, record, err_file in cmds:
+            _kill_cmd(proc, record)
+            err_file.close()
+        for _, thread, _ in filters:
+            thread.join()
+        raise PipelineError(expr, "", [(expr, None, str(err))])
+
+    # Wait for all stages and collect the failed ones.
+    failed = []
+    for stage, proc, record, err_file in cmds:
+        _wait_cmd(proc, record)
+        err_file.seek(0)
+        std_err_output = err_file.read().decode("utf-8", "replace")
+        err_file.close()
+        if 'fatal' in std_err_output or proc.returncode >= 1 or \
+                (proc.returncode < 0 and proc.returncode != -SIGPIPE):
+            failed.append((_get_stage_expr(stage), proc.returncode,
+                           std_err_output))
+    for stage, thread, errors in filters:
+        thread.join()
+        if errors:
+            failed.append((_get_stage_expr(stage), None, str(errors[0])))
+
+    std_output = std_output.decode("utf-8", "replace")
+    if failed or 'fatal' in std_output:
+        # Handle error case
+        raise PipelineError(expr, std_output, failed)
     else:
         # Success!
         return std_output.strip()
 
 
+########################## Compression Tools ############################
+#########################################################################
+### This section defines compressors usable as pipeline stages.
+#########################################################################
+
+class Compression(Enum):
+    """ Compression method identifiers. """
+    GZIP = 'gzip'
+    PIGZ = 'pigz'
+    XZ = 'xz'
+    ZSTD = 'zstd'
+    ZLIB = 'zlib'
+
+
+# File extensions of the compression methods.
+_COMPRESSION_EXT = {
+    Compression.GZIP: ".gz",
+    Compression.PIGZ: ".gz",
+    Compression.XZ: ".xz",
+    Compression.ZSTD: ".zst",
+    Compression.ZLIB: ".gz"
+}
+
+# Size of the blocks compressed in parallel (as pigz).
+_ZLIB_BLOCK_SIZE = 131072
+
+# Size of the preceding data used as dictionary for a block.
+_ZLIB_DICT_SIZE = 32768
+
+_ZLIB_LEVEL = 6
+
+# Gzip header without file name and time.
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03"
+
+
+def get_cpu_count():
+    """ Retrieves the number of CPUs available to this process. """
+    return len(sched_getaffinity(0))
+
+
+def get_compression_ext(compression):
+    """
+    Retrieves the file extension of a compression method.
+        :param compression: the compression method
+        :type compression: Compression
+        :rtype: str
+    """
+    return _COMPRESSION_EXT[compression]
+
+
+def get_compression_exts():
+    """ Retrieves the file extensions of all compression methods. """
+    return sorted(set(_COMPRESSION_EXT.values()))
+
+
+def get_compressor(compression, threads=None):
+    """
+    Creates a pipeline stage (see exec_pipeline) compressing its input.
+    The gzip based methods do not store any file name or time, so that
+    equal input gives equal output.
+        :param compression: the compression method
+        :type compression: Compression
+        :param threads: the number of threads, all available CPUs if None
+        :type threads: int
+        :returns: a command or a filter function
+    """
+    threads = threads if threads is not None else get_cpu_count()
+    if compression == Compression.PIGZ:
+        return ["pigz", "-n", "-c", "-p", str(threads)]
+    elif compression == Compression.XZ:
+        return ["xz", "-c", "-T", str(threads)]
+    elif compression == Compression.ZSTD:
+        return ["zstd", "-q", "-c", "-T{}".format(threads)]
+    elif compression == Compression.ZLIB:
+        return _get_zlib_compressor(threads)
+    return ["gzip", "-n", "-c"]
+
+
+def _compress_zlib_block(data, zdict, last):
+    """
+    Compresses a block as raw deflate data continuing a stream, ending
+    byte aligned (sync flush) unless it is the last block of the stream.
+    """
+    compressor = compressobj(_ZLIB_LEVEL, DEFLATED, -MAX_WBITS,
+                             zdict=zdict) if zdict else \
+        compressobj(_ZLIB_LEVEL, DEFLATED, -MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        Z_FINISH if last else Z_SYNC_FLUSH)
+
+
+def _get_zlib_compressor(threads):
+    """
+    Creates a filter function compressing to gzip in this process,
+    compressing blocks in parallel like pigz: every block is deflated
+    separately using the end of the preceding data as dictionary.
+    """
+
+    def compress_zlib(in_file, out_file):
+        """ Writes the input as a gzip stream. """
+        out_file.write(_GZIP_HEADER)
+        crc = size = 0
+        zdict = b""
+        pending = deque()
+        with ThreadPoolExecutor(threads) as executor:
+            block = in_file.read(_ZLIB_BLOCK_SIZE)
+            while True:
+                next_block = in_file.read(_ZLIB_BLOCK_SIZE)
+                last = not next_block
+                crc = crc32(block, crc)
+                size += len(block)
+                pending.append(executor.submit(_compress_zlib_block, block,
+                                               zdict, last))
+                zdict = (zdict + block)[-_ZLIB_DICT_SIZE:]
+                # Write in order, keeping a bounded number of blocks queued.
+                while pending and (last or len(pending) > 2 * threads):
+                    out_file.write(pending.popleft().result())
+                if last:
+                    break
+                block = next_block
+        out_file.write(pack("<II", crc & 0xffffffff, size & 0xffffffff))
+
+    return compress_zlib
+
+
 def exec_editor(editor_cmd, _file):
     """
     Opens a shell text editor.
     - _file   -- File to be opened.
     """
     try:
-        check_call([editor_cmd, _file])
+        proc, record = _start_cmd([editor_cmd, _file])
+        _wait_cmd(proc, record)
+        if proc.returncode != 0:
+            raise CommandError(editor_cmd + " " + _file, "",
+                               "The editor exited with status {}".format(
+                                   proc.returncode))
     except (OSError, ValueError) as err:
         raise CommandError(editor_cmd + " " + _file, "",
                            "\nError message:\n" + str(err))
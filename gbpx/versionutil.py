@@ -0,0 +1,194 @@
+"""
+versionutil module:
+Contains Debian version parsing and comparison.
+Versions are ordered as by 'dpkg --compare-versions' without
+spawning dpkg.
+"""
+from functools import lru_cache, total_ordering
+from heapq import nlargest
+from os import path
+from re import compile as re_compile
+
+# Number of parsed version keys kept in memory.
+_KEY_CACHE_SIZE = 4096
+
+# Alternating non-digit and digit parts of a version.
+_PART_PATTERN = re_compile(r"(\D*)(\d*)")
+
+# Key of a missing part, where the shorter version ends.
+_END_PART = ((0,), 0)
+
+
+def _get_char_weight(char):
+    """
+    Returns the dpkg sort weight of a character,
+    '~' sorts before the end of a part and letters before other characters.
+    """
+    if char == '~':
+        return -1
+    elif char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _get_part_key(version_part):
+    """
+    Returns a sort key for an upstream version or revision, comparing
+    non-digit parts by character weight and digit parts as numbers.
+    """
+    key = []
+    for non_digits, digits in _PART_PATTERN.findall(version_part):
+        if non_digits or digits:
+            key.append((tuple([_get_char_weight(char) for char in non_digits] +
+                              [0]), int(digits) if digits else 0))
+    # A zero part is equal to a missing part, e.g. '0' and ''.
+    while key and key[-1] == _END_PART:
+        key.pop()
+    key.append(_END_PART)
+    return tuple(key)
+
+
+def split_version(version_str):
+    """
+    Splits a version string ([<epoch>:]<upstream>[-<revision>])
+    into its parts. A missing epoch is 0 and a missing revision empty.
+    Returns a tuple (<epoch>, <upstream>, <revision>).
+    """
+    epoch, sep, rest = version_str.partition(':')
+    if not sep or not epoch.isdigit():
+        epoch, rest = "0", version_str
+    upstream, sep, revision = rest.rpartition('-')
+    if not sep:
+        upstream, revision = rest, ""
+    return int(epoch), upstream, revision
+
+
+@lru_cache(maxsize=_KEY_CACHE_SIZE)
+def get_version_key(version_str):
+    """
+    Returns a sort key for a version string,
+    keys compare like the versions do in dpkg.
+    """
+    epoch, upstream, revision = split_version(version_str)
+    return epoch, _get_part_key(upstream), _get_part_key(revision)
+
+
+@total_ordering
+class Version(object):
+    """
+    A Debian version ([<epoch>:]<upstream>[-<revision>]),
+    ordered as by dpkg.
+    """
+
+    __slots__ = ('version_str', '_key')
+
+    def __init__(self, version_str):
+        self.version_str = version_str
+        self._key = get_version_key(version_str)
+
+    @property
+    def epoch(self):
+        """ The epoch of the version, 0 if not set. """
+        return self._key[0]
+
+    @property
+    def upstream(self):
+        """ The upstream part of the version. """
+        return split_version(self.version_str)[1]
+
+    @property
+    def revision(self):
+        """ The debian revision of the version, empty if not set. """
+        return split_version(self.version_str)[2]
+
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key == other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key < other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __str__(self):
+        return self.version_str
+
+    def __repr__(self):
+        return "Version(" + repr(self.version_str) + ")"
+
+
+def compare_versions(ver1, ver2):
+    """
+    Compares two version strings.
+    Returns -1, 0 or 1 if the first is lesser, equal or greater.
+    """
+    key1 = get_version_key(ver1)
+    key2 = get_version_key(ver2)
+    return (key1 > key2) - (key1 < key2)
+
+
+def sort_versions(version_strs, reverse=False):
+    """
+    Sorts version strings, each version is parsed once.
+    Returns a new sorted list (lowest version first unless reversed).
+    """
+    return sorted(version_strs, key=get_version_key, reverse=reverse)
+
+
+def max_version(version_strs):
+    """
+    Finds the greatest of the version strings.
+    Returns the greatest version or None if there are none.
+    """
+    return max(version_strs, key=get_version_key, default=None)
+
+
+def _decorate(items, get_version_str):
+    """
+    Pairs each item with the sort key of its version, the item index
+    breaks ties so items are never compared. Items without a version
+    (None) are left out.
+    """
+    for index, item in enumerate(items):
+        version_str = get_version_str(item)
+        if version_str is not None:
+            yield get_version_key(version_str), index, item
+
+
+def sort_by_version(items, get_version_str, reverse=False):
+    """
+    Sorts items (e.g. tags or file names) on the version extracted from
+    each item, every version is extracted and parsed once.
+    Items for which get_version_str returns None are left out.
+    Returns a new sorted list (lowest version first unless reversed).
+    """
+    decorated = list(_decorate(items, get_version_str))
+    decorated.sort(reverse=reverse)
+    return [item for _, _, item in decorated]
+
+
+def get_latest_by_version(items, get_version_str, count=1):
+    """
+    Finds the items with the greatest versions without sorting them all.
+    Items for which get_version_str returns None are left out.
+    Returns a list of at most count items, greatest version first.
+    """
+    return [item for _, _, item in
+            nlargest(count, _decorate(items, get_version_str))]
+
+
+def get_file_version_str(file_path, extension=""):
+    """
+    Returns the version part of a file name (<name>_<version>[_...]),
+    e.g. a .changes file or a backup, or None if it has none.
+    The name is cut at the given extension first.
+    """
+    name = path.basename(file_path)
+    if extension:
+        name = name.partition(extension)[0]
+    parts = name.split('_')
+    return parts[1] if len(parts) > 1 and parts[1] else None
@@ -0,0 +1,6 @@
+import sys
+from os import path
+
+# The gbpx modules import each other as top level modules.
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(
+    __file__))), "gbpx"))
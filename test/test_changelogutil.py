@@ -0,0 +1,233 @@
+import unittest
+from json import load
+from os import path, utime, remove
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from unittest import mock
+
+from changelogutil import iter_changelog_entries, read_changelog_entries, \
+    get_changelog_entry, get_branch_changelog_entry, ChangelogError, \
+    get_changes, add_changelog_entry
+from ioutil import exec_cmd
+from gitutil import commit_changes, get_session
+from test.test_gitutil import GitRepositoryTestCase, _FLAGS, \
+    _SAFE_FLAGS
+
+_CHANGELOG = """\
+pkg (1:1.2-1) unstable experimental; urgency=medium, binary-only=yes
+
+  * Second release.
+    - With details.
+
+  * After a blank line.
+
+ -- Jane Doe <jane@example.com>  Mon, 02 Jan 2017 10:00:00 +0100
+
+# A comment between entries.
+
+pkg (1.1~rc1-1) UNRELEASED; urgency=low
+  * First release.
+ -- John Doe <john@example.com>  Sun, 01 Jan 2017 09:00:00 +0000
+Local variables:
+not parsed
+"""
+
+
+class ChangelogParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix="gbpx-test-changelog-")
+        self.file_path = path.join(self.dir, "changelog")
+        self.write(_CHANGELOG)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.file_path, 'w') as file_:
+            file_.write(text)
+
+    def test_entries(self):
+        entries = list(read_changelog_entries(self.file_path))
+        self.assertEqual(len(entries), 2)
+        entry = entries[0]
+        self.assertEqual((entry.source, entry.version, entry.distribution,
+                          entry.urgency),
+                         ("pkg", "1:1.2-1", "unstable experimental",
+                          "medium"))
+        self.assertEqual(entry.changes, ["  * Second release.",
+                                         "    - With details.", "",
+                                         "  * After a blank line."])
+        self.assertEqual(entry.maintainer, "Jane Doe <jane@example.com>")
+        self.assertEqual(entry.date, "Mon, 02 Jan 2017 10:00:00 +0100")
+        self.assertEqual((entries[1].version, entries[1].distribution,
+                          entries[1].urgency, entries[1].changes),
+                         ("1.1~rc1-1", "UNRELEASED", "low",
+                          ["  * First release."]))
+
+    def test_lazy(self):
+        # Only the lines of the entries taken are parsed.
+        lines = iter(_CHANGELOG.splitlines() + ["not a header"])
+        entries = iter_changelog_entries(lines)
+        self.assertEqual(next(entries).version, "1:1.2-1")
+        self.assertEqual(next(lines), "")
+        self.assertEqual(next(lines), "# A comment between entries.")
+
+    def test_errors(self):
+        for text in ["not a header\n",
+                     "pkg (1.0) unstable; urgency=low\n\n  * A\n",
+                     "pkg (1.0) unstable; urgency=low\n\n  * A\n -- bad\n"]:
+            self.write(text)
+            self.assertRaises(ChangelogError, list,
+                              read_changelog_entries(self.file_path))
+        self.write("\n")
+        self.assertRaises(ChangelogError, get_changelog_entry,
+                          self.file_path)
+        self.assertRaises(ChangelogError, get_changelog_entry,
+                          path.join(self.dir, "missing"))
+
+    def test_cached_until_modified(self):
+        self.assertEqual(get_changelog_entry(self.file_path).version,
+                         "1:1.2-1")
+        self.write(_CHANGELOG.replace("1:1.2-1", "1:1.3-1"))
+        utime(self.file_path, (1, 1))
+        self.assertEqual(get_changelog_entry(self.file_path).version,
+                         "1:1.3-1")
+
+    @unittest.skipUnless(which("dpkg-parsechangelog"),
+                         "dpkg-parsechangelog is not installed")
+    def test_same_as_dpkg(self):
+        entry = get_changelog_entry(self.file_path)
+        fields = dict(line.split(": ", 1) for line in exec_cmd(
+            ["dpkg-parsechangelog", "-l", self.file_path]).splitlines()
+            if ": " in line and not line.startswith(" "))
+        self.assertEqual(fields['Source'], entry.source)
+        self.assertEqual(fields['Version'], entry.version)
+        self.assertEqual(fields['Distribution'], entry.distribution)
+        self.assertEqual(fields['Urgency'], entry.urgency)
+        self.assertEqual(fields['Maintainer'], entry.maintainer)
+        self.assertEqual(fields['Date'], entry.date)
+
+
+class BranchChangelogTestCase(GitRepositoryTestCase):
+    def test_branch_entry(self):
+        with open(path.join(self.rep_dir, "changelog"), 'w') as file_:
+            file_.write(_CHANGELOG)
+        commit_changes(_FLAGS, "Add changelog")
+        exec_cmd(["git", "checkout", "-q", "-b", "other"])
+        self.assertEqual(get_branch_changelog_entry(
+            "master", "changelog").version, "1:1.2-1")
+        self.assertRaises(ChangelogError, get_branch_changelog_entry,
+                          "master", "debian/changelog")
+
+
+class ChangesTestCase(GitRepositoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.base = self.commit("base")
+
+    def get_state_path(self):
+        return path.join(get_session().common_dir, "gbpx", "changelog.json")
+
+    def fresh_changes(self):
+        remove(self.get_state_path())
+        return get_changes(self.base)
+
+    def test_incremental_with_merge(self):
+        exec_cmd(["git", "checkout", "-q", "-b", "side"])
+        with mock.patch.dict("os.environ",
+                             GIT_AUTHOR_DATE="2001-01-01T00:00:00",
+                             GIT_COMMITTER_DATE="2001-01-01T00:00:00"):
+            self.commit("side1")
+        exec_cmd(["git", "checkout", "-q", "master"])
+        self.commit("main1")
+        self.assertEqual(get_changes(self.base), [("Test", "main1")])
+        # The side commit is older than the last read commit.
+        exec_cmd(["git", "merge", "-q", "--no-ff", "-m", "Merge", "side"])
+        self.commit("main2")
+        changes = get_changes(self.base)
+        self.assertEqual(changes, [("Test", "main1"), ("Test", "side1"),
+                                   ("Test", "main2")])
+        # A fresh walk has the same commits, ordered by date.
+        fresh = self.fresh_changes()
+        self.assertEqual(sorted(fresh), sorted(changes))
+        self.assertEqual(get_changes(self.base), fresh)
+
+    def test_rewritten_history(self):
+        self.commit("main1")
+        self.assertEqual(get_changes(self.base), [("Test", "main1")])
+        exec_cmd(["git", "reset", "-q", "--hard", self.base])
+        self.commit("main2")
+        self.assertEqual(get_changes(self.base), [("Test", "main2")])
+        self.assertEqual(len(get_changes()), 3)
+
+    def test_branches(self):
+        self.commit("main1")
+        self.assertEqual(get_changes(self.base), [("Test", "main1")])
+        exec_cmd(["git", "checkout", "-q", "-b", "other", self.base])
+        self.commit("other1")
+        self.assertEqual(get_changes(self.base), [("Test", "other1")])
+        exec_cmd(["git", "checkout", "-q", "master"])
+        self.assertEqual(get_changes(self.base), [("Test", "main1")])
+        self.assertEqual(get_changes(self.base), self.fresh_changes())
+
+    def test_state_per_branch(self):
+        self.commit("main1")
+        get_changes(self.base)
+        release = self.commit("main2")
+        self.assertEqual(get_changes(release), [])
+        self.commit("main3")
+        self.assertEqual(get_changes(release), [("Test", "main3")])
+        with open(self.get_state_path()) as state_file:
+            state = load(state_file)
+        self.assertEqual(list(state), ["master"])
+        self.assertEqual(state["master"]["since"], release)
+
+
+class AddEntryTestCase(GitRepositoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file_path = path.join(self.rep_dir, "changelog")
+        with open(self.file_path, 'w') as file_:
+            file_.write(_CHANGELOG.replace("unstable experimental",
+                                           "UNRELEASED"))
+
+    def parse(self):
+        return exec_cmd(["dpkg-parsechangelog", "-l", self.file_path])
+
+    @unittest.skipUnless(which("dpkg-parsechangelog"),
+                         "dpkg-parsechangelog is not installed")
+    @mock.patch.dict("os.environ", DEBFULLNAME="Jane Doe",
+                     DEBEMAIL="jane@example.com")
+    def test_entry(self):
+        changes = [("Test", "A change"), ("Other", "Another " * 20)]
+        add_changelog_entry(_FLAGS, "1:1.3-1", changes, urgency="medium",
+                            file_path=self.file_path)
+        output = self.parse()
+        for field in ["Version: 1:1.3-1", "Distribution: UNRELEASED",
+                      "Urgency: medium",
+                      "Maintainer: Jane Doe <jane@example.com>",
+                      "   [ Test ]", "   * A change", "   [ Other ]"]:
+            self.assertIn(field, output.splitlines())
+        self.assertEqual(len(list(read_changelog_entries(self.file_path))),
+                         3)
+
+        # The same version is replaced, released to the latest released
+        # distribution.
+        add_changelog_entry(_FLAGS, "1:1.3-1", [], release=True,
+                            file_path=self.file_path)
+        output = self.parse()
+        self.assertIn("Distribution: UNRELEASED", output.splitlines())
+        entries = list(read_changelog_entries(self.file_path))
+        self.assertEqual([entry.version for entry in entries],
+                         ["1:1.3-1", "1:1.2-1", "1.1~rc1-1"])
+        self.assertEqual(entries[0].changes, ["  * New release."])
+
+    def test_safemode(self):
+        add_changelog_entry(_SAFE_FLAGS, "1:1.3-1", [],
+                            file_path=self.file_path)
+        self.assertEqual(get_changelog_entry(self.file_path).version,
+                         "1:1.2-1")
+
+
+if __name__ == '__main__':
+    unittest.main()
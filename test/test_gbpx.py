@@ -1,7 +1,7 @@
 import unittest
 from os import path, chdir, listdir
 
-from gbpx.gbpx import execute_with
+from gbpx.gbpx import execute_with, _create_parser, _get_profile_count
 from gbpx.gbpxargs import Action, Flag
 from gbpx.gbpxutil import verify_create_head_tag
 from gbpx.gitutil import init_repository, create_branch, switch_branch, \
@@ -80,5 +80,21 @@ class CommitReleaseTestCase(unittest.TestCase):
         self.assertTrue(len(listdir(".")) == 3)
 
 
+class ArgumentParserTestCase(unittest.TestCase):
+    def parse(self, *args):
+        return _create_parser().parse_args(list(args))
+
+    def test_profile_before_action(self):
+        args = self.parse("--profile", "test-build")
+        self.assertEqual(args.action, Action.TEST_BUILD.value)
+        self.assertEqual(_get_profile_count(args), 10)
+
+    def test_profile_count(self):
+        args = self.parse("--profile-count", "3", "test-build", "/tmp")
+        self.assertEqual((args.action, args.dir), ("test-build", "/tmp"))
+        self.assertEqual(_get_profile_count(args), 3)
+        self.assertIsNone(_get_profile_count(self.parse("test-build")))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,422 @@
+import unittest
+from hashlib import md5, sha1, sha256
+from io import BytesIO
+from json import dump
+from os import path, getcwd, listdir, utime, makedirs, environ, chmod, \
+    pathsep
+from shutil import rmtree
+from tarfile import open as open_tar
+from tempfile import mkdtemp
+from threading import main_thread, current_thread
+from unittest import mock
+
+from gbpxutil import create_temp_commit, restore_temp_commit, BranchFiles, \
+    _evict_worktrees, _MAX_WORKTREES, ChecksumWriter, create_orig_tarball, \
+    ExcludeMatcher, get_orig_tarball, OpError, _evict_orig_cache, \
+    _ORIG_CACHE_MAX_SIZE, LintianStage
+from gitutil import get_head_commit, is_working_dir_clean, add_worktree, \
+    get_session, get_branch
+from ioutil import exec_cmd, Compression, CommandError, Span, \
+    get_cmd_records
+from test.test_gitutil import GitRepositoryTestCase, _FLAGS, _SAFE_FLAGS
+
+
+class TempCommitTestCase(GitRepositoryTestCase):
+    def make_dirty(self):
+        with open(path.join(self.rep_dir, "first"), 'a') as file_:
+            file_.write("changed\n")
+        with open(path.join(self.rep_dir, "untracked"), 'w') as file_:
+            file_.write("untracked\n")
+
+    def test_snapshot_round_trip(self):
+        head = get_head_commit("master")
+        self.make_dirty()
+        restore_data = create_temp_commit(_FLAGS)
+        self.assertNotEqual(get_head_commit("master"), head)
+        self.assertTrue(is_working_dir_clean(use_cache=False))
+
+        restore_temp_commit(_FLAGS, restore_data)
+        self.assertEqual(get_head_commit("master"), head)
+        self.assertFalse(is_working_dir_clean(use_cache=False))
+        self.assertIn("?? untracked", exec_cmd(["git", "status",
+                                                "--porcelain"]))
+        self.assertEqual(exec_cmd(["git", "for-each-ref", "refs/gbpx"]), "")
+
+    def test_safemode_round_trip(self):
+        head = get_head_commit("master")
+        self.make_dirty()
+        status = exec_cmd(["git", "status", "--porcelain"])
+        restore_data = create_temp_commit(_SAFE_FLAGS)
+        self.assertIsNone(restore_data[2])
+        restore_temp_commit(_SAFE_FLAGS, restore_data)
+        self.assertEqual(get_head_commit("master"), head)
+        self.assertEqual(exec_cmd(["git", "status", "--porcelain"]), status)
+
+
+class WorktreeTestCase(GitRepositoryTestCase):
+    def setUp(self):
+        super().setUp()
+        exec_cmd(["git", "branch", "debian"])
+        self.wt_dir = mkdtemp(prefix="gbpx-test-wt-")
+
+    def tearDown(self):
+        rmtree(self.wt_dir)
+        super().tearDown()
+
+    def test_worktree_used(self):
+        branch_files = BranchFiles("debian", self.wt_dir)
+        branch_files.enter(_FLAGS)
+        try:
+            self.assertTrue(branch_files.is_worktree())
+            self.assertEqual(path.dirname(getcwd()),
+                             path.realpath(self.wt_dir))
+        finally:
+            branch_files.leave()
+        self.assertEqual(get_branch(), "master")
+
+    def test_safemode_checks_out(self):
+        branch_files = BranchFiles("debian", self.wt_dir)
+        branch_files.enter(_SAFE_FLAGS)
+        branch_files.leave()
+        self.assertFalse(branch_files.is_worktree())
+        # Nothing (worktrees or lock files) is written in safe mode.
+        self.assertEqual(listdir(self.wt_dir), [])
+
+    def test_other_repository_slots_kept(self):
+        # A slot of another repository with the same name, used least.
+        other_dir = mkdtemp(prefix="gbpx-test-other-")
+        try:
+            exec_cmd(["git", "init", "-q", other_dir])
+            exec_cmd(["git", "-C", other_dir, "commit", "-q",
+                      "--allow-empty", "-m", "other"])
+            other_slot = path.join(self.wt_dir, "debian.other")
+            exec_cmd(["git", "-C", other_dir, "worktree", "add", "-q",
+                      "--detach", other_slot])
+            utime(other_slot, (0, 0))
+
+            slots = [path.join(self.wt_dir, "debian." + str(slot))
+                     for slot in range(_MAX_WORKTREES + 1)]
+            for age, slot_path in enumerate(slots):
+                add_worktree(_FLAGS, slot_path, "master")
+                utime(slot_path, (age + 1, age + 1))
+
+            _evict_worktrees(_FLAGS, self.wt_dir, get_session().common_dir)
+            self.assertTrue(path.exists(other_slot))
+            self.assertFalse(path.exists(slots[0]))
+            self.assertTrue(all(path.exists(slot_path)
+                                for slot_path in slots[1:]))
+        finally:
+            rmtree(other_dir)
+
+
+class ExcludeMatcherTestCase(unittest.TestCase):
+    _PATTERNS = ["*.log", "!keep.log", "build/", "/top.txt", "doc/*.html",
+                 "logs/**", "**/cache", "a/**/z", "[Tt]emp?", "\\#hash",
+                 "\\!bang", "trailing\\ ", "# comment", ""]
+    _PATHS = [("x.log", False), ("sub/x.log", False), ("keep.log", False),
+              ("sub/keep.log", False), ("build", True), ("build", False),
+              ("sub/build", True), ("sub/build/f.c", False),
+              ("top.txt", False), ("sub/top.txt", False),
+              ("doc/a.html", False), ("doc/sub/a.html", False),
+              ("sub/doc/a.html", False), ("logs", True),
+              ("logs/a/b.txt", False), ("sub/logs/a", False),
+              ("cache", True), ("x/y/cache", False), ("a/z", False),
+              ("a/b/c/z", False), ("b/a/z", False), ("Temp1", False),
+              ("temp1", False), ("Temp12", False), ("#hash", False),
+              ("!bang", False), ("trailing ", False), ("trailing", False),
+              ("src/main.c", False), ("# comment", False)]
+
+    def test_git_semantics(self):
+        matcher = ExcludeMatcher(self._PATTERNS)
+        rep_dir = mkdtemp(prefix="gbpx-test-ignore-")
+        try:
+            exec_cmd(["git", "init", "-q", rep_dir])
+            with open(path.join(rep_dir, ".gitignore"), 'w') as ignore_file:
+                ignore_file.write("\n".join(self._PATTERNS) + "\n")
+            for file_path, is_dir in self._PATHS:
+                # A trailing '/' makes git check the path as a directory.
+                try:
+                    exec_cmd(["git", "-C", rep_dir, "check-ignore", "-q",
+                              "--no-index", file_path + ("/" if is_dir
+                                                         else "")])
+                    ignored = True
+                except CommandError:
+                    ignored = False
+                self.assertEqual(matcher.is_excluded(file_path, is_dir),
+                                 ignored, file_path)
+        finally:
+            rmtree(rep_dir)
+
+    def test_excluded_directory_contents(self):
+        matcher = ExcludeMatcher(["build/", "!build/keep"])
+        # Files of an excluded directory can not be included again.
+        self.assertTrue(matcher.is_excluded("build/keep"))
+        self.assertTrue(matcher.is_excluded("sub/build/a/b", False))
+        self.assertFalse(matcher.is_excluded("builds/a"))
+
+    def test_vcs(self):
+        matcher = ExcludeMatcher(["*.o"], exclude_vcs=True)
+        self.assertTrue(matcher.is_excluded(".git", True))
+        self.assertTrue(matcher.is_excluded("sub/.gitignore"))
+        self.assertTrue(matcher.is_excluded("a.o"))
+        self.assertFalse(ExcludeMatcher().is_excluded(".gitignore"))
+        self.assertEqual(ExcludeMatcher(["a", "#b", " "]).get_patterns(),
+                         ["a"])
+
+    def test_pathspecs(self):
+        self.assertIsNone(ExcludeMatcher(["*.log", "!keep.log"]).
+                          to_pathspecs())
+        self.assertEqual(ExcludeMatcher(["build/", "/top.txt", "\\#a"]).
+                         to_pathspecs(),
+                         [":(exclude,glob)**/build/**",
+                          ":(exclude,glob)top.txt",
+                          ":(exclude,glob)top.txt/**",
+                          ":(exclude,glob)**/#a",
+                          ":(exclude,glob)**/#a/**"])
+
+
+class PathspecTestCase(GitRepositoryTestCase):
+    def test_same_files_as_matcher(self):
+        patterns = ["*.log", "build/", "/top.txt", "doc/*.html", "logs/**",
+                    "**/cache", "a/**/z", "[Tt]emp?"]
+        file_paths = ["x.log", "sub/x.log", "build/f.c", "sub/build/f.c",
+                      "top.txt", "sub/top.txt", "doc/a.html",
+                      "doc/sub/a.html", "sub/doc/a.html", "logs/a/b.txt",
+                      "sub/logs/a", "cache/f", "x/cache/f", "a/z",
+                      "a/b/c/z", "b/a/z", "Temp1", "temp1", "Temp12",
+                      "src/main.c"]
+        for file_path in file_paths:
+            makedirs(path.dirname(path.join(self.rep_dir, file_path)),
+                     exist_ok=True)
+            with open(path.join(self.rep_dir, file_path), 'w') as file_:
+                file_.write(file_path)
+        self.commit("files")
+
+        matcher = ExcludeMatcher(patterns)
+        files = exec_cmd(["git", "ls-files", "--"] +
+                         matcher.to_pathspecs()).splitlines()
+        self.assertEqual(sorted(files),
+                         sorted(file_path for file_path in
+                                file_paths + ["first", "files"]
+                                if not matcher.is_excluded(file_path)))
+
+
+class ChecksumWriterTestCase(unittest.TestCase):
+    def test_checksums(self):
+        out_file = BytesIO()
+        writer = ChecksumWriter(out_file)
+        for data in [b"", b"abc", b"\0" * 100000]:
+            writer.write(data)
+        data = out_file.getvalue()
+        self.assertEqual(data, b"abc" + b"\0" * 100000)
+        self.assertEqual(writer.size, len(data))
+        self.assertEqual(writer.get_checksums(),
+                         {'md5': md5(data).hexdigest(),
+                          'sha1': sha1(data).hexdigest(),
+                          'sha256': sha256(data).hexdigest()})
+
+
+class TarballTestCase(GitRepositoryTestCase):
+    """ Adds release files to the repository and an output directory. """
+
+    def setUp(self):
+        super().setUp()
+        for file_path in ["src/main.c", "src/test/test.c", "README.md",
+                          "debian/rules"]:
+            makedirs(path.dirname(path.join(self.rep_dir, file_path)),
+                     exist_ok=True)
+            with open(path.join(self.rep_dir, file_path), 'w') as file_:
+                file_.write(file_path + "\n")
+        self.commit("second")
+        self.out_dir = mkdtemp(prefix="gbpx-test-tar-")
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+        super().tearDown()
+
+
+class OrigTarballTestCase(TarballTestCase):
+    def create(self, name, compression=Compression.GZIP, mtime=1000):
+        tar_path = path.join(self.out_dir, name)
+        size, checksums = create_orig_tarball(
+            "master", tar_path, "pkg-1.0/",
+            ExcludeMatcher(["debian/", "README.md", "test"]),
+            compression=compression, mtime=mtime)
+        with open(tar_path, 'rb') as tar_file:
+            data = tar_file.read()
+        self.assertEqual(size, len(data))
+        self.assertEqual(checksums['sha256'], sha256(data).hexdigest())
+        return data
+
+    def test_members(self):
+        data = self.create("pkg_1.0.orig.tar.gz")
+        with open_tar(fileobj=BytesIO(data), mode='r:gz') as tar:
+            members = tar.getmembers()
+            self.assertEqual(sorted(member.name for member in members),
+                             ["pkg-1.0", "pkg-1.0/first", "pkg-1.0/second",
+                              "pkg-1.0/src", "pkg-1.0/src/main.c"])
+            self.assertEqual(tar.extractfile("pkg-1.0/src/main.c").read(),
+                             b"src/main.c\n")
+        for member in members:
+            self.assertEqual((member.uid, member.gid, member.uname,
+                              member.gname, member.mtime),
+                             (0, 0, "root", "root", 1000))
+
+    def test_reproducible(self):
+        data = self.create("a.orig.tar.gz")
+        self.assertEqual(self.create("b.orig.tar.gz"), data)
+        self.assertNotEqual(self.create("c.orig.tar.gz", mtime=2000), data)
+        self.assertEqual(self.create("a.orig.tar.gz", Compression.ZLIB),
+                         self.create("b.orig.tar.gz", Compression.ZLIB))
+
+
+class OrigCacheTestCase(TarballTestCase):
+    def get(self, tar_path, cache_dir=None):
+        return get_orig_tarball(
+            cache_dir or path.join(self.out_dir, "cache"), "master",
+            tar_path, "pkg", "1.0", ExcludeMatcher(["debian/"]))
+
+    def test_cache_reused(self):
+        tar_path = path.join(self.out_dir, "pkg_1.0.orig.tar.gz")
+        size, sums, cached = self.get(tar_path)
+        self.assertFalse(cached)
+        self.assertEqual(self.get(tar_path), (size, sums, True))
+
+        # The tarball is a copy, changing it does not touch the cache.
+        with open(tar_path, 'wb') as tar_file:
+            tar_file.write(b"changed")
+        self.assertEqual(self.get(tar_path), (size, sums, True))
+        with open(tar_path, 'rb') as tar_file:
+            self.assertEqual(sha256(tar_file.read()).hexdigest(),
+                             sums['sha256'])
+
+    def test_file_errors(self):
+        cache_path = path.join(self.out_dir, "cache")
+        with open(cache_path, 'w') as cache_file:
+            cache_file.write("not a directory")
+        self.assertRaises(OpError, self.get,
+                          path.join(self.out_dir, "pkg_1.0.orig.tar.gz"))
+        self.assertRaises(OpError, self.get,
+                          path.join(self.out_dir, "missing", "a.tar.gz"),
+                          path.join(self.out_dir, "cache2"))
+
+    def test_eviction(self):
+        cache_dir = path.join(self.out_dir, "cache")
+        makedirs(cache_dir)
+
+        def add_entry(key, size, mtime, names):
+            for name in names:
+                with open(path.join(cache_dir, name), 'w') as file_:
+                    file_.write(name)
+            with open(path.join(cache_dir, key + ".json"), 'w') as file_:
+                dump({'size': size}, file_)
+            utime(path.join(cache_dir, key + ".json"), (mtime, mtime))
+
+        add_entry("old", _ORIG_CACHE_MAX_SIZE, 1,
+                  ["old.tar.gz", "old.tar.xz.123.tmp"])
+        # An entry with its tarball already removed by another process.
+        add_entry("gone", _ORIG_CACHE_MAX_SIZE, 2, [])
+        add_entry("kept", 10, 3, ["kept.tar.gz"])
+        _evict_orig_cache(cache_dir, "kept")
+        self.assertEqual(sorted(listdir(cache_dir)),
+                         ["kept.json", "kept.tar.gz", "old.tar.xz.123.tmp"])
+
+
+_FAKE_LINTIAN = """#!/bin/sh
+if [ "$1" = "--version" ]; then
+    echo "Lintian v2.0"
+    exit 0
+fi
+echo run >> "$(dirname "$0")/runs"
+echo "W: pkg: first-finding"
+echo "E: pkg: second-finding"
+exit 1
+"""
+
+
+class LintianStageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix="gbpx-test-lintian-")
+        bin_dir = path.join(self.dir, "bin")
+        makedirs(bin_dir)
+        lintian_path = path.join(bin_dir, "lintian")
+        with open(lintian_path, 'w') as file_:
+            file_.write(_FAKE_LINTIAN)
+        chmod(lintian_path, 0o755)
+        self.runs_path = path.join(bin_dir, "runs")
+        self.changes_path = path.join(self.dir, "pkg.changes")
+        with open(self.changes_path, 'w') as file_:
+            file_.write("Files:\n")
+        self.cache_dir = path.join(self.dir, "cache")
+        patcher = mock.patch.dict(
+            environ, PATH=bin_dir + pathsep + environ.get("PATH", ""))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logged = []
+        patcher = mock.patch(
+            "gbpxutil.log", lambda flags, text, *args: self.logged.append(
+                (current_thread(), text)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def get_runs(self):
+        if not path.exists(self.runs_path):
+            return 0
+        with open(self.runs_path) as file_:
+            return len(file_.readlines())
+
+    def run_stage(self, flags=_FLAGS):
+        stage = LintianStage(self.changes_path, self.cache_dir)
+        stage.start(flags)
+        stage._thread.join()
+        logged = len(self.logged)
+        return stage.wait(flags), logged
+
+    def test_findings_logged_on_wait(self):
+        result, logged = self.run_stage()
+        self.assertEqual(result, {'lines': ["W: pkg: first-finding",
+                                            "E: pkg: second-finding"],
+                                  'failed': True})
+        # Only the start message is logged before waiting.
+        self.assertEqual(logged, 1)
+        self.assertTrue(all(thread is main_thread()
+                            for thread, _ in self.logged))
+        texts = [text for _, text in self.logged]
+        self.assertEqual(texts[1:4], result['lines'] +
+                         ["Lintian finished with errors"])
+
+    def test_cached(self):
+        self.assertEqual(self.run_stage()[0], self.run_stage()[0])
+        self.assertEqual(self.get_runs(), 1)
+        with open(self.changes_path, 'a') as file_:
+            file_.write("changed\n")
+        self.run_stage()
+        self.assertEqual(self.get_runs(), 2)
+
+    def test_not_cached_in_safemode(self):
+        self.run_stage(_SAFE_FLAGS)
+        self.run_stage(_SAFE_FLAGS)
+        self.assertEqual(self.get_runs(), 2)
+
+    def test_unexpected_error_raised_on_wait(self):
+        with mock.patch("gbpxutil._get_lintian_cache_key",
+                        side_effect=ValueError("unexpected")):
+            self.assertRaises(ValueError, self.run_stage)
+
+    def test_records_in_own_span(self):
+        with Span("main") as main_span:
+            self.run_stage()
+        records = [record for record in get_cmd_records()
+                   if record.get_executable() == "lintian"]
+        self.assertTrue(records)
+        for record in records:
+            self.assertEqual(record.span.name, "lintian")
+            self.assertIsNot(record.span, main_span)
+            self.assertNotEqual(record.span.thread, main_span.thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
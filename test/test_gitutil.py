@@ -0,0 +1,290 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os import chdir, getcwd, path, stat, utime
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from gbpxargs import Flag
+from gitutil import GitError, get_head_tags, get_latest_tag, tag_head, \
+    delete_tag, invalidate_tag_index, commit_changes, get_head_commit, \
+    RefTransaction, delete_ref, resolve_rev, is_working_dir_clean, \
+    CleanCheck, get_session, get_tag_index, _sessions, commit_tree
+from ioutil import exec_cmd, get_spawn_count
+
+_FLAGS = {Flag.SAFEMODE: False, Flag.QUIET: True, Flag.VERBOSE: False,
+          Flag.COLOR: False}
+_SAFE_FLAGS = {Flag.SAFEMODE: True, Flag.QUIET: True, Flag.VERBOSE: False,
+               Flag.COLOR: False}
+
+
+class GitRepositoryTestCase(unittest.TestCase):
+    """ Runs each test in a new repository with one commit on master. """
+
+    def setUp(self):
+        self._start_dir = getcwd()
+        self.rep_dir = mkdtemp(prefix="gbpx-test-")
+        chdir(self.rep_dir)
+        exec_cmd(["git", "init", "-q"])
+        exec_cmd(["git", "symbolic-ref", "HEAD", "refs/heads/master"])
+        exec_cmd(["git", "config", "user.name", "Test"])
+        exec_cmd(["git", "config", "user.email", "test@example.com"])
+        self.commit("first")
+
+    def tearDown(self):
+        chdir(self._start_dir)
+        rmtree(self.rep_dir)
+
+    def commit(self, name):
+        with open(path.join(self.rep_dir, name), 'w') as file_:
+            file_.write(name + "\n")
+        commit_changes(_FLAGS, name)
+        return get_head_commit("master")
+
+
+class TagIndexTestCase(GitRepositoryTestCase):
+    def test_head_tags_sorted_on_version(self):
+        for tag in ["debian/1.0-10", "debian/1.0-2", "debian/1.0-1",
+                    "upstream/1.0"]:
+            tag_head(_FLAGS, "master", tag)
+        self.assertEqual(get_head_tags("master", "debian"),
+                         ["debian/1.0-1", "debian/1.0-2",
+                          "debian/1.0-10"])
+
+    def test_latest_tag_is_nearest(self):
+        tag_head(_FLAGS, "master", "upstream/2.0")
+        self.commit("second")
+        tag_head(_FLAGS, "master", "upstream/1.0")
+        self.commit("third")
+        # The closest tag is used, as by 'git describe', not the greatest.
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.0")
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         exec_cmd(["git", "describe", "--abbrev=0", "--tags",
+                                   "--match", "upstream/*"]))
+
+    def test_lookups_read_history_once(self):
+        tag_head(_FLAGS, "master", "upstream/1.0")
+        self.commit("second")
+        self.commit("third")
+        tag_index = get_tag_index()
+        self.assertEqual(tag_index.get_reachable_tag("master", "upstream"),
+                         "upstream/1.0")
+        # Ancestors are walked in memory without spawning processes.
+        count = get_spawn_count()
+        for rev in ["master~1", "master~2"]:
+            self.assertEqual(tag_index.get_reachable_tag(rev, "upstream"),
+                             "upstream/1.0")
+        self.assertEqual(get_spawn_count(), count)
+
+    def test_nearest_through_merge(self):
+        tag_head(_FLAGS, "master", "upstream/1.0")
+        exec_cmd(["git", "checkout", "-q", "-b", "side"])
+        self.commit("side")
+        tag_head(_FLAGS, "side", "upstream/0.9")
+        exec_cmd(["git", "checkout", "-q", "master"])
+        for name in ["second", "third"]:
+            self.commit(name)
+        exec_cmd(["git", "merge", "-q", "--no-ff", "-m", "Merge", "side"])
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/0.9")
+        # Several tags as close, the greatest version is used.
+        tag_head(_FLAGS, "master", "upstream/1.1")
+        tag_head(_FLAGS, "master", "upstream/1.10")
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.10")
+
+    def test_no_reachable_tag(self):
+        self.assertRaises(GitError, get_latest_tag, "master", "upstream")
+        tag_head(_FLAGS, "master", "debian/1.0-1")
+        self.assertRaises(GitError, get_latest_tag, "master", "upstream")
+
+    def test_lookup_after_ref_updates(self):
+        tag_head(_FLAGS, "master", "upstream/1.0")
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.0")
+
+        # Moving the branch and tagging updates the lookup.
+        self.commit("second")
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.0")
+        tag_head(_FLAGS, "master", "upstream/1.1")
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.1")
+
+        delete_tag(_FLAGS, "upstream/1.1")
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.0")
+
+        # Tags made by other programs are seen after invalidation.
+        exec_cmd(["git", "tag", "upstream/1.2"])
+        invalidate_tag_index()
+        self.assertEqual(get_latest_tag("master", "upstream"),
+                         "upstream/1.2")
+        self.assertEqual(get_head_tags("master", "upstream"),
+                         ["upstream/1.2"])
+
+
+class CleanCheckTestCase(GitRepositoryTestCase):
+    def write(self, name, content):
+        with open(path.join(self.rep_dir, name), 'w') as file_:
+            file_.write(content)
+
+    def test_strategies(self):
+        for strategy in CleanCheck:
+            self.assertTrue(is_working_dir_clean(strategy))
+        self.write("untracked", "new\n")
+        for strategy in CleanCheck:
+            self.assertFalse(is_working_dir_clean(strategy))
+        self.assertTrue(is_working_dir_clean(CleanCheck.DIFF_INDEX,
+                                             untracked=False))
+        self.write("first", "changed\n")
+        self.assertFalse(is_working_dir_clean(CleanCheck.DIFF_INDEX,
+                                              untracked=False))
+
+    def test_file_writes_not_cached(self):
+        self.assertTrue(is_working_dir_clean())
+        # Written without running git, the default check must see it.
+        self.write("untracked", "new\n")
+        self.assertFalse(is_working_dir_clean())
+
+    def test_cache_opt_in(self):
+        self.assertTrue(is_working_dir_clean(use_cache=True))
+        self.assertTrue(is_working_dir_clean(use_cache=True))
+        # Running a command drops the cached result.
+        self.write("untracked", "new\n")
+        exec_cmd(["git", "rev-parse", "HEAD"])
+        self.assertFalse(is_working_dir_clean(use_cache=True))
+
+
+class RefTransactionTestCase(GitRepositoryTestCase):
+    def get_ref(self, ref):
+        return exec_cmd(["git", "for-each-ref", "--format=%(objectname)",
+                         ref]) or None
+
+    def test_queued_changes(self):
+        first = get_head_commit("master")
+        second = self.commit("second")
+        exec_cmd(["git", "branch", "old", first])
+
+        transaction = RefTransaction(_FLAGS)
+        transaction.create("refs/heads/new", "master")
+        transaction.update("refs/heads/master", first, second)
+        transaction.delete("refs/heads/old", "refs/heads/old")
+        self.assertFalse(transaction.is_empty())
+        # Nothing is written before the commit.
+        self.assertEqual(self.get_ref("refs/heads/master"), second)
+        transaction.commit(_FLAGS)
+
+        self.assertTrue(transaction.is_empty())
+        self.assertEqual(self.get_ref("refs/heads/new"), second)
+        self.assertEqual(self.get_ref("refs/heads/master"), first)
+        self.assertIsNone(self.get_ref("refs/heads/old"))
+        self.assertEqual(get_head_commit("master"), first)
+
+    def test_old_value_verified(self):
+        first = get_head_commit("master")
+        second = self.commit("second")
+
+        transaction = RefTransaction(_FLAGS)
+        transaction.create("refs/heads/new", "master")
+        transaction.update("refs/heads/master", first, first)
+        self.assertRaises(GitError, transaction.commit, _FLAGS)
+        # No ref is written if any update fails.
+        self.assertIsNone(self.get_ref("refs/heads/new"))
+        self.assertEqual(self.get_ref("refs/heads/master"), second)
+
+    def test_existing_ref_not_created(self):
+        transaction = RefTransaction(_FLAGS)
+        transaction.create("refs/heads/master", "master")
+        self.assertRaises(GitError, transaction.commit, _FLAGS)
+
+    def test_missing_revision(self):
+        transaction = RefTransaction(_FLAGS)
+        self.assertRaises(GitError, transaction.update, "refs/heads/master",
+                          "refs/heads/missing")
+        self.assertRaises(GitError, delete_ref, _FLAGS, "refs/gbpx/missing")
+
+    def test_tag_index_updated(self):
+        transaction = RefTransaction(_FLAGS)
+        transaction.create("refs/tags/upstream/1.0", "master")
+        transaction.commit(_FLAGS)
+        self.assertEqual(get_head_tags("master", "upstream"),
+                         ["upstream/1.0"])
+
+    def test_safemode(self):
+        first = get_head_commit("master")
+        transaction = RefTransaction(_SAFE_FLAGS)
+        # Missing revisions are not resolved, nothing will be written.
+        transaction.create("refs/tags/upstream/1.0", "refs/tags/missing")
+        transaction.update("refs/heads/master", "refs/heads/missing",
+                           "refs/heads/missing")
+        transaction.delete("refs/gbpx/missing", "refs/gbpx/missing")
+        transaction.commit(_SAFE_FLAGS)
+        self.assertEqual(self.get_ref("refs/heads/master"), first)
+        self.assertIsNone(self.get_ref("refs/tags/upstream/1.0"))
+
+        delete_ref(_SAFE_FLAGS, "refs/gbpx/missing")
+        tag_head(_SAFE_FLAGS, "master", "upstream/1.0")
+        self.assertIsNone(self.get_ref("refs/tags/upstream/1.0"))
+        self.assertEqual(resolve_rev("master"), first)
+
+
+class SessionTestCase(GitRepositoryTestCase):
+    def test_shared_between_threads(self):
+        head = get_head_commit("master")
+        exec_cmd(["git", "tag", "upstream/1.0"])
+        get_session().close()
+        _sessions.clear()
+        with ThreadPoolExecutor(8) as executor:
+            sessions = list(executor.map(lambda _: get_session(), range(8)))
+            tag_indexes = list(executor.map(lambda _: get_tag_index(),
+                                            range(8)))
+            revs = list(executor.map(
+                lambda rev: (rev, resolve_rev(rev)),
+                ["master", "HEAD", "upstream/1.0"] * 20))
+        self.assertTrue(all(session is sessions[0] for session in sessions))
+        self.assertTrue(all(tag_index is tag_indexes[0]
+                            for tag_index in tag_indexes))
+        self.assertEqual(set(revs), {("master", head), ("HEAD", head),
+                                     ("upstream/1.0", head)})
+
+    def keep_mtime(self, rel_path, cmd):
+        """ Runs a command, then restores the mtime of a git file. """
+        file_path = path.join(self.rep_dir, ".git", rel_path)
+        file_stat = stat(file_path)
+        exec_cmd(cmd)
+        utime(file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+    def test_ref_updates_within_a_tick(self):
+        session = get_session()
+        first = session.get_head()
+        second = self.commit("second")
+        self.assertEqual(session.get_head(), second)
+        self.keep_mtime("refs/heads/master",
+                        ["git", "update-ref", "refs/heads/master", first])
+        self.assertEqual(session.get_head(), first)
+
+        exec_cmd(["git", "branch", "other"])
+        self.assertEqual(session.get_branch(), "master")
+        self.keep_mtime("HEAD", ["git", "symbolic-ref", "HEAD",
+                                 "refs/heads/other"])
+        self.assertEqual(session.get_branch(), "other")
+
+
+class CommitTreeTestCase(GitRepositoryTestCase):
+    def test_excluded_paths_with_whitespace(self):
+        for name in [" excluded", " kept"]:
+            with open(path.join(self.rep_dir, name), 'w') as file_:
+                file_.write(name + "\n")
+        commit_changes(_FLAGS, "Add files")
+        commit = commit_tree(_FLAGS, "master", "upstream", "Import",
+                             lambda file_path: file_path == " excluded")
+        self.assertEqual(
+            exec_cmd(["git", "ls-tree", "-z", "--name-only", commit],
+                     raw=True).split('\0'),
+            [" kept", "first", ""])
+        self.assertEqual(get_head_commit("upstream"), commit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import unittest
+from gzip import decompress
+from io import BytesIO
+from json import load
+from random import Random
+from os import close, remove
+from tempfile import mkstemp
+from threading import Thread
+
+from ioutil import CommandError, Span, exec_cmd, exec_concurrently, \
+    exec_cmd_streamed, get_spawn_count, get_cmd_records, get_current_span, \
+    dump_trace, exec_pipeline, PipelineError, Compression, get_compressor, \
+    get_compression_ext, _ZLIB_BLOCK_SIZE
+
+_MISSING_CMD = ["gbpx-test-missing-command"]
+
+
+class CmdRecordTestCase(unittest.TestCase):
+    def test_spawn_failure_not_recorded(self):
+        count = get_spawn_count()
+        with Span("test") as span:
+            self.assertRaises(CommandError, exec_cmd, _MISSING_CMD)
+            self.assertRaises(CommandError, exec_cmd_streamed, _MISSING_CMD)
+            self.assertRaises(CommandError, exec_concurrently,
+                              [_MISSING_CMD])
+        self.assertEqual(get_spawn_count(), count)
+        self.assertEqual(span.records, [])
+
+    def test_command_recorded(self):
+        count = get_spawn_count()
+        with Span("test") as span:
+            exec_cmd(["true"])
+            exec_concurrently([["true"]])
+        self.assertEqual(get_spawn_count(), count + 2)
+        self.assertEqual(len(span.records), 2)
+        for record in get_cmd_records()[-2:]:
+            self.assertIs(record.span, span)
+            self.assertEqual(record.exit_code, 0)
+
+
+def _upper(in_file, out_file):
+    out_file.write(in_file.read().upper())
+
+
+def _produce(in_file, out_file):
+    out_file.write(b"abc\n")
+
+
+def _fail(in_file, out_file):
+    raise ValueError("filter failed")
+
+
+class PipelineTestCase(unittest.TestCase):
+    def test_commands(self):
+        self.assertEqual(exec_pipeline([["echo", "abc"], ["tr", "a", "x"]]),
+                         "xbc")
+        self.assertEqual(get_cmd_records()[-1].out_bytes, 4)
+
+    def test_filter_only(self):
+        count = get_spawn_count()
+        self.assertEqual(exec_pipeline([_produce, _upper]), "ABC")
+        self.assertEqual(get_spawn_count(), count)
+
+    def test_filter_last(self):
+        self.assertEqual(exec_pipeline([["echo", "abc"], _upper]), "ABC")
+        # The output was produced by the filter, not by echo.
+        self.assertEqual(get_cmd_records()[-1].out_bytes, 0)
+
+    def test_filter_first(self):
+        self.assertEqual(exec_pipeline([_produce, ["tr", "a", "x"]]), "xbc")
+
+    def test_output_file(self):
+        fd, out_path = mkstemp()
+        close(fd)
+        try:
+            self.assertEqual(exec_pipeline([["echo", "abc"], _upper],
+                                           out_path), "")
+            with open(out_path, 'rb') as out_file:
+                self.assertEqual(out_file.read(), b"ABC\n")
+        finally:
+            remove(out_path)
+
+    def test_failing_stages(self):
+        with self.assertRaises(PipelineError) as context:
+            exec_pipeline([["echo", "abc"], ["false"], ["cat"]])
+        self.assertEqual(context.exception.stages[0][:2], ("false", 1))
+
+        with self.assertRaises(PipelineError) as context:
+            exec_pipeline([["echo", "abc"], _fail])
+        self.assertEqual(context.exception.stages,
+                         [("_fail", None, "filter failed")])
+
+        self.assertRaises(PipelineError, exec_pipeline,
+                          [_produce, _MISSING_CMD])
+
+    def test_sigpipe_not_failed(self):
+        self.assertEqual(exec_pipeline([["yes"], ["head", "-n", "1"]]), "y")
+
+
+class ZlibCompressorTestCase(unittest.TestCase):
+    def compress(self, data, threads):
+        out_file = BytesIO()
+        get_compressor(Compression.ZLIB, threads)(BytesIO(data), out_file)
+        return out_file.getvalue()
+
+    def test_round_trip(self):
+        random = Random(1)
+        text = b"".join(b"line %d of the test data\n" % i
+                        for i in range(20000))
+        noise = bytes(random.getrandbits(8) for _ in range(100000))
+        for data in [b"", b"a", text[:_ZLIB_BLOCK_SIZE],
+                     text[:_ZLIB_BLOCK_SIZE + 1], text + noise + text]:
+            compressed = self.compress(data, 4)
+            self.assertEqual(decompress(compressed), data)
+            # Blocks continue the stream, compressing as well as one pass.
+            self.assertLess(len(compressed), max(len(data), 1) + 100)
+
+    def test_independent_of_threads(self):
+        data = b"".join(b"%d\n" % i for i in range(200000))
+        self.assertEqual(self.compress(data, 1), self.compress(data, 3))
+
+    def test_gzip_compatible(self):
+        fd, out_path = mkstemp(suffix=get_compression_ext(Compression.ZLIB))
+        close(fd)
+        try:
+            exec_pipeline([["seq", "100000"],
+                           get_compressor(Compression.ZLIB, 2)], out_path)
+            self.assertEqual(exec_cmd(["gzip", "-dc", out_path]),
+                             exec_cmd(["seq", "100000"]))
+        finally:
+            remove(out_path)
+
+
+class SpanThreadTestCase(unittest.TestCase):
+    def test_worker_commands_in_caller_span(self):
+        with Span("caller") as span:
+            results = exec_concurrently([lambda: exec_cmd(["echo", "a"]),
+                                         lambda: get_current_span()])
+        self.assertEqual(results, ["a", span])
+        self.assertEqual([r.cmd for r in span.records], [["echo", "a"]])
+        # The worker threads leave the span when done.
+        self.assertEqual(exec_concurrently([get_current_span]), [None])
+
+    def test_thread_spans_separate(self):
+        thread_spans = []
+
+        def run():
+            thread_spans.append(get_current_span())
+            with Span("background") as background:
+                exec_cmd(["true"])
+                thread_spans.append(background)
+
+        with Span("main") as span:
+            thread = Thread(target=run)
+            thread.start()
+            thread.join()
+            exec_cmd(["true"])
+
+        self.assertIsNone(thread_spans[0])
+        self.assertIsNone(thread_spans[1].parent)
+        self.assertEqual(len(thread_spans[1].records), 1)
+        self.assertEqual(len(span.records), 1)
+        self.assertIs(get_current_span(), None)
+
+        fd, trace_path = mkstemp(suffix=".json")
+        close(fd)
+        try:
+            dump_trace(trace_path)
+            with open(trace_path) as trace_file:
+                events = load(trace_file)['traceEvents']
+        finally:
+            remove(trace_path)
+        tids = {event['name']: event['tid'] for event in events
+                if event.get('cat') == 'phase'}
+        self.assertEqual(tids['main'], 0)
+        self.assertNotEqual(tids['background'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
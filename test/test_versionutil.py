@@ -0,0 +1,77 @@
+import unittest
+
+from gbpx.versionutil import Version, compare_versions, sort_versions, \
+    max_version, sort_by_version, get_latest_by_version, get_file_version_str
+
+
+class CompareVersionsTestCase(unittest.TestCase):
+    def test_numeric_parts(self):
+        self.assertEqual(compare_versions("1.9", "1.10"), -1)
+        self.assertEqual(compare_versions("1.0", "1.00"), 0)
+        self.assertEqual(compare_versions("2.0", "1.99"), 1)
+
+    def test_epoch(self):
+        self.assertEqual(compare_versions("1:0.1", "9.9"), 1)
+        self.assertEqual(compare_versions("0:1.0", "1.0"), 0)
+
+    def test_tilde(self):
+        self.assertEqual(compare_versions("1.0~rc1", "1.0"), -1)
+        self.assertEqual(compare_versions("1.0~~", "1.0~"), -1)
+        self.assertEqual(compare_versions("1.0-1~bpo1", "1.0-1"), -1)
+
+    def test_letters_before_symbols(self):
+        self.assertEqual(compare_versions("1.0a", "1.0+"), -1)
+        self.assertEqual(compare_versions("1.0", "1.0a"), -1)
+
+    def test_revision(self):
+        self.assertEqual(compare_versions("1.0", "1.0-0"), 0)
+        self.assertEqual(compare_versions("1.0-1", "1.0-1ubuntu1"), -1)
+        self.assertEqual(compare_versions("1.0-2", "1.0-10"), -1)
+
+
+class VersionTestCase(unittest.TestCase):
+    def test_parts(self):
+        version = Version("2:1.0-rc-3")
+        self.assertEqual(version.epoch, 2)
+        self.assertEqual(version.upstream, "1.0-rc")
+        self.assertEqual(version.revision, "3")
+
+    def test_ordering(self):
+        self.assertTrue(Version("1.0~rc1") < Version("1.0"))
+        self.assertEqual(Version("1.0"), Version("1.00"))
+        self.assertEqual(len({Version("1.0"), Version("1.00")}), 1)
+
+    def test_sort_versions(self):
+        self.assertEqual(sort_versions(["1.10", "1:0.1", "1.0", "1.0~rc1"]),
+                         ["1.0~rc1", "1.0", "1.10", "1:0.1"])
+        self.assertEqual(max_version(["1.2", "1.10", "1.9"]), "1.10")
+        self.assertIsNone(max_version([]))
+
+
+class SortByVersionTestCase(unittest.TestCase):
+    _CHANGES = ["build/pkg_1.10-1_source.changes",
+                "build/pkg_1.9-1_source.changes",
+                "build/pkg_1.10-1~rc1_source.changes",
+                "build/README"]
+
+    def test_sort_by_version(self):
+        self.assertEqual(sort_by_version(self._CHANGES, get_file_version_str),
+                         ["build/pkg_1.9-1_source.changes",
+                          "build/pkg_1.10-1~rc1_source.changes",
+                          "build/pkg_1.10-1_source.changes"])
+
+    def test_get_latest_by_version(self):
+        self.assertEqual(get_latest_by_version(self._CHANGES,
+                                               get_file_version_str),
+                         ["build/pkg_1.10-1_source.changes"])
+        self.assertEqual(get_latest_by_version([], get_file_version_str), [])
+
+    def test_get_file_version_str(self):
+        self.assertEqual(get_file_version_str(
+            "bak/repo_2017-01-02-03-04-05.bak.tar.gz", ".bak.tar"),
+            "2017-01-02-03-04-05")
+        self.assertIsNone(get_file_version_str("build/README"))
+
+
+if __name__ == '__main__':
+    unittest.main()